@@ -5,6 +5,9 @@
 
 __author__ = 'jonpsull'
 
+import collections
+import concurrent.futures
+import inspect
 import jenkins
 import json
 import logging
@@ -14,6 +17,11 @@ import requests
 from stevedore import driver, ExtensionManager
 import xml.etree.ElementTree as ET
 
+from . import interface
+from . import metrics
+from . import ratelimit
+from . import registry
+
 
 # Monkey patch the jenkins import
 # The build number could be a string if we are addressing a particular build of a matrix build
@@ -91,8 +99,164 @@ def get_build_stages(self, name, number):
 
 
 jenkins.Jenkins.get_build_stages = get_build_stages
+
+
+# Stream the console log
+CONSOLE_CHUNK_SIZE = 64 * 1024
+
+
+def get_build_console_output_stream(self, name, number, chunk_size=CONSOLE_CHUNK_SIZE):
+    """Get build console text a line at a time, reading it from Jenkins in chunks
+
+    Lines are split as ``str.splitlines`` would split the full console text
+
+    :param name: Job name, ``str``
+    :param number: Build number, ``int``
+    :param chunk_size: Number of bytes to read from Jenkins at a time, ``int``
+    :returns: generator of console lines without line endings, ``str``
+    """
+    folder_url, short_name = self._get_job_folder(name)
+    req = requests.Request('GET', self._build_url(jenkins.BUILD_CONSOLE_OUTPUT, locals()))
+
+    try:
+        # As jenkins_request, but without reading the whole body in to memory
+        self._maybe_add_auth()
+        self.maybe_add_crumb(req)
+        prepared = self._session.prepare_request(req)
+        settings = self._session.merge_environment_settings(
+            prepared.url, {}, True, self._session.verify, None)
+        settings['timeout'] = self.timeout
+        response = self._response_handler(self._session.send(prepared, **settings))
+    except (requests.exceptions.HTTPError, jenkins.NotFoundException):
+        raise jenkins.JenkinsException('job[%s] number[%s] does not exist' % (name, number))
+
+    try:
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        pending = ''
+        for chunk in response.iter_content(chunk_size=chunk_size, decode_unicode=True):
+            lines = (pending + chunk).splitlines(True)
+            pending = ''
+            # The last line continues in the next chunk if it is unterminated,
+            # or ends in a '\r' that could be the start of a '\r\n'
+            if lines[-1].endswith('\r') or lines[-1].splitlines()[0] == lines[-1]:
+                pending = lines.pop()
+            for line in lines:
+                yield line.splitlines()[0]
+        if pending:
+            yield pending.splitlines()[0]
+    finally:
+        response.close()
+
+
+jenkins.Jenkins.get_build_console_output_stream = get_build_console_output_stream
+
+
+# Read the console log from a byte offset
+BUILD_CONSOLE_PROGRESSIVE_TEXT = '%(folder_url)sjob/%(short_name)s/%(number)s/logText/' + \
+    'progressiveText?start=%(start)s'
+
+
+def get_build_console_output_size(self, name, number):
+    """Get the size of the build console text, without downloading it
+
+    :param name: Job name, ``str``
+    :param number: Build number, ``int``
+    :returns: size of the console text, in bytes, ``int``
+    """
+    folder_url, short_name = self._get_job_folder(name)
+    start = 0
+
+    try:
+        # A HEAD request has the headers of the full console text, but no body
+        response = self.jenkins_request(requests.Request(
+                'HEAD', self._build_url(BUILD_CONSOLE_PROGRESSIVE_TEXT, locals())))
+        return int(response.headers['X-Text-Size'])
+    except (requests.exceptions.HTTPError, jenkins.NotFoundException):
+        raise jenkins.JenkinsException('job[%s] number[%s] does not exist' % (name, number))
+    except (KeyError, ValueError):
+        raise jenkins.JenkinsException(
+                'Could not get console size for job[%s] number[%s]' % (name, number))
+
+
+jenkins.Jenkins.get_build_console_output_size = get_build_console_output_size
+
+
+def get_build_console_output_from(self, name, number, start):
+    """Get build console text from a byte offset
+
+    :param name: Job name, ``str``
+    :param number: Build number, ``int``
+    :param start: Byte offset in the console text to start from, ``int``
+    :returns: console text from start, ``str``
+    """
+    folder_url, short_name = self._get_job_folder(name)
+
+    try:
+        response = self.jenkins_request(requests.Request(
+                'GET', self._build_url(BUILD_CONSOLE_PROGRESSIVE_TEXT, locals())))
+    except (requests.exceptions.HTTPError, jenkins.NotFoundException):
+        raise jenkins.JenkinsException('job[%s] number[%s] does not exist' % (name, number))
+    # The offset may split a multi-byte character, so don't fail decoding it
+    return response.content.decode('utf-8', errors='replace')
+
+
+jenkins.Jenkins.get_build_console_output_from = get_build_console_output_from
+
+
+# List the builds of a job, fetching only the fields needed rather than the full build info
+JOB_BUILDS = '%(folder_url)sjob/%(short_name)s/api/json?tree=%(builds)s' + \
+    '[number,building,result,timestamp,duration]%(build_range)s'
+
+
+def get_job_builds(self, name, all_builds=True, start=None, end=None):
+    """Get the number, building, result, timestamp and duration of the builds of a job
+
+    :param name: Job name, ``str``
+    :param all_builds: All of the builds, or only the most recent 100, ``bool``
+    :param start: With end, list only the builds from this index, newest first, ``int``
+    :param end: With start, list only the builds before this index, ``int``
+    :returns: builds of the job, newest first, ``list``
+    """
+    folder_url, short_name = self._get_job_folder(name)
+    builds = 'allBuilds' if all_builds else 'builds'
+    build_range = '' if start is None else '{%d,%d}' % (start, end)
+
+    try:
+        response = self.jenkins_open(requests.Request(
+                'GET', self._build_url(JOB_BUILDS, locals())))
+
+        if response:
+            return json.loads(response)[builds]
+        else:
+            raise jenkins.JenkinsException('job[%s] does not exist' % name)
+    except (requests.exceptions.HTTPError, jenkins.NotFoundException):
+        raise jenkins.JenkinsException('job[%s] does not exist' % name)
+    except (KeyError, ValueError):
+        raise jenkins.JenkinsException('Could not parse JSON info for job[%s]' % name)
+
+
+jenkins.Jenkins.get_job_builds = get_job_builds
 # End Monkey Patch
 
+
+def connect_jenkins(url, username=None, password=None, rate_limit=0, heavy_rate_limit=0):
+    """Create a Jenkins client, limited to the request rates of the Jenkins if given
+
+    :param url: Jenkins URL, ``str``
+    :param username: User to connect as, if any, ``str``
+    :param password: Password of the user, ``str``
+    :param rate_limit: Requests per second for all requests, 0 for no limit, ``float``
+    :param heavy_rate_limit: Requests per second for heavy requests, 0 for no limit, ``float``
+    :returns: ``jenkins.Jenkins``
+    """
+    server = jenkins.Jenkins(url, username=username, password=password)
+    if rate_limit or heavy_rate_limit:
+        # Each Jenkins has its own budget
+        ratelimit.limit_session(server._session, url, rate_limit, heavy_rate_limit)
+    return server
+
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -101,14 +265,33 @@ class JenkinsCollectError(Exception):
 
 
 class EsLogger(object):
+    # The data sources fetched for es_info itself, unless ES_INFO_DATA is set
+    DEFAULT_ES_INFO_DATA = [interface.CONSOLE_LOG, interface.JOB_CONFIG, interface.ENV_VARS]
+
+    # Because of timestamper 1.9+
+    # https://issues.jenkins-ci.org/browse/JENKINS-48344
+    # if the line starts with the timestamp, strip it
+    # [2020-04-22T11:21:48.848Z] console log
+    TIMESTAMP_RE = re.compile(
+            r'(^\[[0-9]{4}-[0-9]{2}-[0-9]{2}' +                 # Date: '[2020-04-22'
+            r'T[0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{3}Z\]\s)' +    # Time: 'T11:21:48.848Z] '
+            r'(.*$)')                                           # Actual console log line
+
     # Initialise the object
-    def __init__(self, console_length, targets):
+    def __init__(self, console_length, targets, config=None):
         self.data_name = type(self).__name__.lower()
+        # Settings by environment variable name, e.g. JENKINS_URL, used in preference to the
+        # environment so that builds with different settings can run in the same process
+        self.config = dict(config) if config else {}
 
         self.server = None
         self.jenkins_url = None
         self.jenkins_user = None
         self.jenkins_password = None
+        # Requests per second to Jenkins, overall and for heavy requests like the console log,
+        # shared by every EsLogger in the process
+        self.jenkins_rate_limit = None
+        self.jenkins_heavy_rate_limit = None
 
         self.es_job_name = None
         self.es_build_number = None
@@ -123,56 +306,102 @@ class EsLogger(object):
         self.job_xml_raw = None
         self.job_xml = None
 
+        self.console_log = None
+        self.console_log_processors = None
+        self.console_tail_only = None
+
+        # The data sources to fetch from Jenkins, resolved from es_info_data and the plugins
+        self.es_info_data = None
+        self.data_requirements = None
+
         self.process_console_logs = []
         self.gather_build_data = []
         self.generate_events = []
 
+        # Jenkins requests started by prefetch_build_data, keyed by server method name
+        self.collect_workers = None
+        self.prefetched = {}
+        self.generate_workers = None
+
         self.jenkins_url = self.get_jenkins_url()
         self.jenkins_user = self.get_jenkins_user()
         self.jenkins_password = self.get_jenkins_password()
+        self.jenkins_rate_limit = self.get_jenkins_rate_limit()
+        self.jenkins_heavy_rate_limit = self.get_jenkins_heavy_rate_limit()
         if self.jenkins_url:
-            self.server = jenkins.Jenkins(self.jenkins_url,
-                                          username=self.jenkins_user,
-                                          password=self.jenkins_password)
+            self.server = connect_jenkins(self.jenkins_url, self.jenkins_user,
+                                          self.jenkins_password, self.jenkins_rate_limit,
+                                          self.jenkins_heavy_rate_limit)
         self.es_job_name = self.get_es_job_name()
         self.es_build_number = self.get_es_build_number()
         self.process_console_logs = self.get_process_console_logs()
         self.gather_build_data = self.get_gather_build_data()
         self.generate_events = self.get_generate_events()
+        self.collect_workers = self.get_collect_workers()
+        self.generate_workers = self.get_generate_workers()
+        self.console_tail_only = self.get_console_tail_only()
+        self.es_info_data = self.get_es_info_data()
         self.console_length = console_length
 
-        self.targets = []
-        for target in targets:
-            self.targets.append(driver.DriverManager(namespace='es_logger.plugins.event_target',
-                                                     invoke_on_load=True, name=target))
+        self.targets = [self.load_target(target) for target in targets]
         LOGGER.info('Using targets: {}'.format(targets))
 
+    # Load a target, passing it the config if it takes one.  Targets written when they were
+    # created without any arguments are given the config once created instead
+    def load_target(self, name):
+        namespace = 'es_logger.plugins.event_target'
+        parameters = inspect.signature(registry.get_plugin_class(namespace, name)).parameters
+        if 'config' in parameters or \
+                any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+            return driver.DriverManager(namespace=namespace, invoke_on_load=True, name=name,
+                                        invoke_kwds={'config': self.config})
+        target = driver.DriverManager(namespace=namespace, invoke_on_load=True, name=name)
+        target.driver.config = dict(self.config)
+        return target
+
     ####################################
     # Get variables from the environment
     ####################################
+    # A setting from the config, or failing that the environment
+    # Also used by the plugins, which are shared by every EsLogger in the process
+    def get_setting(self, name, default=None):
+        if name in self.config:
+            return self.config[name]
+        return os.environ.get(name, default)
+
     def get_jenkins_url(self):
         if not self.jenkins_url:
-            return os.environ.get('JENKINS_URL')
+            return self.get_setting('JENKINS_URL')
         return self.jenkins_url
 
     def get_jenkins_user(self):
         if not self.jenkins_user:
-            return os.environ.get('JENKINS_USER')
+            return self.get_setting('JENKINS_USER')
         return self.jenkins_user
 
     def get_jenkins_password(self):
         if not self.jenkins_password:
-            return os.environ.get('JENKINS_PASSWORD')
+            return self.get_setting('JENKINS_PASSWORD')
         return self.jenkins_password
 
+    def get_jenkins_rate_limit(self):
+        if not self.jenkins_rate_limit:
+            return float(self.get_setting('JENKINS_RATE_LIMIT') or 0)
+        return self.jenkins_rate_limit
+
+    def get_jenkins_heavy_rate_limit(self):
+        if not self.jenkins_heavy_rate_limit:
+            return float(self.get_setting('JENKINS_HEAVY_RATE_LIMIT') or 0)
+        return self.jenkins_heavy_rate_limit
+
     def get_es_job_name(self):
         if not self.es_job_name:
-            return os.environ.get('ES_JOB_NAME')
+            return self.get_setting('ES_JOB_NAME')
         return self.es_job_name
 
     def get_es_build_number(self):
         if not self.es_build_number:
-            return os.environ.get('ES_BUILD_NUMBER', '0')
+            return self.get_setting('ES_BUILD_NUMBER', '0')
         if type(self.es_build_number) is int:
             LOGGER.warn("converting int es_build_number to string")
             self.es_build_number = '{}'.format(self.es_build_number)
@@ -180,7 +409,7 @@ class EsLogger(object):
 
     def get_process_console_logs(self):
         if not self.process_console_logs:
-            process_console_logs = os.environ.get('PROCESS_CONSOLE_LOGS')
+            process_console_logs = self.get_setting('PROCESS_CONSOLE_LOGS')
             if process_console_logs in [None, '']:
                 self.process_console_logs = []
             else:
@@ -189,7 +418,7 @@ class EsLogger(object):
 
     def get_gather_build_data(self):
         if not self.gather_build_data:
-            gather_build_data = os.environ.get('GATHER_BUILD_DATA')
+            gather_build_data = self.get_setting('GATHER_BUILD_DATA')
             if gather_build_data in [None, '']:
                 self.gather_build_data = []
             else:
@@ -198,15 +427,38 @@ class EsLogger(object):
 
     def get_generate_events(self):
         if not self.generate_events:
-            generate_events = os.environ.get('GENERATE_EVENTS')
+            generate_events = self.get_setting('GENERATE_EVENTS')
             if generate_events in [None, '']:
                 self.generate_events = []
             else:
                 self.generate_events = generate_events.split(' ')
-            if os.environ.get('ES_NO_COMMIT_EVENTS', None) is None:
+            if self.get_setting('ES_NO_COMMIT_EVENTS', None) is None:
                 self.generate_events.append('commit')
             self.generate_events = list(set(self.generate_events))
         return self.generate_events
+
+    def get_collect_workers(self):
+        if self.collect_workers is None:
+            return int(self.get_setting('ES_COLLECT_WORKERS', '0'))
+        return self.collect_workers
+
+    def get_generate_workers(self):
+        if self.generate_workers is None:
+            return int(self.get_setting('ES_GENERATE_WORKERS', '0'))
+        return self.generate_workers
+
+    def get_console_tail_only(self):
+        if self.console_tail_only is None:
+            return self.get_setting('ES_CONSOLE_TAIL_ONLY', None) is not None
+        return self.console_tail_only
+
+    def get_es_info_data(self):
+        if self.es_info_data is None:
+            es_info_data = self.get_setting('ES_INFO_DATA')
+            if es_info_data is None:
+                return list(self.DEFAULT_ES_INFO_DATA)
+            return es_info_data.split()
+        return self.es_info_data
     ################
     # End of getters
     ################
@@ -261,24 +513,34 @@ class EsLogger(object):
             self.es_info[self.data_name]['build_label'] = '/'.join(build_number_parts[1:])
         self.es_info[self.data_name]['es_build_number'] = self.get_es_build_number()
 
+        requirements = self.get_data_requirements()
+
+        # Start the independent Jenkins requests in parallel if configured to
+        if self.get_collect_workers() > 0:
+            self.prefetch_build_data()
+
         try:
             # Build Info (Parameters, Status)
-            self.build_info = self.server.get_build_info(self.es_job_name,
-                                                         self.get_es_build_number(),
-                                                         depth=0)
+            self.build_info = self.fetch('get_build_info', self.server.get_build_info,
+                                         self.es_job_name, self.get_es_build_number(), depth=0)
         except Exception as exc:
             raise JenkinsCollectError("get_build_info") from exc
         self.es_info['build_info'] = self.build_info
 
-        try:
-            self.job_xml_raw = self.server.get_job_config(self.es_job_name)
-        except jenkins.JenkinsException as jenkins_err:
-            LOGGER.error("JenkinsException when attempting to get job config: {}".format(
-                    jenkins_err))
+        if interface.JOB_CONFIG in requirements:
+            try:
+                self.job_xml_raw = self.fetch('get_job_config', self.server.get_job_config,
+                                              self.es_job_name)
+            except jenkins.JenkinsException as jenkins_err:
+                LOGGER.error("JenkinsException when attempting to get job config: {}".format(
+                        jenkins_err))
+                self.es_info['job_config_info'] = None
+                self.es_info['job_config_info_status'] = "Unable to retrieve config.xml."
+            except Exception as exc:
+                raise JenkinsCollectError("get_job_config") from exc
+        else:
             self.es_info['job_config_info'] = None
-            self.es_info['job_config_info_status'] = "Unable to retrieve config.xml."
-        except Exception as exc:
-            raise JenkinsCollectError("get_job_config") from exc
+            self.es_info['job_config_info_status'] = "Not required."
 
         if self.job_xml_raw is not None:
             self.job_xml = ET.fromstring(self.job_xml_raw)
@@ -286,28 +548,74 @@ class EsLogger(object):
             self.es_info['job_config_info_status'] = "Retrieved config.xml."
 
         # Environment Variables
-        try:
-            self.env_vars = self.server.get_build_env_vars(self.es_job_name,
-                                                           self.get_es_build_number())
-        except Exception as exc:
-            raise JenkinsCollectError("get_build_env_vars") from exc
+        self.env_vars = None
+        if interface.ENV_VARS in requirements:
+            try:
+                self.env_vars = self.fetch('get_build_env_vars', self.server.get_build_env_vars,
+                                           self.es_job_name, self.get_es_build_number())
+            except Exception as exc:
+                raise JenkinsCollectError("get_build_env_vars") from exc
         self.es_info['env_vars'] = self.env_vars
 
         # Process build_info
         self.process_build_info()
 
         # Process the console log
-        self.process_console_log()
+        if interface.CONSOLE_LOG in requirements:
+            self.process_console_log()
 
         # Now run through any extra data gathering plugins to annotate the event
         for plugin in self.gather_build_data:
-            data = driver.DriverManager(
-                    namespace='es_logger.plugins.gather_build_data',
-                    name=plugin,
-                    invoke_on_load=True,
-                    invoke_args=()
-                )
-            self.es_info.setdefault('build_data', {})[plugin] = data.driver.gather(self)
+            data = registry.get_plugin('es_logger.plugins.gather_build_data', plugin)
+            self.es_info.setdefault('build_data', {})[plugin] = data.gather(self)
+
+    # Start the Jenkins requests used by get_build_data on a bounded thread pool,
+    # so that the build takes the time of the slowest request rather than the sum of them all
+    def prefetch_build_data(self):
+        # Load plugins here rather than in a worker thread
+        self.get_console_log_processors()
+        requirements = self.get_data_requirements()
+        calls = {
+            'get_build_info': (self.server.get_build_info,
+                               (self.es_job_name, self.get_es_build_number()), {'depth': 0}),
+        }
+        if interface.JOB_CONFIG in requirements:
+            calls['get_job_config'] = (self.server.get_job_config, (self.es_job_name,), {})
+        if interface.ENV_VARS in requirements:
+            calls['get_build_env_vars'] = (self.server.get_build_env_vars,
+                                           (self.es_job_name, self.get_es_build_number()), {})
+        if interface.CONSOLE_LOG in requirements:
+            calls['read_console_log'] = (self.get_console_log_reader(), (), {})
+        # These are otherwise fetched when the plugins that need them ask for them
+        if interface.TEST_REPORT in requirements:
+            calls['get_build_test_report'] = (self.server.get_build_test_report,
+                                              (self.es_job_name, self.get_es_build_number()), {})
+        if interface.STAGES in requirements:
+            calls['get_build_stages'] = (self.server.get_build_stages,
+                                         (self.es_job_name, self.get_es_build_number()), {})
+        LOGGER.debug("Prefetching {} with {} workers".format(list(calls.keys()),
+                                                             self.get_collect_workers()))
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.get_collect_workers(), len(calls)))
+        for name, (func, args, kwargs) in calls.items():
+            self.prefetched[name] = executor.submit(self.timed_request, name, func, *args,
+                                                    **kwargs)
+        # Don't wait here, the results are collected as they are needed by fetch
+        executor.shutdown(wait=False)
+
+    # Return the result of func, using the request already started by prefetch_build_data
+    # if there is one.  Exceptions are raised to the caller as if func had been called directly
+    def fetch(self, name, func, *args, **kwargs):
+        future = self.prefetched.pop(name, None)
+        if future is not None:
+            return future.result()
+        return self.timed_request(name, func, *args, **kwargs)
+
+    # Return the result of func, recording how long the request took
+    @staticmethod
+    def timed_request(name, func, *args, **kwargs):
+        with metrics.JENKINS_REQUEST_SECONDS.time(request=name):
+            return func(*args, **kwargs)
 
     def get_pipeline_job_type(self):
         pipeline_types = {"org.jenkinsci.plugins.workflow.cps.CpsFlowDefinition": "Script",
@@ -392,50 +700,169 @@ class EsLogger(object):
                 # Clear the field that causes ES field explosion
                 action['buildsByBranchName'] = "Removed by es-logger"
 
-    # Process Console Log
-    def process_console_log(self):
+    # Load the console log processor plugins for this build
+    def get_console_log_processors(self):
+        if self.console_log_processors is None:
+            self.console_log_processors = {}
+            for plugin in self.process_console_logs:
+                # Processors keep state while processing a console log, so one per build
+                processor = registry.get_plugin_class('es_logger.plugins.console_log_processor',
+                                                      plugin)
+                self.console_log_processors[plugin] = processor()
+        return self.console_log_processors
+
+    # The data sources needed by each kind of configured plugin, keyed by plugin namespace
+    def get_plugin_requirements(self):
+        plugin_requirements = {}
+        for namespace, plugins in [('console_log_processor', self.process_console_logs),
+                                   ('gather_build_data', self.gather_build_data),
+                                   ('event_generator', self.generate_events)]:
+            requirements = set()
+            for plugin in plugins:
+                plugin_class = registry.get_plugin_class('es_logger.plugins.' + namespace, plugin)
+                requirements.update(plugin_class.get_requirements())
+            plugin_requirements[namespace] = requirements
+        return plugin_requirements
+
+    # The data sources to fetch from Jenkins, the union of those needed for es_info
+    # and those required by the plugins in use
+    def get_data_requirements(self):
+        if self.data_requirements is None:
+            requirements = set(self.get_es_info_data())
+            for plugin_requirements in self.get_plugin_requirements().values():
+                requirements.update(plugin_requirements)
+            # get_event_info adds the env vars from get_fields to every generated event
+            if len(self.generate_events) > 0:
+                requirements.add(interface.ENV_VARS)
+            LOGGER.debug("Data required from Jenkins: {}".format(sorted(requirements)))
+            self.data_requirements = requirements
+        return self.data_requirements
+
+    # Whether the full console log has to be held in memory, rather than just the tail for es_info
+    def console_log_required(self):
+        for processor in self.get_console_log_processors().values():
+            if not processor.streaming:
+                return True
+        # Build data gatherers and event generators are passed this object, so may read the
+        # console log
+        plugin_requirements = self.get_plugin_requirements()
+        return interface.CONSOLE_LOG in plugin_requirements['gather_build_data'] or \
+            interface.CONSOLE_LOG in plugin_requirements['event_generator']
+
+    # Whether only the tail of the console log has to be fetched from Jenkins
+    def console_tail_possible(self):
+        if not self.get_console_tail_only():
+            return False
+        # Every line has to be read if any plugin requires the console log
+        for requirements in self.get_plugin_requirements().values():
+            if interface.CONSOLE_LOG in requirements:
+                LOGGER.debug("Reading the full console log, as plugins require it")
+                return False
+        return True
+
+    # The function that reads the console log, for process_console_log
+    def get_console_log_reader(self):
+        if self.console_tail_possible():
+            return self.read_console_log_tail
+        return self.read_console_log
+
+    # Strip the timestamper timestamp from the start of a console log line
+    def strip_timestamp(self, line):
+        mo = self.TIMESTAMP_RE.match(line)
+        if mo:
+            return mo.group(2)
+        return line
+
+    # The console log lines, wrapping any error in the fetch from Jenkins
+    def console_log_lines(self):
         try:
-            self.console_log_ts = self.server.get_build_console_output(self.es_job_name,
-                                                                       self.get_es_build_number())
+            yield from self.server.get_build_console_output_stream(self.es_job_name,
+                                                                   self.get_es_build_number())
         except Exception as exc:
             raise JenkinsCollectError("get_build_console_output") from exc
-        # Because of timestamper 1.9+
-        # https://issues.jenkins-ci.org/browse/JENKINS-48344
-        # if the line starts with the timestamp, strip it
-        # [2020-04-22T11:21:48.848Z] console log
-        all_lines = []
-        time_re = re.compile(
-                r'(^\[[0-9]{4}-[0-9]{2}-[0-9]{2}' +                 # Date: '[2020-04-22'
-                r'T[0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{3}Z\]\s)' +    # Time: 'T11:21:48.848Z] '
-                r'(.*$)')                                           # Actual console log line
-        for line in self.console_log_ts.splitlines():
-            mo = time_re.match(line)
-            if mo:
-                all_lines.append(mo.group(2))
-            else:
+
+    # Stream the console log from Jenkins, stripping timestamps and passing each line to the
+    # streaming console log processors.  Only the tail is kept unless the full log is required
+    # Returns the tail of the console log and the length of the full console log
+    def read_console_log(self):
+        streaming = [p for p in self.get_console_log_processors().values() if p.streaming]
+        all_lines = [] if self.console_log_required() else None
+        tail = collections.deque()
+        tail_length = 0
+        console_log_length = 0
+        for line in self.console_log_lines():
+            line = self.strip_timestamp(line)
+            for processor in streaming:
+                processor.process_line(line)
+            if all_lines is not None:
                 all_lines.append(line)
-        self.console_log = "\n".join(all_lines)
+            # Account for the newline joining this line to the previous one
+            separator = 1 if len(tail) > 0 else 0
+            console_log_length += separator + len(line)
+            tail_length += separator + len(line)
+            tail.append(line)
+            # Drop lines from the tail that aren't needed to make up console_length characters
+            # (a console_length of 0 has always meant the full console log)
+            while len(tail) > 1 and self.console_length > 0 and \
+                    tail_length - len(tail[0]) - 1 >= self.console_length:
+                tail_length -= len(tail.popleft()) + 1
+
+        if all_lines is not None:
+            self.console_log = "\n".join(all_lines)
+        return "\n".join(tail), console_log_length
+
+    # Fetch only the end of the console log from Jenkins, enough for console_length characters
+    # once timestamps are stripped.  The length returned is the size of the log in bytes
+    # Jenkins that can't give the size, e.g. behind a proxy that drops the X-Text-Size header of
+    # a HEAD request, have the whole console log streamed instead
+    def read_console_log_tail(self):
+        try:
+            size = self.server.get_build_console_output_size(self.es_job_name,
+                                                             self.get_es_build_number())
+        except Exception as exc:
+            LOGGER.warning("Unable to get the console log size, reading all of it: {}".format(exc))
+            return self.read_console_log()
+        try:
+            # Start with the most bytes console_length UTF-8 characters could take
+            window = 4 * self.console_length
+            while True:
+                start = max(0, size - window) if self.console_length > 0 else 0
+                text = self.server.get_build_console_output_from(self.es_job_name,
+                                                                 self.get_es_build_number(),
+                                                                 start)
+                lines = text.splitlines()
+                # Unless this is the start of the log, the first line is likely partial
+                if start > 0 and len(lines) > 0:
+                    lines.pop(0)
+                tail = "\n".join([self.strip_timestamp(line) for line in lines])
+                if start == 0 or len(tail) >= self.console_length:
+                    return tail, size
+                # Timestamps or a long partial line meant not enough was fetched
+                window *= 2
+        except Exception as exc:
+            raise JenkinsCollectError("get_build_console_output") from exc
+
+    # Process Console Log
+    def process_console_log(self):
+        console_log_tail, console_log_length = self.fetch('read_console_log',
+                                                          self.get_console_log_reader())
 
         # Add plugin loading and processing with an array of plugins
         # e.g. - count errors, count warnings, parse test results, etc.
-        for plugin in self.process_console_logs:
-            processor = driver.DriverManager(
-                    namespace='es_logger.plugins.console_log_processor',
-                    name=plugin,
-                    invoke_on_load=True,
-                    invoke_args=()
-                )
-            self.es_info.setdefault('console_log_plugins', {})[plugin] = processor.driver.process(
-                self.console_log)
+        for plugin, processor in self.get_console_log_processors().items():
+            if processor.streaming:
+                result = processor.finish_process()
+            else:
+                result = processor.process(self.console_log)
+            self.es_info.setdefault('console_log_plugins', {})[plugin] = result
 
         # Max length for an indexed field is 32766, if longer, reduce
         # Default value in args parsing is 32500,
         # as when using larger values saw failures (not sure why)
-        console_log_length = len(self.console_log)
         if console_log_length > self.console_length:
-            self.es_info['console_log'] = self.console_log[-self.console_length:]
+            self.es_info['console_log'] = console_log_tail[-self.console_length:]
         else:
-            self.es_info['console_log'] = self.console_log
+            self.es_info['console_log'] = console_log_tail
         # Add the length of the console log
         self.es_info['console_log_length'] = console_log_length
 
@@ -467,36 +894,59 @@ class EsLogger(object):
     # To enable best visualisation of data,
     # allow for plugins that create an array of events to post
     def get_events(self):
-        # Run through any event generator plugins
-        for plugin in self.generate_events:
-            event_generator = driver.DriverManager(
-                    namespace='es_logger.plugins.event_generator',
-                    name=plugin,
-                    invoke_on_load=True,
-                    invoke_args=()
-                )
-            gen_events = event_generator.driver.generate_events(self)
-
-            # Get the default event info
-            event_info = self.get_event_info(event_generator.driver.get_fields())
-            # Add the name of the driver into the event field
-            event_info[self.data_name]['event'] = plugin
-
-            # Add the default data to each of the events we are sending in
-            add_events = []
-            for event in gen_events:
-                new_event = {plugin: event}
-                new_event.update(event_info)
-                # Add the timestamp for logging when this ran
-                new_event.setdefault('build_info', {})['timestamp'] = \
-                    self.es_info['build_info'].get('timestamp')
-                add_events.append(new_event)
-            self.events += add_events
+        # Load the event generator plugins before running any of them
+        generators = [(plugin, registry.get_plugin('es_logger.plugins.event_generator', plugin))
+                      for plugin in self.generate_events]
+        if self.get_generate_workers() > 0:
+            self.events += self.get_events_parallel(generators)
+        else:
+            # Run through any event generator plugins
+            for plugin, event_generator in generators:
+                self.events += self.get_plugin_events(plugin, event_generator)
+
+    # Run the event generators on a thread pool, as they are a mix of waiting on Jenkins and
+    # scanning the console log.  The events are kept in generate_events order, and a failing
+    # generator is logged and recorded in es_info rather than losing the events of the others
+    def get_events_parallel(self, generators):
+        events = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.get_generate_workers()) as executor:
+            futures = [(plugin, executor.submit(self.get_plugin_events, plugin, event_generator))
+                       for plugin, event_generator in generators]
+            for plugin, future in futures:
+                try:
+                    events += future.result()
+                except Exception as exc:
+                    LOGGER.exception("Event generator {} failed".format(plugin))
+                    self.es_info.setdefault('event_generator_errors', {})[plugin] = \
+                        "{}: {}".format(type(exc).__name__, exc)
+        return events
+
+    # Generate the events from a single event generator plugin
+    def get_plugin_events(self, plugin, event_generator):
+        gen_events = event_generator.generate_events(self)
+
+        # Get the default event info
+        event_info = self.get_event_info(event_generator.get_fields())
+        # Add the name of the driver into the event field
+        event_info[self.data_name]['event'] = plugin
+
+        # Add the default data to each of the events we are sending in
+        add_events = []
+        for event in gen_events:
+            new_event = {plugin: event}
+            new_event.update(event_info)
+            # Add the timestamp for logging when this ran
+            new_event.setdefault('build_info', {})['timestamp'] = \
+                self.es_info['build_info'].get('timestamp')
+            add_events.append(new_event)
+        return add_events
 
     def get_test_report(self):
         if self.es_info['test_report'] is None:
             try:
-                self.es_info['test_report'] = self.server.get_build_test_report(
+                self.es_info['test_report'] = self.fetch(
+                    'get_build_test_report', self.server.get_build_test_report,
                     self.es_job_name, self.get_es_build_number())
             except Exception as exc:
                 raise JenkinsCollectError("get_build_test_report") from exc
@@ -505,7 +955,8 @@ class EsLogger(object):
     def get_stages(self):
         if self.es_info['stages'] is None:
             try:
-                self.es_info['stages'] = self.server.get_build_stages(
+                self.es_info['stages'] = self.fetch(
+                    'get_build_stages', self.server.get_build_stages,
                     self.es_job_name, self.get_es_build_number())
             except Exception as exc:
                 raise JenkinsCollectError("get_build_stages") from exc
@@ -519,23 +970,32 @@ class EsLogger(object):
     def post(self, json_event):
         status = 0
         for target in self.targets:
-            status += target.driver.send_event(json_event)
+            target_status = target.driver.send_event(json_event)
+            if target_status:
+                metrics.TARGET_ERRORS.inc(target_status, target=target.names()[0])
+            status += target_status
         return status
 
     def finish(self):
         status = 0
         for target in self.targets:
-            status += target.driver.finish_send()
+            target_status = target.driver.finish_send()
+            if target_status:
+                metrics.TARGET_ERRORS.inc(target_status, target=target.names()[0])
+            status += target_status
         return status
 
     def gather_all(self):
-        self.get_build_data()
-        self.get_events()
+        with metrics.STAGE_SECONDS.time(stage='gather'):
+            self.get_build_data()
+        with metrics.STAGE_SECONDS.time(stage='generate'):
+            self.get_events()
 
     def post_all(self):
         process_events = [self.es_info] + self.events
         status = 0
-        for e in process_events:
-            status += self.post(e)
-        status += self.finish()
+        with metrics.STAGE_SECONDS.time(stage='post'):
+            for e in process_events:
+                status += self.post(e)
+            status += self.finish()
         return status
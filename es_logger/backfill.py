@@ -0,0 +1,137 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import concurrent.futures
+import es_logger
+import fnmatch
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Append-only file of the builds a backfill has processed, a line of JSON for each
+# Builds that processed without error are skipped when the backfill is run again,
+# so an interrupted backfill carries on where it stopped, and failed builds are retried
+class Progress(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path) as progress:
+                for line in progress:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line left incomplete by the backfill being killed
+                        continue
+                    self.update(record['job'], record['number'], record['status'])
+
+    def __len__(self):
+        return len(self.done)
+
+    def update(self, job, number, status):
+        if status == 0:
+            self.done.add((job, number))
+        else:
+            self.done.discard((job, number))
+
+    def is_done(self, job, number):
+        return (job, number) in self.done
+
+    # Record the status of a build, from any of the workers
+    def record(self, job, number, status):
+        with self.lock:
+            if self.path is not None:
+                with open(self.path, 'a') as progress:
+                    progress.write(json.dumps({'job': job, 'number': number,
+                                               'status': status}) + '\n')
+            self.update(job, number, status)
+
+
+# Process the finished builds of jobs in a range of build numbers, each build gathered, generated
+# and posted on its own worker, so many builds are in progress at once in the one process
+class Backfill(object):
+    def __init__(self, job, first=1, last=None, targets=('logstash',), console_length=32500,
+                 workers=4, progress=None, config=None):
+        self.job = job
+        self.first = first
+        self.last = last
+        self.targets = list(targets)
+        self.console_length = console_length
+        self.workers = workers
+        self.progress = Progress(progress)
+        # Settings for EsLogger by environment variable name, over those in the environment
+        self.config = dict(config) if config else {}
+        self.server = None
+
+    # The Jenkins server, rate limited as the EsLogger processing the builds are
+    def get_server(self):
+        if self.server is None:
+            self.server = es_logger.EsLogger(self.console_length, [], config=self.config).server
+            if self.server is None:
+                raise es_logger.JenkinsCollectError("JENKINS_URL is not set")
+        return self.server
+
+    # The full names of the jobs matching a job name, which may be a glob, e.g. folder/*
+    def get_jobs(self):
+        if not any(char in self.job for char in '*?['):
+            return [self.job]
+        return sorted(job['fullname'] for job in self.get_server().get_all_jobs()
+                      if 'jobs' not in job and fnmatch.fnmatchcase(job['fullname'], self.job))
+
+    # The numbers of the finished builds of a job in the range, oldest first
+    def get_builds(self, job):
+        return sorted(build['number'] for build in self.get_server().get_job_builds(job)
+                      if not build.get('building') and self.first <= build['number'] and
+                      (self.last is None or build['number'] <= self.last))
+
+    # The (job, number) of each build to process, leaving out any already done
+    def get_work(self):
+        work = []
+        for job in self.get_jobs():
+            builds = self.get_builds(job)
+            work += [(job, number) for number in builds
+                     if not self.progress.is_done(job, number)]
+            LOGGER.info("{} has {} builds in range".format(job, len(builds)))
+        return work
+
+    def process_build(self, job, number):
+        config = dict(self.config)
+        config['ES_JOB_NAME'] = job
+        config['ES_BUILD_NUMBER'] = '{}'.format(number)
+        try:
+            esl = es_logger.EsLogger(self.console_length, self.targets, config=config)
+            esl.gather_all()
+            status = esl.post_all()
+        except Exception as exc:
+            LOGGER.warning("{} number {} exception: {}".format(job, number, exc))
+            status = 1
+        self.progress.record(job, number, status)
+        LOGGER.info("{} number {} status {}".format(job, number, status))
+        return status
+
+    # Process the builds, returning the number that failed
+    def run(self):
+        work = self.get_work()
+        LOGGER.info("Backfilling {} builds on {} workers, {} already done".format(
+            len(work), self.workers, len(self.progress)))
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='backfill') as executor:
+            futures = [executor.submit(self.process_build, job, number) for job, number in work]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    if future.result() != 0:
+                        failed += 1
+            except KeyboardInterrupt:
+                LOGGER.warning("Interrupted, finishing the builds in progress")
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        LOGGER.info("Backfilled {} builds, {} failed".format(len(work), failed))
+        return failed
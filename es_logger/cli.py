@@ -7,6 +7,7 @@ __author__ = 'jonpsull'
 
 import argparse
 import es_logger
+import es_logger.backfill
 import logging
 import sys
 
@@ -15,6 +16,8 @@ def parse_args():
     desc = '''
 Read data from a completed Jenkins job and push it to a logstash instance.
 
+Run "es-logger backfill --help" to process many builds of a job, or of several jobs.
+
 Behaviour is controlled through a number of environment variables as follows:
 
 What data to gather:
@@ -26,10 +29,19 @@ Where to gather data from:
     JENKINS_URL             The url to access Jenkins at
     JENKINS_USER            The username for Jenkins access
     JENKINS_PASSWORD        The password or API token for Jenkins access
+    JENKINS_RATE_LIMIT      Make at most this many requests a second to Jenkins
+    JENKINS_HEAVY_RATE_LIMIT
+                            Make at most this many console, test report and artifact
+                            requests a second to Jenkins
+    ES_COLLECT_WORKERS      Make up to this many Jenkins requests for build data in parallel
+    ES_CONSOLE_TAIL_ONLY    Only fetch the end of the console log when no plugins need all of it
 
 What to gather data from:
     ES_JOB_NAME             The "Full Project Name" style job name for the job to process
     ES_BUILD_NUMBER         The build number for the job to process
+    ES_INFO_DATA            The data to fetch for the main build event, defaults to
+                            "console_log job_config env_vars"
+    ES_GENERATE_WORKERS     Run up to this many event generator plugins in parallel
 
 Target Variables:
 '''
@@ -64,6 +76,51 @@ Target Variables:
     return args
 
 
+def parse_backfill_args(argv):
+    desc = '''
+Read data from the completed builds of Jenkins jobs and push it to the targets, processing
+several builds at once.  Jenkins and plugins are configured through the same environment
+variables as es-logger, other than ES_JOB_NAME and ES_BUILD_NUMBER.
+'''
+    parser = argparse.ArgumentParser(prog='es-logger backfill',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=desc)
+    parser.add_argument(
+        'job', help='The "Full Project Name" of the job, or a glob matching several, e.g. folder/*')
+    parser.add_argument(
+        '--from', dest='first', type=int, default=1, help='The first build number to process')
+    parser.add_argument(
+        '--to', dest='last', type=int, help='The last build number to process, defaults to all')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=4, help='Process up to this many builds at once')
+    parser.add_argument(
+        '--progress',
+        help='Record the builds processed in this file, and skip those already processed without '
+             'error, so an interrupted backfill can be run again to carry on')
+    parser.add_argument(
+        '--rate-limit', type=float,
+        help='Make at most this many requests a second to Jenkins, over JENKINS_RATE_LIMIT')
+    parser.add_argument(
+        '--heavy-rate-limit', type=float,
+        help='Make at most this many console, test report and artifact requests a second to '
+             'Jenkins, over JENKINS_HEAVY_RATE_LIMIT')
+    parser.add_argument(
+        '-l', '--list', action='store_true', help='List the builds to process, then exit')
+    parser.add_argument(
+        '-c', '--console-length', type=int, default=32500,
+        help='Restrict the console length in the event to this number of characters')
+    parser.add_argument(
+        '-t', '--target', action='append',
+        help='A target to send events to, defaults to logstash if no other is specified')
+    parser.add_argument(
+        '--debug', action='store_true', help='Print debug logs to console during execution')
+
+    args = parser.parse_args(argv)
+    if args.target is None:
+        args.target = ['logstash']
+    return args
+
+
 def configure_logging(args):
     if args.debug:
         log_level = logging.DEBUG
@@ -74,7 +131,32 @@ def configure_logging(args):
                         format='%(asctime)s %(name)s %(levelname)s %(message)s')
 
 
+def backfill_main(argv):
+    args = parse_backfill_args(argv)
+    configure_logging(args)
+
+    config = {}
+    if args.rate_limit is not None:
+        config['JENKINS_RATE_LIMIT'] = '{}'.format(args.rate_limit)
+    if args.heavy_rate_limit is not None:
+        config['JENKINS_HEAVY_RATE_LIMIT'] = '{}'.format(args.heavy_rate_limit)
+    backfill = es_logger.backfill.Backfill(
+        args.job, first=args.first, last=args.last, targets=args.target,
+        console_length=args.console_length, workers=args.workers, progress=args.progress,
+        config=config)
+
+    if args.list:
+        for job, number in backfill.get_work():
+            print("{} {}".format(job, number))
+        sys.exit(0)
+
+    sys.exit(backfill.run())
+
+
 def main():
+    if sys.argv[1:2] == ['backfill']:
+        backfill_main(sys.argv[2:])
+
     args = parse_args()
     configure_logging(args)
 
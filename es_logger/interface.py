@@ -4,14 +4,32 @@
 __author__ = 'jonpsull'
 
 import abc
+import concurrent.futures
+import os
 import six
+import threading
+
+# The data sources plugins can require EsLogger to fetch from Jenkins for a build
+# The build info is always fetched
+CONSOLE_LOG = 'console_log'
+TEST_REPORT = 'test_report'
+STAGES = 'stages'
+ARTIFACTS = 'artifacts'
+JOB_CONFIG = 'job_config'
+ENV_VARS = 'env_vars'
+DATA_SOURCES = [CONSOLE_LOG, TEST_REPORT, STAGES, ARTIFACTS, JOB_CONFIG, ENV_VARS]
 
 
 @six.add_metaclass(abc.ABCMeta)
 class ConsoleLogProcessor(object):
     """
     Base class for a console log processor
+        * By default process is called with the full console log
+        * Processors that set streaming to True have process_line called for each line of the
+          console log as it is read, then finish_process, so the full console log need not be
+          held in memory
     """
+    streaming = False
 
     def __init__(self):
         super(ConsoleLogProcessor, self).__init__()
@@ -26,6 +44,31 @@ class ConsoleLogProcessor(object):
         :returns: dict(str:?)
         """
 
+    @staticmethod
+    def get_requirements():
+        """
+        The data sources this plugin needs fetched from Jenkins
+
+        :returns: list(str)
+        """
+        return [CONSOLE_LOG]
+
+    def process_line(self, line):
+        """
+        Parse a single line of the console log, for streaming processors
+
+        :param line: A line of the console log, without the line ending
+        :type line: str
+        """
+
+    def finish_process(self):
+        """
+        Return the dict for ES once all lines have been passed to process_line,
+        for streaming processors
+
+        :returns: dict(str:?)
+        """
+
 
 @six.add_metaclass(abc.ABCMeta)
 class GatherBuildData(object):
@@ -46,6 +89,15 @@ class GatherBuildData(object):
         :returns: dict(str:?)
         """
 
+    @staticmethod
+    def get_requirements():
+        """
+        The data sources this plugin needs fetched from Jenkins, all of them unless overridden
+
+        :returns: list(str)
+        """
+        return list(DATA_SOURCES)
+
 
 @six.add_metaclass(abc.ABCMeta)
 class EventGenerator(object):
@@ -70,6 +122,16 @@ class EventGenerator(object):
     def get_fields(self):
         return self.DEFAULT_FIELDS
 
+    @staticmethod
+    def get_requirements():
+        """
+        The data sources this plugin needs fetched from Jenkins, all of them unless overridden
+        The env vars for get_fields are always fetched for event generators
+
+        :returns: list(str)
+        """
+        return list(DATA_SOURCES)
+
     @abc.abstractmethod
     def generate_events(self, esl):
         """
@@ -108,10 +170,20 @@ class ConsoleLogEventRegex(object):
 class EventTarget(object):
     """
     Base class for an event target
+        * Settings are read with get_setting, from the config the target was created with or
+          failing that the environment, so targets with different settings can run in the same
+          process.  Targets whose __init__ takes no config have it set once they are created
+        * Targets that set send_window greater than 0 can send with send_async, to have up to
+          that many sends in flight at once, which finish_send waits for
     """
 
-    def __init__(self):
+    def __init__(self, config=None):
         super(EventTarget, self).__init__()
+        self.config = dict(config) if config else {}
+        self.send_window = 0
+        self.send_executor = None
+        self.send_slots = None
+        self.send_futures = []
 
     @staticmethod
     @abc.abstractmethod
@@ -143,5 +215,56 @@ class EventTarget(object):
         """
         return []
 
-    def finish_send(self):
+    def get_setting(self, name, default=None):
+        """
+        Get a setting from the config, or failing that the environment
+
+        :param name: The name of the setting, as its environment variable, e.g. LS_USER
+        :type name: str
+        :param default: The value if the setting is in neither
+        :type default: str
+        :returns: str
+        """
+        if name in self.config:
+            return self.config[name]
+        return os.environ.get(name, default)
+
+    def send_async(self, send, *args):
+        """
+        Call send with args on a pool of send_window threads, waiting for a send in flight to
+        finish while the window is full.  Calls it directly when send_window is 0
+
+        :param send: The function to send with, returning the number of errors
+        :type send: callable
+        :returns: int, the errors from send when called directly, otherwise 0, with the errors
+                  counted by wait_sent
+        """
+        if self.send_window <= 0:
+            return send(*args)
+        if self.send_executor is None:
+            self.send_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.send_window, thread_name_prefix=type(self).__name__)
+            self.send_slots = threading.BoundedSemaphore(self.send_window)
+        slots = self.send_slots
+        slots.acquire()
+        future = self.send_executor.submit(send, *args)
+        future.add_done_callback(lambda future: slots.release())
+        self.send_futures.append(future)
         return 0
+
+    def wait_sent(self):
+        """
+        Wait for all of the sends from send_async to finish
+
+        :returns: int, the total errors of the sends
+        :raises: The exception of the first send that raised one, once all have finished
+        """
+        futures = self.send_futures
+        self.send_futures = []
+        if self.send_executor is not None:
+            self.send_executor.shutdown(wait=True)
+            self.send_executor = None
+        return sum(future.result() for future in futures)
+
+    def finish_send(self):
+        return self.wait_sent()
@@ -0,0 +1,180 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import base64
+import json
+import os
+import sqlite3
+import time
+
+
+# Messages from ZMQ are lists of bytes frames, store them as JSON holding the base64 of each frame
+def encode_message(msg):
+    return json.dumps([base64.b64encode(frame).decode('ascii') for frame in msg])
+
+
+def decode_message(data):
+    return [base64.b64decode(frame) for frame in json.loads(data)]
+
+
+# Append-only file of the messages that overflowed the queue, read back in order as it drains
+# Messages left in the file when the daemon stops are replayed when it next starts
+class SpillFile(object):
+    def __init__(self, path):
+        self.path = path
+        # The offset of the oldest message not read back is kept beside the file, so that the
+        # messages read back before a restart are not replayed
+        self.offset_path = path + '.offset'
+        self.read_offset = 0
+        self.pending = 0
+        if os.path.exists(self.path):
+            if os.path.exists(self.offset_path):
+                with open(self.offset_path) as offset:
+                    self.read_offset = int(offset.read())
+            with open(self.path, 'rb') as spill:
+                spill.seek(self.read_offset)
+                self.pending = len(spill.readlines())
+        if self.pending == 0:
+            self.remove()
+
+    def __len__(self):
+        return self.pending
+
+    # Store a message, as a line of JSON
+    def append(self, msg):
+        with open(self.path, 'ab') as spill:
+            spill.write(encode_message(msg).encode('ascii') + b'\n')
+        self.pending += 1
+
+    # Remove and return the oldest message
+    def pop(self):
+        with open(self.path, 'rb') as spill:
+            spill.seek(self.read_offset)
+            line = spill.readline()
+            self.read_offset = spill.tell()
+        self.pending -= 1
+        if self.pending == 0:
+            # Everything has been read back, so start afresh
+            self.remove()
+        else:
+            self.save_offset()
+        return decode_message(line)
+
+    # Replace the offset file in one step, so a crash leaves either the old or the new offset
+    def save_offset(self):
+        with open(self.offset_path + '.tmp', 'w') as offset:
+            offset.write(str(self.read_offset))
+        os.replace(self.offset_path + '.tmp', self.offset_path)
+
+    # Remove the file and its offset, the file first so an offset is never applied to a new file
+    def remove(self):
+        for path in [self.path, self.offset_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.read_offset = 0
+
+
+# SQLite journal of the builds accepted for processing, keyed by job and build number
+# A build is added when its message is accepted, and removed once it has been posted,
+# so whatever is left in the journal after a restart or crash is work still to do
+class WorkJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        # With write-ahead logging, synchronous=NORMAL only syncs at checkpoints rather than at
+        # every commit, batching the fsyncs.  Commits survive the daemon crashing, though the
+        # last few could be lost if the host loses power
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS work ('
+                              'job TEXT NOT NULL, number TEXT NOT NULL, message TEXT NOT NULL, '
+                              'added REAL NOT NULL, resumes INTEGER NOT NULL DEFAULT 0, '
+                              'held INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job, number))')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM work').fetchone()[0]
+
+    # Record a build to process, returning False if it is already recorded
+    def add(self, job, number, msg):
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO work (job, number, message, added) VALUES (?, ?, ?, ?)',
+                (job, '{}'.format(number), encode_message(msg), time.time()))
+        return cursor.rowcount == 1
+
+    # Remove a build that has been processed
+    def complete(self, job, number):
+        with self.conn:
+            self.conn.execute('DELETE FROM work WHERE job = ? AND number = ?',
+                              (job, '{}'.format(number)))
+
+    # Mark a build as held, kept only here until there is room for it on the queue, returning
+    # False if it is already held
+    def hold(self, job, number):
+        with self.conn:
+            cursor = self.conn.execute(
+                'UPDATE work SET held = 1 WHERE job = ? AND number = ? AND held = 0',
+                (job, '{}'.format(number)))
+        return cursor.rowcount == 1
+
+    # Release and return up to count of the held messages, oldest first
+    def take_held(self, count):
+        rows = self.conn.execute('SELECT rowid, message FROM work WHERE held = 1 '
+                                 'ORDER BY added, rowid LIMIT ?', (count,)).fetchall()
+        with self.conn:
+            self.conn.executemany('UPDATE work SET held = 0 WHERE rowid = ?',
+                                  [(row[0],) for row in rows])
+        return [decode_message(row[1]) for row in rows]
+
+    # The messages for the builds still to process, oldest first
+    def pending(self):
+        return [decode_message(row[0]) for row in
+                self.conn.execute('SELECT message FROM work ORDER BY added, rowid')]
+
+    # Count another resume of every build still to process, returning how many builds were
+    # abandoned for having already been resumed max_resumes times, and the messages for the rest
+    # A build that keeps failing is not then retried forever
+    def resume(self, max_resumes):
+        with self.conn:
+            abandoned = self.conn.execute('DELETE FROM work WHERE resumes >= ?',
+                                          (max_resumes,)).rowcount
+            self.conn.execute('UPDATE work SET resumes = resumes + 1, held = 0')
+        return abandoned, self.pending()
+
+    def close(self):
+        self.conn.close()
+
+
+# SQLite record of the newest build processed for each job, so that the builds that finished
+# while the daemon was not listening can be found, by looking for any newer than it
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS checkpoint ('
+                              'job TEXT PRIMARY KEY, number INTEGER NOT NULL, '
+                              'updated REAL NOT NULL)')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM checkpoint').fetchone()[0]
+
+    # Record a processed build, keeping the newest for the job as builds can finish out of order
+    def update(self, job, number):
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO checkpoint (job, number, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (job) DO UPDATE SET number = MAX(number, excluded.number), '
+                'updated = excluded.updated', (job, number, time.time()))
+
+    # The newest build number processed for each job
+    def builds(self):
+        return dict(self.conn.execute('SELECT job, number FROM checkpoint'))
+
+    def close(self):
+        self.conn.close()
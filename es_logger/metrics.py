@@ -0,0 +1,207 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import contextlib
+import http.server
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets, suited to the time taken by builds
+DEFAULT_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+# Base class of a metric, holding a value per set of label values
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError("{} takes labels {}, not {}".format(
+                self.name, list(self.labelnames), list(labels.keys())))
+        return tuple('{}'.format(labels[name]) for name in self.labelnames)
+
+    # List of (name suffix, labels, value) for each of the current values
+    def samples(self):
+        with self.lock:
+            return [('', dict(zip(self.labelnames, key)), value)
+                    for key, value in sorted(self.values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    # Read the value from func each time it is collected, for an unlabelled gauge
+    # None to go back to the set value
+    def set_function(self, func):
+        self.function = func
+
+    def samples(self):
+        if self.function is not None:
+            return [('', {}, self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = [count + 1 if value <= bound else count
+                      for count, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value)
+
+    # Observe the time taken by the body of a with statement
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        samples = []
+        for _, labels, (counts, total) in super().samples():
+            for bound, count in zip(self.buckets, counts):
+                bucket_labels = dict(labels)
+                bucket_labels['le'] = '+Inf' if bound == float('inf') else '{}'.format(bound)
+                samples.append(('_bucket', bucket_labels, count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, counts[-1]))
+        return samples
+
+
+# The metrics of a process, rendered in the Prometheus text exposition format
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    @staticmethod
+    def format_labels(labels):
+        if len(labels) == 0:
+            return ''
+        escaped = ['{}="{}"'.format(
+            name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels.items()]
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(metric.name, suffix,
+                                                self.format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Recorded by EsLogger, for each build it processes
+JENKINS_REQUEST_SECONDS = REGISTRY.histogram(
+    'es_logger_jenkins_request_seconds', 'Time taken by requests to Jenkins', ['request'])
+STAGE_SECONDS = REGISTRY.histogram(
+    'es_logger_stage_seconds',
+    'Time taken by each stage of processing a build: gather from Jenkins, generate events '
+    'with the plugins, and post to the targets', ['stage'])
+TARGET_ERRORS = REGISTRY.counter(
+    'es_logger_target_errors_total', 'Failures to send to or finish with a target', ['target'])
+
+# Recorded by the ZMQ daemon
+MESSAGES_RECEIVED = REGISTRY.counter(
+    'es_logger_messages_received_total', 'Messages received from Jenkins')
+MESSAGES_DISCARDED = REGISTRY.counter(
+    'es_logger_messages_discarded_total', 'Messages discarded as not needing processing',
+    ['phase'])
+MESSAGES_DUPLICATE = REGISTRY.counter(
+    'es_logger_messages_duplicate_total', 'Messages skipped as repeats of a build already queued')
+QUEUE_DEPTH = REGISTRY.gauge('es_logger_queue_depth', 'Messages waiting on the queue')
+BUILDS_PROCESSED = REGISTRY.counter(
+    'es_logger_builds_processed_total', 'Builds processed, by result', ['result'])
+BUILD_SECONDS = REGISTRY.histogram(
+    'es_logger_build_seconds', 'Time taken by a worker to process a message')
+WORKERS_BUSY = REGISTRY.gauge('es_logger_workers_busy', 'Workers processing a message')
+WORKER_UTILIZATION = REGISTRY.gauge(
+    'es_logger_worker_utilization', 'Fraction of the workers processing a message')
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', '{}'.format(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format % args)
+
+
+def start_server(address, port):
+    """
+    Serve the metrics over HTTP from a background thread
+
+    :param address: The address to listen on, e.g. 127.0.0.1 to only allow local scrapes
+    :type address: str
+    :param port: The port to listen on, 0 for any free port
+    :type port: int
+    :returns: http.server.ThreadingHTTPServer, to shutdown() when finished
+    """
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    LOGGER.info("Serving metrics on {}:{}".format(*server.server_address[:2]))
+    return server
@@ -7,7 +7,7 @@ import itertools
 import json
 import logging
 import urllib
-from ..interface import ConsoleLogEventRegex, EventGenerator
+from ..interface import CONSOLE_LOG, ConsoleLogEventRegex, EventGenerator
 import re
 
 LOGGER = logging.getLogger(__name__)
@@ -22,6 +22,10 @@ class AnsibleRecapEvent(EventGenerator):
     def get_fields(self):
         return super().get_fields()
 
+    @staticmethod
+    def get_requirements():
+        return [CONSOLE_LOG]
+
     def generate_events(self, esl):
         """
         Parse the console log and return a list for ES
@@ -115,6 +119,10 @@ class AnsibleFatalGenerator(EventGenerator):
     def get_fields(self):
         return super(AnsibleFatalGenerator, self).get_fields()
 
+    @staticmethod
+    def get_requirements():
+        return [CONSOLE_LOG]
+
     def generate_events(self, esl):
         """
         Parse the console log and return a list for ES
@@ -3,11 +3,10 @@
 
 __author__ = 'jonpsull'
 
-from es_logger.interface import EventGenerator
+from es_logger.interface import ARTIFACTS, EventGenerator
 import jenkins
 import json
 import logging
-import os
 
 LOGGER = logging.getLogger(__name__)
 
@@ -15,9 +14,15 @@ LOGGER = logging.getLogger(__name__)
 class ArtifactEvent(EventGenerator):
     '''
     '''
+    # The artifact holding the events, unless ES_EVENT_ARTIFACT is set
+    DEFAULT_ARTIFACT = 'es-logger-data.json'
+
     def __init__(self):
         super().__init__()
-        self.config_artifact = os.environ.get('ES_EVENT_ARTIFACT', 'es-logger-data.json')
+
+    @staticmethod
+    def get_requirements():
+        return [ARTIFACTS]
 
     def generate_events(self, esl):
         """
@@ -27,30 +32,32 @@ class ArtifactEvent(EventGenerator):
         :type esl: object
         :returns: list(obj)
         """
+        # Read per build, as the plugin is shared by builds that may have different settings
+        config_artifact = esl.get_setting('ES_EVENT_ARTIFACT', self.DEFAULT_ARTIFACT)
         data = None
         artifact_saved = False
         for artifact in esl.build_info['artifacts']:
-            if self.config_artifact == artifact['relativePath']:
+            if config_artifact == artifact['relativePath']:
                 artifact_saved = True
                 break
         if artifact_saved:
             try:
                 raw_data = esl.server.get_build_artifact(
-                    esl.es_job_name, esl.es_build_number, self.config_artifact)
+                    esl.es_job_name, esl.es_build_number, config_artifact)
                 try:
                     data = json.loads(raw_data)
                 except json.decoder.JSONDecodeError as err:
                     LOGGER.warn("JSONDecodeError when attempting to get {} artifact: {}".format(
-                        self.config_artifact, err))
+                        config_artifact, err))
                     LOGGER.warn("Data: {}".format(raw_data))
             except jenkins.JenkinsException as jenkins_err:
                 LOGGER.warn("JenkinsException when attempting to get {} artifact: {}".format(
-                    self.config_artifact, jenkins_err))
+                    config_artifact, jenkins_err))
 
         ret_data = []
 
         if data is None:
-            LOGGER.info("No saved event data found in artifact {}".format(self.config_artifact))
+            LOGGER.info("No saved event data found in artifact {}".format(config_artifact))
         else:
             ret_data = data
 
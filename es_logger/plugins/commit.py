@@ -15,6 +15,10 @@ class CommitEvent(EventGenerator):
     def get_fields(self):
         return super().get_fields()
 
+    @staticmethod
+    def get_requirements():
+        return []
+
     def generate_events(self, esl):
         # Prep the event info if there are change sets
         add_events = []
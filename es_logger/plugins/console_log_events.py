@@ -1,12 +1,13 @@
 __author__ = 'jonpsull'
 
 from es_logger.interface import ConsoleLogEventRegex
-from es_logger.interface import EventGenerator
+from es_logger.interface import CONSOLE_LOG, EventGenerator
 import json
 import logging
 import os
 import re
-from stevedore import driver, ExtensionManager
+
+from .. import registry
 
 LOGGER = logging.getLogger(__name__)
 
@@ -18,6 +19,10 @@ class ConsoleLogEvent(EventGenerator):
     def get_fields(self):
         return super(ConsoleLogEvent, self).get_fields() + ['NODE_NAME', 'NODE_LABELS']
 
+    @staticmethod
+    def get_requirements():
+        return [CONSOLE_LOG]
+
     def generate_events(self, esl):
         """
         Parse the console log and return a list to send as events
@@ -33,14 +38,9 @@ class ConsoleLogEvent(EventGenerator):
         """
         Load all console log plugins
         """
-        mgr = ExtensionManager(namespace='es_logger.plugins.event_generator.console_log_events',
-                               invoke_on_load=False)
-        for plugin in mgr.names():  # All known console_log_events plugins
-            drv = driver.DriverManager(
-                namespace='es_logger.plugins.event_generator.console_log_events',
-                invoke_on_load=False,
-                name=plugin)
-            regex_list = drv.driver.get_regex(regex_list)
+        namespace = 'es_logger.plugins.event_generator.console_log_events'
+        for plugin in registry.get_plugin_names(namespace):  # All known console_log_events plugins
+            regex_list = registry.get_plugin_class(namespace, plugin).get_regex(regex_list)
             LOGGER.debug('Loaded plugins from {}, regex_list now with {} elements'.format(
                          plugin, len(regex_list)))
 
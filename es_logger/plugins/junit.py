@@ -1,6 +1,6 @@
 __author__ = 'jonpsull'
 
-from ..interface import EventGenerator
+from ..interface import EventGenerator, TEST_REPORT
 import logging
 
 LOGGER = logging.getLogger(__name__)
@@ -14,6 +14,10 @@ class JUnitEvent(EventGenerator):
         return super(JUnitEvent, self).get_fields() + ['GERRIT_PATCHSET_REVISION',
                                                        'GERRIT_REFSPEC']
 
+    @staticmethod
+    def get_requirements():
+        return [TEST_REPORT]
+
     def generate_events(self, esl):
         """
         return a list of objects to send as events
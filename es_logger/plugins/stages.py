@@ -3,7 +3,7 @@
 
 __author__ = 'mvillene'
 
-from ..interface import EventGenerator
+from ..interface import EventGenerator, STAGES
 import logging
 
 LOGGER = logging.getLogger(__name__)
@@ -18,6 +18,10 @@ class StageEvent(EventGenerator):
     def get_fields(self):
         return super().get_fields()
 
+    @staticmethod
+    def get_requirements():
+        return [STAGES]
+
     def generate_events(self, esl):
         """
         return a list of objects to send as events
@@ -5,17 +5,89 @@ __author__ = 'jonpsull'
 
 from ..interface import EventTarget
 import boto3
+import gzip
 import hashlib
 import json
 import logging
-import os
 import requests
+import requests.adapters
+import threading
 import time
 import urllib3.exceptions
 
 LOGGER = logging.getLogger(__name__)
 
 
+# Keep a keep-alive connection for each send a target can have in flight, as the requests
+# default pool only keeps 10 for a host
+def mount_pool(session, send_window):
+    if send_window > requests.adapters.DEFAULT_POOLSIZE:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=send_window)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+
+# Sessions shared by the targets of every build in the process, keyed by the target type and
+# the settings the session is made with, so builds reuse the keep-alive connections of the
+# builds before them rather than connecting afresh
+_SESSION_LOCK = threading.Lock()
+_SESSIONS = {}
+
+
+def get_shared_session(key, create):
+    with _SESSION_LOCK:
+        if key not in _SESSIONS:
+            _SESSIONS[key] = create()
+        return _SESSIONS[key]
+
+
+# Stop sharing a session after an error on it, unless it has already been replaced
+def drop_shared_session(key, session):
+    with _SESSION_LOCK:
+        if _SESSIONS.get(key) is session:
+            del _SESSIONS[key]
+
+
+def clear_sessions():
+    with _SESSION_LOCK:
+        _SESSIONS.clear()
+
+
+# Gzip the request bodies of an HTTP target once they are big enough to be worth it,
+# counting the bytes of the bodies and the bytes sent for the debug output of a build
+class GzipBody(object):
+    def __init__(self, level=0, min_bytes=1024):
+        # A level of 0 leaves the bodies uncompressed
+        self.level = int(level)
+        self.min_bytes = int(min_bytes)
+        self.body_bytes = 0
+        self.wire_bytes = 0
+        # Bodies may be sent from several threads, see EventTarget.send_async
+        self.lock = threading.Lock()
+
+    # Return the body to send and the headers it needs
+    def encode(self, body):
+        headers = {}
+        with self.lock:
+            self.body_bytes += len(body)
+        if self.level > 0 and len(body) >= self.min_bytes:
+            body = gzip.compress(body, compresslevel=self.level)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    # Count a body sent, once for each attempt
+    def sent(self, body):
+        with self.lock:
+            self.wire_bytes += len(body)
+
+    def report(self, target):
+        LOGGER.debug("{} posted {} bytes as {} bytes on the wire".format(
+            target, self.body_bytes, self.wire_bytes))
+        self.body_bytes = 0
+        self.wire_bytes = 0
+
+
 class LogstashPostError(Exception):
     pass
 
@@ -23,8 +95,8 @@ class LogstashPostError(Exception):
 class LogstashTarget(EventTarget):
     """
     """
-    def __init__(self):
-        super().__init__()
+    def __init__(self, config=None):
+        super().__init__(config)
 
         self.logstash_server = None
         self.ls_user = None
@@ -38,6 +110,19 @@ class LogstashTarget(EventTarget):
         self.ls_user = self.get_ls_user()
         self.ls_password = self.get_ls_password()
 
+        # Batching is off unless LS_BATCH_SIZE is set, then events are buffered and posted
+        # together as newline delimited json, when any limit is reached and at finish_send
+        self.batch_size = int(self.get_setting('LS_BATCH_SIZE', '0'))
+        self.batch_bytes = int(self.get_setting('LS_BATCH_BYTES', '{}'.format(5 * 1024 * 1024)))
+        self.batch_seconds = float(self.get_setting('LS_BATCH_SECONDS', '0'))
+        self.batch = []
+        self.batch_length = 0
+        self.batch_started = None
+
+        self.gzip = GzipBody(self.get_setting('LS_GZIP_LEVEL', '0'),
+                             self.get_setting('LS_GZIP_MIN_BYTES', '1024'))
+        self.send_window = int(self.get_setting('LS_SEND_WINDOW', '0'))
+
     @staticmethod
     def get_help_string():
         return '''
@@ -45,6 +130,13 @@ Logstash Target Environment Variables:
     LOGSTASH_SERVER         The server to send events to
     LS_USER                 The user for logstash access
     LS_PASSWORD             The password for logstash access
+    LS_BATCH_SIZE           Post up to this many events a request as newline delimited json
+    LS_BATCH_BYTES          Post a batch before it goes over this many bytes, default 5MB
+    LS_BATCH_SECONDS        Post a batch once its first event has waited this many seconds
+    LS_GZIP_LEVEL           Gzip request bodies at this level, 1 to 9, default 0 for none
+    LS_GZIP_MIN_BYTES       Only gzip request bodies of at least this many bytes, default 1024
+    LS_SEND_WINDOW          Have up to this many posts in flight at once, default 0 to post
+                            one at a time
 '''
 
     @staticmethod
@@ -56,6 +148,59 @@ Logstash Target Environment Variables:
 
     # Post to ES
     def send_event(self, json_event):
+        if self.batch_size > 0:
+            return self.add_to_batch(json_event)
+        return self.send_async(self.post_event, json.dumps(json_event).encode('utf-8'))
+
+    def post_event(self, body):
+        r = self.post(body, 'application/json')
+        LOGGER.debug("Posted event, result {}".format(r.ok))
+        if r.ok:
+            return 0
+        return 1
+
+    def add_to_batch(self, json_event):
+        error_count = 0
+        line = (json.dumps(json_event) + '\n').encode('utf-8')
+        # Send what is buffered first if this event would take the batch over the byte limit
+        if self.batch and self.batch_length + len(line) > self.batch_bytes:
+            error_count += self.send_batch()
+        if not self.batch:
+            self.batch_started = time.monotonic()
+        self.batch.append(line)
+        self.batch_length += len(line)
+        if len(self.batch) >= self.batch_size or self.batch_length >= self.batch_bytes or \
+                (self.batch_seconds > 0 and
+                 time.monotonic() - self.batch_started >= self.batch_seconds):
+            error_count += self.send_batch()
+        return error_count
+
+    # Post the buffered events in one request, returning the number not accepted
+    def send_batch(self):
+        if not self.batch:
+            return 0
+        count = len(self.batch)
+        body = b''.join(self.batch)
+        self.batch = []
+        self.batch_length = 0
+        return self.send_async(self.post_batch, body, count)
+
+    def post_batch(self, body, count):
+        r = self.post(body, 'application/x-ndjson')
+        LOGGER.debug("Posted {} events in {} bytes, result {}".format(count, len(body), r.ok))
+        if r.ok:
+            return 0
+        return count
+
+    def finish_send(self):
+        error_count = self.send_batch()
+        error_count += self.wait_sent()
+        self.gzip.report('Logstash')
+        return error_count
+
+    def post(self, body, content_type):
+        body, headers = self.gzip.encode(body)
+        headers['Content-Type'] = content_type
         # We see a lot of logstash timeout errors
         post_attempts = []
         r = None
@@ -63,11 +208,13 @@ Logstash Target Environment Variables:
         while r is None:
             try:
                 session = self.get_session()
-                r = session.post(self.logstash_server, json=json_event)
+                self.gzip.sent(body)
+                r = session.post(self.logstash_server, data=body, headers=headers)
             except (requests.exceptions.ReadTimeout, urllib3.exceptions.ProtocolError) as exc:
                 post_attempts.append(exc)
                 LOGGER.warn("Setting session to None on post_attempt {}".format(
                             len(post_attempts)))
+                drop_shared_session(self.get_session_key(), self.ls_session)
                 self.ls_session = None
                 if len(post_attempts) >= 5:
                     raise LogstashPostError(
@@ -76,33 +223,209 @@ Logstash Target Environment Variables:
             except Exception as exc:
                 raise LogstashPostError(
                     "Logstash post error on attempt {}".format(post_attempts)) from exc
-        LOGGER.debug("Posted event, result {}".format(r.ok))
-        if r.ok:
-            return 0
-        return 1
+        return r
 
     def get_logstash_server(self):
         if not self.logstash_server:
-            return os.environ.get('LOGSTASH_SERVER')
+            return self.get_setting('LOGSTASH_SERVER')
         return self.logstash_server
 
     def get_ls_user(self):
         if not self.ls_user:
-            return os.environ.get('LS_USER')
+            return self.get_setting('LS_USER')
         return self.ls_user
 
     def get_ls_password(self):
         if not self.ls_password:
-            return os.environ.get('LS_PASSWORD')
+            return self.get_setting('LS_PASSWORD')
         return self.ls_password
 
+    def get_session_key(self):
+        return ('logstash', self.logstash_server, self.ls_user, self.ls_password,
+                self.send_window)
+
     def get_session(self):
         if self.ls_session is None:
-            LOGGER.debug("Creating session against {}".format(self.logstash_server))
-            self.ls_session = requests.Session()
-            self.ls_session.auth = (self.ls_user, self.ls_password)
+            self.ls_session = get_shared_session(self.get_session_key(), self.create_session)
         return self.ls_session
 
+    def create_session(self):
+        LOGGER.debug("Creating session against {}".format(self.logstash_server))
+        session = mount_pool(requests.Session(), self.send_window)
+        session.auth = (self.ls_user, self.ls_password)
+        return session
+
+
+class ElasticsearchTarget(EventTarget):
+    """
+    """
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.es_session = None
+        self.timeout_sleep = 2
+
+        self.es_server = self.get_setting('ELASTICSEARCH_SERVER')
+        self.es_user = self.get_setting('ELASTICSEARCH_USER')
+        self.es_password = self.get_setting('ELASTICSEARCH_PASSWORD')
+        # The main build events go to this index, and the events of each event generator
+        # plugin to an index of their own, named after the plugin, e.g. es-logger-junit
+        self.index = self.get_setting('ELASTICSEARCH_INDEX', 'es-logger')
+        self.batch_size = int(self.get_setting('ELASTICSEARCH_BATCH_SIZE', '500'))
+        self.batch_bytes = int(self.get_setting('ELASTICSEARCH_BATCH_BYTES',
+                                                '{}'.format(5 * 1024 * 1024)))
+        self.retries = int(self.get_setting('ELASTICSEARCH_RETRIES', '3'))
+        self.batch = []
+        self.batch_length = 0
+        self.gzip = GzipBody(self.get_setting('ELASTICSEARCH_GZIP_LEVEL', '0'),
+                             self.get_setting('ELASTICSEARCH_GZIP_MIN_BYTES', '1024'))
+        self.send_window = int(self.get_setting('ELASTICSEARCH_SEND_WINDOW', '0'))
+        self.event_counts = {}
+
+    @staticmethod
+    def get_help_string():
+        return '''
+Elasticsearch Target Environment Variables:
+    ELASTICSEARCH_SERVER    The Elasticsearch url to send events to with the _bulk API
+    ELASTICSEARCH_USER      The user for Elasticsearch access, if needed
+    ELASTICSEARCH_PASSWORD  The password for Elasticsearch access
+    ELASTICSEARCH_INDEX     The index for build events, and prefix of the index for the events
+                            of each event generator plugin, default es-logger
+    ELASTICSEARCH_BATCH_SIZE
+                            Send up to this many events a request, default 500
+    ELASTICSEARCH_BATCH_BYTES
+                            Send a request before it goes over this many bytes, default 5MB
+    ELASTICSEARCH_RETRIES   Retry the events Elasticsearch rejected as busy this many times,
+                            default 3
+    ELASTICSEARCH_GZIP_LEVEL
+                            Gzip request bodies at this level, 1 to 9, default 0 for none
+    ELASTICSEARCH_GZIP_MIN_BYTES
+                            Only gzip request bodies of at least this many bytes, default 1024
+    ELASTICSEARCH_SEND_WINDOW
+                            Have up to this many requests in flight at once, default 0 to send
+                            one at a time
+'''
+
+    @staticmethod
+    def get_required_vars():
+        return ['ELASTICSEARCH_SERVER']
+
+    def validate(self):
+        return True
+
+    # Events from event generator plugins name the plugin, see EsLogger.get_plugin_events
+    def get_index(self, json_event):
+        plugin = json_event.get('eslogger', {}).get('event')
+        if plugin:
+            return '{}-{}'.format(self.index, plugin).lower()
+        return self.index
+
+    # The id of an event is its build, plugin and place among the events of the plugin for the
+    # build, so the events of a build sent again overwrite those indexed before, while events
+    # that repeat within a build are each kept.  Events without a build are given ids by
+    # Elasticsearch
+    def get_event_id(self, json_event):
+        info = json_event.get('eslogger', {})
+        if 'job_name' not in info or 'es_build_number' not in info:
+            return None
+        key = (info.get('jenkins_url'), info['job_name'], info['es_build_number'],
+               info.get('event'))
+        sequence = self.event_counts.get(key, 0)
+        self.event_counts[key] = sequence + 1
+        return hashlib.sha256(json.dumps(list(key) + [sequence]).encode('utf-8')).hexdigest()
+
+    def send_event(self, json_event):
+        error_count = 0
+        source = json.dumps(json_event).encode('utf-8')
+        index = {'_index': self.get_index(json_event)}
+        event_id = self.get_event_id(json_event)
+        if event_id:
+            index['_id'] = event_id
+        action = json.dumps({'index': index})
+        item = action.encode('utf-8') + b'\n' + source + b'\n'
+        # Send what is buffered first if this event would take the request over the byte limit
+        if self.batch and self.batch_length + len(item) > self.batch_bytes:
+            error_count += self.send_batch()
+        self.batch.append(item)
+        self.batch_length += len(item)
+        if len(self.batch) >= self.batch_size or self.batch_length >= self.batch_bytes:
+            error_count += self.send_batch()
+        return error_count
+
+    def finish_send(self):
+        error_count = self.send_batch()
+        error_count += self.wait_sent()
+        self.gzip.report('Elasticsearch')
+        return error_count
+
+    def send_batch(self):
+        items = self.batch
+        self.batch = []
+        self.batch_length = 0
+        if not items:
+            return 0
+        return self.send_async(self.send_items, items)
+
+    # Send events, retrying only those rejected for want of capacity,
+    # and return the number that were not indexed
+    def send_items(self, items):
+        error_count = 0
+        attempt = 0
+        while items:
+            if attempt > self.retries:
+                LOGGER.warning("Giving up on {} events after {} attempts".format(
+                    len(items), attempt))
+                error_count += len(items)
+                break
+            if attempt > 0:
+                time.sleep(self.timeout_sleep)
+            retry = []
+            for item, (status, error) in zip(items, self.bulk(items)):
+                if status is None or status == 429 or status >= 500:
+                    retry.append(item)
+                elif status >= 300:
+                    LOGGER.warning("Error indexing event status {} error {}".format(status, error))
+                    error_count += 1
+            if retry:
+                LOGGER.debug("Retrying {} of {} events".format(len(retry), len(items)))
+            items = retry
+            attempt += 1
+        return error_count
+
+    # Post items to the _bulk API, returning the (status, error) of each
+    def bulk(self, items):
+        body, headers = self.gzip.encode(b''.join(items))
+        headers['Content-Type'] = 'application/x-ndjson'
+        try:
+            self.gzip.sent(body)
+            r = self.get_session().post('{}/_bulk'.format(self.es_server.rstrip('/')),
+                                        data=body, headers=headers)
+        except requests.exceptions.RequestException as exc:
+            LOGGER.warning("Bulk request error {}".format(exc))
+            drop_shared_session(self.get_session_key(), self.es_session)
+            self.es_session = None
+            return [(None, exc)] * len(items)
+        LOGGER.debug("Posted {} events, result {}".format(len(items), r.status_code))
+        if not r.ok:
+            return [(r.status_code, r.text)] * len(items)
+        # Each result is keyed by the action, e.g. {'index': {'status': 201, ...}}
+        results = [next(iter(result.values())) for result in r.json()['items']]
+        return [(result['status'], result.get('error')) for result in results]
+
+    def get_session_key(self):
+        return ('elasticsearch', self.es_server, self.es_user, self.es_password, self.send_window)
+
+    def get_session(self):
+        if self.es_session is None:
+            self.es_session = get_shared_session(self.get_session_key(), self.create_session)
+        return self.es_session
+
+    def create_session(self):
+        LOGGER.debug("Creating session against {}".format(self.es_server))
+        session = mount_pool(requests.Session(), self.send_window)
+        if self.es_user:
+            session.auth = (self.es_user, self.es_password)
+        return session
+
 
 class SqsPostError(Exception):
     pass
@@ -111,16 +434,29 @@ class SqsPostError(Exception):
 class SqsTarget(EventTarget):
     """
     """
-    def __init__(self):
-        super().__init__()
+    def __init__(self, config=None):
+        super().__init__(config)
         self.client = None
         self.data = []
+        self.data_size = 0
         self.error_count = 0
         # boto3 SQS limits are 256KB per message, and per batch, and max 10 messages per batch
         self.message_count_limit = 10
         self.message_limit = 256 * 1024  # 256KB
         self.sqs_queue = None
         self.timeout_sleep = 2
+        self.message_attributes = {
+            'source': {
+                'StringValue': 'es-logger',
+                'DataType': 'String'
+            }
+        }
+        # SQS counts the name, type and value of each attribute towards the size of a message
+        self.attributes_size = sum(len(name) + len(attribute['DataType']) +
+                                   len(attribute['StringValue'])
+                                   for name, attribute in self.message_attributes.items())
+        # Full batches are sent on a small pool, so the build need not wait on each in turn
+        self.send_window = int(self.get_setting('SQS_SEND_WINDOW', '0'))
 
     @staticmethod
     def get_help_string():
@@ -131,6 +467,8 @@ AWS SQS Target Environment Variables:
         See: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
 
     SQS_QUEUE       Name of the queue to send the data into
+    SQS_SEND_WINDOW Send up to this many batches at once, default 0 to send one at a time,
+                    in order as the FIFO queue expects
 '''
 
     @staticmethod
@@ -144,41 +482,49 @@ AWS SQS Target Environment Variables:
     def send_event(self, json_event):
         error_count = 0
         message_data = json.dumps(json_event)
+        message_bytes = message_data.encode('utf-8')
         data_item = {
             'MessageBody': message_data,
-            'MessageAttributes': {
-                'source': {
-                    'StringValue': 'es-logger',
-                    'DataType': 'String'
-                }
-            },
-            'MessageDeduplicationId': hashlib.sha256(message_data.encode('utf-8')).hexdigest(),
+            'MessageAttributes': self.message_attributes,
+            'MessageDeduplicationId': hashlib.sha256(message_bytes).hexdigest(),
             'MessageGroupId': 'es-logger'
         }
-        size = len(json.dumps(data_item))
+        size = len(message_bytes) + self.attributes_size
         # 256Kb limit on message_data
         if size >= self.message_limit:
             LOGGER.warn("Message too big: {}".format(size))
             error_count = 1
         else:
             # 256Kb total limit on all messages
-            total_size = len(json.dumps(self.data)) + size
+            total_size = self.data_size + size
             if total_size >= self.message_limit or len(self.data) == self.message_count_limit:
                 LOGGER.debug("Sending max message size {} count {}".format(
                              total_size, len(self.data)))
-                error_count = self.do_send()
+                error_count = self.send_batch()
             # The Ids of a batch request need to be unique within a request.
             data_item['Id'] = "{}".format(len(self.data))
             self.data.append(data_item)
+            self.data_size += size
         return error_count
 
+    def send_batch(self):
+        entries = self.data
+        self.data = []
+        self.data_size = 0
+        if not entries:
+            return 0
+        # Create the client before any of the sends need it
+        self.get_sqs()
+        return self.send_async(self.do_send, entries)
+
     def finish_send(self):
-        return self.do_send()
+        error_count = self.send_batch()
+        return error_count + self.wait_sent()
 
-    def do_send(self):
+    def do_send(self, entries):
         sqs_client = self.get_sqs()
-        LOGGER.debug("Sending {} events to {}".format(len(self.data), self.get_sqs_queue()))
-        response = sqs_client.send_message_batch(QueueUrl=self.get_sqs_queue(), Entries=self.data)
+        LOGGER.debug("Sending {} events to {}".format(len(entries), self.get_sqs_queue()))
+        response = sqs_client.send_message_batch(QueueUrl=self.get_sqs_queue(), Entries=entries)
         LOGGER.debug("Response: {}".format(response))
 
         error_count = 0
@@ -193,12 +539,11 @@ AWS SQS Target Environment Variables:
             error_count = len(response['Failed'])
         if error_count > 0:
             LOGGER.warn("Total {} errors in do_send()".format(error_count))
-        self.data = []
         return error_count
 
     def get_sqs_queue(self):
         if self.sqs_queue is None:
-            self.sqs_queue = os.environ.get('SQS_QUEUE')
+            self.sqs_queue = self.get_setting('SQS_QUEUE')
         return self.sqs_queue
 
     def get_sqs(self):
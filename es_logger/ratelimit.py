@@ -0,0 +1,96 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import logging
+import requests
+import threading
+import time
+import urllib.parse
+
+LOGGER = logging.getLogger(__name__)
+
+# Requests that download a lot from Jenkins, given their own, usually smaller, budget
+HEAVY_PATHS = ('/consoleText', '/logText/', '/testReport/', '/artifact/')
+
+# Buckets shared by every EsLogger in the process, so that the limits hold across workers.
+# Keyed by (name, rate)
+_LOCK = threading.Lock()
+_BUCKETS = {}
+
+
+# Allow rate requests a second on average, in bursts of up to burst requests
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst is not None else max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take a token, sleeping until there is one
+    # Callers queue by borrowing from the tokens to come, so they are served in turn
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            LOGGER.debug("Rate limited, waiting {:.3f}s".format(wait))
+            time.sleep(wait)
+        return wait
+
+
+# Transport adapter taking a token from each bucket that applies before sending a request
+class RateLimitAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, bucket=None, heavy_bucket=None, **kwargs):
+        self.bucket = bucket
+        self.heavy_bucket = heavy_bucket
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        path = urllib.parse.urlsplit(request.url).path
+        if self.heavy_bucket is not None and any(heavy in path for heavy in HEAVY_PATHS):
+            self.heavy_bucket.acquire()
+        if self.bucket is not None:
+            self.bucket.acquire()
+        return super().send(request, **kwargs)
+
+
+def get_bucket(name, rate):
+    """
+    Get the bucket shared across the process for a budget, or None for no limit
+
+    :param name: The name of the budget, e.g. the URL of a Jenkins
+    :type name: str
+    :param rate: Requests per second, None or 0 for no limit
+    :type rate: float
+    :returns: TokenBucket
+    """
+    if not rate:
+        return None
+    with _LOCK:
+        if (name, rate) not in _BUCKETS:
+            _BUCKETS[(name, rate)] = TokenBucket(rate)
+        return _BUCKETS[(name, rate)]
+
+
+def limit_session(session, name, rate, heavy_rate):
+    """
+    Limit the requests made through a session with the budgets shared across the process
+
+    :param session: The session to limit, e.g. the _session of a jenkins.Jenkins
+    :type session: requests.Session
+    :param name: The name of the budgets, e.g. the URL of a Jenkins
+    :type name: str
+    :param rate: Requests per second for all requests, None or 0 for no limit
+    :type rate: float
+    :param heavy_rate: Requests per second for requests to HEAVY_PATHS, None or 0 for no limit
+    :type heavy_rate: float
+    """
+    adapter = RateLimitAdapter(get_bucket(name, rate), get_bucket(name + '_heavy', heavy_rate))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
@@ -0,0 +1,98 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import importlib
+import logging
+from stevedore import driver, ExtensionManager
+import sys
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# Process-wide caches of plugins loaded through stevedore, so that entry points are scanned and
+# plugins loaded once per process rather than once per build.  Keyed by (namespace, name)
+_LOCK = threading.RLock()
+_PLUGIN_CLASSES = {}
+_PLUGINS = {}
+_PLUGIN_NAMES = {}
+
+
+def get_plugin_class(namespace, name):
+    """
+    Get a plugin without instantiating it, for plugins with state per build or static methods
+
+    :param namespace: The full stevedore namespace, e.g. es_logger.plugins.event_generator
+    :type namespace: str
+    :param name: The name of the plugin in the namespace
+    :type name: str
+    :returns: class
+    """
+    with _LOCK:
+        if (namespace, name) not in _PLUGIN_CLASSES:
+            _PLUGIN_CLASSES[(namespace, name)] = driver.DriverManager(
+                namespace=namespace, name=name, invoke_on_load=False).driver
+        return _PLUGIN_CLASSES[(namespace, name)]
+
+
+def get_plugin(namespace, name):
+    """
+    Get the instance of a plugin shared by every build in the process
+    Only for plugins that keep no state between calls
+
+    :param namespace: The full stevedore namespace, e.g. es_logger.plugins.event_generator
+    :type namespace: str
+    :param name: The name of the plugin in the namespace
+    :type name: str
+    :returns: object
+    """
+    with _LOCK:
+        if (namespace, name) not in _PLUGINS:
+            _PLUGINS[(namespace, name)] = driver.DriverManager(
+                namespace=namespace, name=name, invoke_on_load=True, invoke_args=()).driver
+        return _PLUGINS[(namespace, name)]
+
+
+def get_plugin_names(namespace):
+    """
+    Get the names of all of the plugins available in a namespace
+
+    :param namespace: The full stevedore namespace, e.g. es_logger.plugins.event_generator
+    :type namespace: str
+    :returns: list(str)
+    """
+    with _LOCK:
+        if namespace not in _PLUGIN_NAMES:
+            _PLUGIN_NAMES[namespace] = ExtensionManager(namespace=namespace,
+                                                        invoke_on_load=False).names()
+        return list(_PLUGIN_NAMES[namespace])
+
+
+def invalidate(reload_modules=False):
+    """
+    Drop all cached plugins and entry points, so they are loaded again when next used
+    e.g. after plugins are installed or upgraded under a running daemon
+
+    :param reload_modules: Also reload the modules of the plugins that were loaded, so the code
+                           of upgraded plugins is used.  Modules they import are not reloaded
+    :type reload_modules: bool
+    """
+    with _LOCK:
+        modules = set(plugin_class.__module__ for plugin_class in _PLUGIN_CLASSES.values())
+        modules.update(type(plugin).__module__ for plugin in _PLUGINS.values())
+        _PLUGIN_CLASSES.clear()
+        _PLUGINS.clear()
+        _PLUGIN_NAMES.clear()
+        ExtensionManager.ENTRY_POINT_CACHE.clear()
+        if reload_modules:
+            importlib.invalidate_caches()
+            for name in sorted(modules):
+                if name not in sys.modules:
+                    continue
+                try:
+                    importlib.reload(sys.modules[name])
+                    LOGGER.info("Reloaded plugin module {}".format(name))
+                except Exception as exc:
+                    LOGGER.error("Failed to reload plugin module {}: {}".format(name, exc))
+    LOGGER.debug("Plugin registry invalidated")
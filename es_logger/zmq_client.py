@@ -7,18 +7,26 @@ __author__ = 'jonpsull'
 
 import argparse
 import asyncio
+import collections
+import concurrent.futures
 import configparser
 import es_logger
+import es_logger.journal
+import es_logger.metrics
+import jenkins
 import json
 import logging
+import math
 import os
+import re
 import signal
-from stevedore import driver
 import sys
+import time
 import traceback
 import urllib
 import zmq
 from zmq.asyncio import Context
+import zmq.utils.monitor
 
 
 # Configure logging for the daemon
@@ -42,13 +50,85 @@ class ZMQClientMisconfiguration(ZMQClientError):
     pass
 
 
+# The tiers of the queue, each taken only once those before it are empty: builds with one of the
+# priority_statuses, the rest of the builds Jenkins sent, then builds found by catching up
+PRIORITY, LIVE, CATCH_UP = range(3)
+
+# The name of the master listening to the Jenkins in [zmq] and [jenkins], alongside the masters
+# of the [master:<name>] sections
+DEFAULT_MASTER = 'default'
+
+# How many builds of a job to list at a time when catching up
+CATCH_UP_PAGE = 100
+
+# What a message says of its build, parsed once when the message arrives and queued alongside it
+Build = collections.namedtuple('Build', ['job', 'number', 'phase', 'status', 'catch_up'])
+
+
+# Pending items in tiers, each holding a queue per key that take turns
+class FairItems(object):
+    def __init__(self, classify):
+        self.classify = classify
+        self.tiers = (collections.OrderedDict(), collections.OrderedDict(),
+                      collections.OrderedDict())
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for tier in self.tiers:
+            for items in tier.values():
+                yield from items
+
+    def append(self, item):
+        key, tier_index = self.classify(item)
+        tier = self.tiers[tier_index]
+        tier.setdefault(key, collections.deque()).append(item)
+        self.size += 1
+
+    def popleft(self):
+        tier = next(tier for tier in self.tiers if len(tier) > 0)
+        key, items = next(iter(tier.items()))
+        item = items.popleft()
+        if len(items) > 0:
+            # Back of the line until every other key has had a turn
+            tier.move_to_end(key)
+        else:
+            del tier[key]
+        self.size -= 1
+        return item
+
+
+# Queue taking items for each key in turn, so that one busy key can't starve the rest
+# classify(item) returns the key of an item, and its tier
+class FairQueue(asyncio.Queue):
+    def __init__(self, maxsize=0, classify=None):
+        self.classify = classify or (lambda item: (None, LIVE))
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = FairItems(self.classify)
+
+
 # Class for running es-logger as Jenkins ZMQ listener
 class ESLoggerZMQDaemon(object):
+    # Finds the phase in a raw message, without parsing the JSON
+    PHASE_RE = re.compile(rb'"phase"\s*:\s*"([^"]*)"')
+
     def __init__(self, args):
+        self.args = args
+        # The name of the Jenkins master, or None, and a daemon for each master listened to
+        self.master = None
+        self.masters = []
+        # The settings for EsLogger, its plugins and targets, by environment variable name
+        self.settings = {}
+        self.queue = None
         self.listener = None
         self.tasks = []
-        self.env_vars = ['JENKINS_URL', 'JENKINS_USER', 'JENKINS_PASSWORD', 'PROCESS_CONSOLE_LOGS',
-                         'GATHER_BUILD_DATA', 'GENERATE_EVENTS']
+        self.env_vars = ['JENKINS_URL', 'JENKINS_USER', 'JENKINS_PASSWORD', 'JENKINS_RATE_LIMIT',
+                         'JENKINS_HEAVY_RATE_LIMIT', 'PROCESS_CONSOLE_LOGS', 'GATHER_BUILD_DATA',
+                         'GENERATE_EVENTS']
         self.process_console_logs = ''
         self.gather_build_data = ''
         self.generate_events = ''
@@ -56,20 +136,130 @@ class ESLoggerZMQDaemon(object):
         self.worker_sleep = 15
         self.test_zmq = args.test_zmq
         self.targets = {}
+        # Where the blocking work of processing each message runs, thread or process
+        self.executor_type = 'thread'
+        self.executor = None
+        # Queue depth, 0 for unbounded, and what to do with messages once it is reached:
+        # block the listener, or spill them to spill_file.  Only FINISHED messages are queued
+        # outside of --test-zmq, so dropping all but FINISHED messages is only for --test-zmq
+        self.max_queue_size = 0
+        self.overflow = 'block'
+        self.spill_file = 'es-logger-spill.jsonl'
+        self.spill = None
+        # How many overflowing messages are held in the journal, which already keeps them,
+        # rather than spilled
+        self.held = 0
+        self.overflowing = False
+        # SQLite journal of the builds accepted for processing, None to disable, so that builds
+        # left unfinished are resumed when the daemon next starts, up to journal_max_resumes times
+        self.journal_file = None
+        self.journal_max_resumes = 3
+        self.journal = None
+        # SQLite checkpoint of the newest build processed for each job, None to disable, so that
+        # builds that finished while the daemon was down or disconnected from Jenkins are caught
+        # up on, behind the builds Jenkins sends
+        self.checkpoint_file = None
+        self.checkpoint = None
+        self.catch_up_task = None
+        # Count of the messages the listener discarded, by phase
+        self.discarded = collections.Counter()
+        # Builds already queued, and when to forget them, to skip repeated FINISHED messages
+        # for dedup_ttl seconds, 0 to disable
+        self.dedup_ttl = 3600
+        self.seen_builds = collections.OrderedDict()
+        self.duplicates = 0
+        # Take queued messages from each job in turn (fair), or in the order received (fifo),
+        # either way taking the builds with priority_statuses first
+        self.scheduling = 'fair'
+        self.priority_statuses = ['FAILURE']
+        # Serve metrics for Prometheus over HTTP on metrics_address:metrics_port, None to disable
+        self.metrics_address = '127.0.0.1'
+        self.metrics_port = None
+        self.metrics_server = None
+        self.busy_workers = 0
+        # Scale the workers between min_workers and max_workers, which default to num_workers,
+        # checking every scale_interval seconds.  Grow when the queue would take more than
+        # scale_up_backlog seconds to drain, shrink after scale_down_checks checks in a row
+        # with the queue empty and workers idle
+        self.min_workers = None
+        self.max_workers = None
+        self.scale_interval = 10
+        self.scale_up_backlog = 60
+        self.scale_down_checks = 6
+        self.idle_checks = 0
+        self.retiring = 0
+        self.next_worker = 0
+        self.process_func = None
+        # Moving average of the seconds taken to process a message, and when each message being
+        # processed was started
+        self.latency = None
+        self.processing_since = []
+        # The most seconds to spend processing the queue at shutdown, 0 for no limit
+        self.drain_timeout = 0
+        self.drain_expired = False
+        self.stopping = False
 
-    # Read the configuration
-    def configure(self, config_file='es-logger.ini'):
+    # Read the configuration of a Jenkins master, from its [master:<name>] section over the
+    # [zmq] and [jenkins] sections, or with no master the configuration of a daemon listening
+    # to each master, and to the Jenkins in [zmq] and [jenkins] if its zmq_publisher is set
+    def configure(self, config_file='es-logger.ini', master=None):
         config = configparser.ConfigParser()
         config.read(config_file)
+        self.master = master
+
+        overrides = {}
+        if master is not None and master != DEFAULT_MASTER:
+            overrides = config['master:' + master]
+
+        zmq_config = self.get_section(config, 'zmq', overrides)
+        if zmq_config is not None:
+            self.num_workers = int(zmq_config.get('num_workers', 3))
+            self.min_workers = int(zmq_config.get('min_workers', self.num_workers))
+            self.max_workers = int(zmq_config.get('max_workers', self.num_workers))
+            self.scale_interval = int(zmq_config.get('scale_interval', 10))
+            self.scale_up_backlog = int(zmq_config.get('scale_up_backlog', 60))
+            self.scale_down_checks = int(zmq_config.get('scale_down_checks', 6))
+            self.drain_timeout = int(zmq_config.get('drain_timeout', 0))
+            self.zmq_publisher = zmq_config.get('zmq_publisher')
+            self.executor_type = zmq_config.get('executor', 'thread')
+            self.max_queue_size = int(zmq_config.get('max_queue_size', 0))
+            self.overflow = zmq_config.get('overflow', 'block')
+            self.spill_file = zmq_config.get('spill_file', 'es-logger-spill.jsonl')
+            self.journal_file = zmq_config.get('journal')
+            self.journal_max_resumes = int(zmq_config.get('journal_max_resumes', 3))
+            self.checkpoint_file = zmq_config.get('checkpoint')
+            self.dedup_ttl = int(zmq_config.get('dedup_ttl', 3600))
+            self.scheduling = zmq_config.get('scheduling', 'fair')
+            self.priority_statuses = zmq_config.get('priority_statuses', 'FAILURE').split()
+            self.metrics_address = zmq_config.get('metrics_address', '127.0.0.1')
+            if zmq_config.get('metrics_port') is not None:
+                self.metrics_port = int(zmq_config.get('metrics_port'))
 
-        if 'zmq' in config:
-            self.num_workers = int(config['zmq'].get('num_workers', 3))
-            self.zmq_publisher = config['zmq'].get('zmq_publisher')
+        if master is not None and master != DEFAULT_MASTER:
+            # Keep the messages of each master apart, the default master keeping the files it
+            # used before there were other masters
+            if 'spill_file' not in overrides:
+                self.spill_file = '{}.{}'.format(self.spill_file, master)
+            if self.journal_file is not None and 'journal' not in overrides:
+                self.journal_file = '{}.{}'.format(self.journal_file, master)
+            if self.checkpoint_file is not None and 'checkpoint' not in overrides:
+                self.checkpoint_file = '{}.{}'.format(self.checkpoint_file, master)
+        if master is not None:
+            # Served once for every master
+            self.metrics_port = None
 
-        if 'jenkins' in config:
-            self.jenkins_url = config['jenkins'].get('jenkins_url')
-            self.jenkins_user = config['jenkins'].get('jenkins_user')
-            self.jenkins_password = config['jenkins'].get('jenkins_password')
+        jenkins_config = self.get_section(config, 'jenkins', overrides)
+        if jenkins_config is not None:
+            self.jenkins_url = jenkins_config.get('jenkins_url')
+            self.jenkins_user = jenkins_config.get('jenkins_user')
+            self.jenkins_password = jenkins_config.get('jenkins_password')
+            # Optional limits on the requests a second to Jenkins, shared by the workers
+            self.jenkins_rate_limit = jenkins_config.get('rate_limit')
+            self.jenkins_heavy_rate_limit = jenkins_config.get('heavy_rate_limit')
+
+        # Passed to each EsLogger rather than set in the environment, so that masters with
+        # different settings can share the process
+        self.settings = {}
 
         if 'eslogger' in config:
             targets = config['eslogger'].get('targets', 'logstash').split(' ')
@@ -84,7 +274,7 @@ class ESLoggerZMQDaemon(object):
                 for var in config[target].keys():
                     self.targets[target][var] = config[target].get(var)
                     logging.debug("Setting target configuration {}".format(self.targets[target]))
-                    self.set_in_env(var, self.targets[target][var])
+                    self.set_setting(var, self.targets[target][var])
 
         # Set defaults plugins to all unless overridden
         if 'plugins' not in config:
@@ -109,25 +299,50 @@ class ESLoggerZMQDaemon(object):
         logging.info("Using generate_events plugins: {}".format(self.generate_events))
         self.get_plugin_config("generate_events", self.generate_events.split(" "), config)
 
-        # Set the necessary environment variables
+        # Set the necessary settings
         for var in self.env_vars:
             if hasattr(self, var.lower()):
-                self.set_in_env(var, getattr(self, var.lower()))
+                self.set_setting(var, getattr(self, var.lower()))
 
-        # Iterate over the plugin configuration and set it in the environment
+        # Iterate over the plugin configuration and add it to the settings
         for plugin in self.plugins.keys():
             for var in self.plugins[plugin].keys():
-                self.set_in_env(var, self.plugins[plugin][var])
+                self.set_setting(var, self.plugins[plugin][var])
+
+        # Each [master:<name>] section is another Jenkins to listen to, as well as the Jenkins
+        # in [zmq] and [jenkins] when its zmq_publisher is set
+        self.masters = []
+        if master is None:
+            names = [section[len('master:'):] for section in config.keys()
+                     if section.startswith('master:')]
+            if DEFAULT_MASTER in names:
+                raise ZMQClientMisconfiguration(
+                    "[master:{0}] is reserved for the Jenkins in [zmq] and [jenkins], "
+                    "use another name".format(DEFAULT_MASTER))
+            if len(names) > 0 and self.zmq_publisher is not None:
+                names.insert(0, DEFAULT_MASTER)
+            for name in names:
+                master_daemon = ESLoggerZMQDaemon(self.args)
+                master_daemon.configure(config_file, master=name)
+                self.masters.append(master_daemon)
 
         self.validate_config()
 
-    # lower case var to upper case env var
+    # The settings of a section with any overrides, or None if there are neither
     @staticmethod
-    def set_in_env(var, val):
+    def get_section(config, name, overrides):
+        if name not in config and len(overrides) == 0:
+            return None
+        section = dict(config[name]) if name in config else {}
+        section.update(overrides)
+        return section
+
+    # lower case var to upper case setting, as its env var
+    def set_setting(self, var, val):
         var_name = var.upper()
         if val is not None and val != '':
-            os.environ[var_name] = val
-            logging.debug('Setting env var {}'.format(var_name))
+            self.settings[var_name] = val
+            logging.debug('Setting {}'.format(var_name))
 
     # Check for plugin-specific configuration
     def get_plugin_config(self, plugin_type, plugin_list, config):
@@ -143,16 +358,37 @@ class ESLoggerZMQDaemon(object):
         # Confirm configuration or raise an exception
         unset_attr = []
         needed_attrs = ['jenkins_url', 'jenkins_user', 'jenkins_password', 'zmq_publisher']
+        if len(self.masters) > 0:
+            # Needed by each master instead
+            needed_attrs = []
         target_attrs = []
         for target in self.targets:
-            drv = driver.DriverManager(namespace='es_logger.plugins.event_target',
-                                       invoke_on_load=False,
-                                       name=target)
-            target_attrs = target_attrs + drv.driver.get_required_vars()
+            target_class = es_logger.registry.get_plugin_class('es_logger.plugins.event_target',
+                                                               target)
+            target_attrs = target_attrs + target_class.get_required_vars()
         for attr in needed_attrs + target_attrs:
             if ((not hasattr(self, attr.lower())) or getattr(self, attr.lower()) is None) and \
+                    attr.upper() not in self.settings and \
                     os.environ.get(attr.upper(), None) is None:
                 unset_attr.append(attr)
+        if self.executor_type not in ['thread', 'process']:
+            raise ZMQClientMisconfiguration(
+                "Unknown executor {}, use thread or process".format(self.executor_type))
+        if self.overflow not in ['block', 'drop', 'spill']:
+            raise ZMQClientMisconfiguration(
+                "Unknown overflow {}, use block, drop or spill".format(self.overflow))
+        if self.overflow == 'drop' and not self.test_zmq:
+            raise ZMQClientMisconfiguration(
+                "overflow drop never drops FINISHED messages, the only ones queued outside of "
+                "--test-zmq, use block or spill")
+        if self.min_workers is not None and \
+                not 1 <= self.min_workers <= self.num_workers <= self.max_workers:
+            raise ZMQClientMisconfiguration(
+                "Workers must be 1 <= min_workers ({}) <= num_workers ({}) <= max_workers ({})"
+                .format(self.min_workers, self.num_workers, self.max_workers))
+        if self.scheduling not in ['fair', 'fifo']:
+            raise ZMQClientMisconfiguration(
+                "Unknown scheduling {}, use fair or fifo".format(self.scheduling))
         if len(unset_attr) > 0:
             e = ZMQClientMisconfiguration(
                 "Unconfigured for daemon operation, check config or environment for the following "
@@ -171,34 +407,328 @@ class ESLoggerZMQDaemon(object):
         project = urllib.parse.unquote(project)
         return project
 
+    # Only the configuration is needed to run tasks in a process pool, not the asyncio state
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for attr in ['args', 'masters', 'loop', 'queue', 'listener', 'tasks', 'executor', 'spill',
+                     'journal', 'checkpoint', 'catch_up_task', 'metrics_server']:
+            state.pop(attr, None)
+        return state
+
+    # Create the executor the workers run the processing of each message in
+    def get_executor(self):
+        if self.executor_type == 'process':
+            # Leave SIGINT to the daemon, which finishes the builds in progress before exiting
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.get_max_workers(), initializer=signal.signal,
+                initargs=(signal.SIGINT, signal.SIG_IGN))
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.get_max_workers())
+
+    # The most workers that can be running, with room for them in the executor
+    def get_max_workers(self):
+        return max(self.num_workers, self.max_workers or 0)
+
+    # Whether the workers are to be scaled
+    def autoscaling(self):
+        return self.max_workers is not None and self.max_workers > self.min_workers
+
+    # Start another worker task
+    def add_worker(self):
+        name = f'worker-{self.next_worker}'
+        if self.master is not None:
+            name = f'{self.master}-{name}'
+        task = asyncio.create_task(self.worker(name, self.process_func))
+        self.next_worker += 1
+        self.tasks.append(task)
+
+    # The seconds taken to process a message, or until one has been processed, the time the
+    # oldest message being processed has taken so far, as it will take at least that long
+    def get_latency(self):
+        if self.latency is not None:
+            return self.latency
+        if len(self.processing_since) > 0:
+            return time.monotonic() - min(self.processing_since)
+        return 0
+
+    # Grow or shrink the workers from the time the queue would take to drain at the current size
+    # Growing as soon as it is too long but shrinking only after a run of idle checks, so that
+    # the workers don't thrash as the load comes and goes
+    def autoscale(self):
+        workers = len(self.tasks) - self.retiring
+        depth = self.queue.qsize()
+        latency = self.get_latency()
+        backlog = depth * latency / workers
+        if backlog > self.scale_up_backlog and workers < self.max_workers:
+            self.idle_checks = 0
+            target = min(self.max_workers, max(
+                workers + 1, math.ceil(depth * latency / self.scale_up_backlog)))
+            logging.info("Queue of {} needs {:.0f}s to drain, scaling up to {} workers".format(
+                depth, backlog, target))
+            for i in range(target - workers):
+                self.add_worker()
+        elif depth == 0 and self.busy_workers < workers:
+            self.idle_checks += 1
+            if self.idle_checks >= self.scale_down_checks and workers > self.min_workers:
+                self.idle_checks = 0
+                logging.info("Workers idle, scaling down to {} workers".format(workers - 1))
+                self.retiring += 1
+        else:
+            self.idle_checks = 0
+
+    # The Build a message is for, or None if it can't be parsed
+    def parse_message(self, msg):
+        try:
+            var = json.loads(''.join(msg[0].decode("utf-8").split()[1:]))
+            build = var['build']
+            return Build(self.get_project_name(var['url']), build.get('number'),
+                         build.get('phase'), build.get('status'), bool(build.get('catch_up')))
+        except (ValueError, KeyError, AttributeError, IndexError, TypeError):
+            return None
+
+    # Only FINISHED messages are processed, so check the phase cheaply before the message is
+    # queued, counting the rest.  Everything is kept when testing the connection
+    def is_actionable(self, msg):
+        if self.test_zmq:
+            return True
+        match = self.PHASE_RE.search(msg[0])
+        phase = match.group(1).decode('utf-8', errors='replace') if match else 'unknown'
+        if phase == 'FINISHED':
+            return True
+        self.discarded[phase] += 1
+        es_logger.metrics.MESSAGES_DISCARDED.inc(phase=phase)
+        logging.debug("Discarding message in phase {}".format(phase))
+        return False
+
+    # Whether a Build is a FINISHED build that can be processed
+    @staticmethod
+    def is_finished(build):
+        return build is not None and build.phase == 'FINISHED' and build.number is not None
+
+    # The job a queued message is for, to take turns between on the queue, with None for the job
+    # of anything unparseable, and its tier: PRIORITY if its build has one of the
+    # priority_statuses, CATCH_UP if it was found by catching up, otherwise LIVE
+    def classify_message(self, item):
+        msg, build = item
+        if build is None:
+            return None, LIVE
+        job = None if self.scheduling == 'fifo' else build.job
+        if build.catch_up:
+            return job, CATCH_UP
+        if build.status in self.priority_statuses:
+            return job, PRIORITY
+        return job, LIVE
+
+    # Whether a message is for a build already queued in the last dedup_ttl seconds
+    def is_duplicate(self, build):
+        if self.test_zmq or self.dedup_ttl <= 0 or not self.is_finished(build):
+            return False
+        key = (build.job, build.number)
+        # Every build is kept for the same time, so the oldest expire first
+        now = time.monotonic()
+        while len(self.seen_builds) > 0 and next(iter(self.seen_builds.values())) <= now:
+            self.seen_builds.popitem(last=False)
+        if key in self.seen_builds:
+            self.duplicates += 1
+            es_logger.metrics.MESSAGES_DUPLICATE.inc()
+            logging.debug("Skipping duplicate of {} number {}".format(build.job, build.number))
+            return True
+        self.seen_builds[key] = now + self.dedup_ttl
+        return False
+
+    # Record a FINISHED message in the journal until its build has been processed
+    def journal_work(self, msg, build):
+        if self.is_journaled(build):
+            self.journal.add(build.job, build.number, msg)
+
+    # Whether a message is kept in the journal until its build has been processed
+    def is_journaled(self, build):
+        return self.journal is not None and self.is_finished(build)
+
+    # Remove a processed message's build from the journal, and record it in the checkpoint
+    def complete_work(self, build):
+        if self.is_finished(build):
+            if self.journal is not None:
+                self.journal.complete(build.job, build.number)
+            if self.checkpoint is not None:
+                self.checkpoint.update(build.job, build.number)
+
+    # Put the builds left unfinished by the last run back on the queue
+    async def resume_work(self):
+        abandoned, pending = self.journal.resume(self.journal_max_resumes)
+        if abandoned > 0:
+            logging.warning("Abandoning {} builds in the journal, resumed {} times already".format(
+                abandoned, self.journal_max_resumes))
+        logging.info("Resuming {} unfinished builds from the journal".format(len(pending)))
+        for msg in pending:
+            await self.enqueue(msg, self.parse_message(msg))
+
+    # A message for a build found by catching up, as Jenkins sends when a build finishes
+    @staticmethod
+    def make_catch_up_message(job, number):
+        url = ''.join('job/{}/'.format(urllib.parse.quote(part, safe=''))
+                      for part in job.split('/'))
+        var = {'url': url,
+               'build': {'number': number, 'phase': 'FINISHED', 'url': '{}{}/'.format(url, number),
+                         'catch_up': True}}
+        return ['onFinalized {}'.format(json.dumps(var)).encode('utf-8')]
+
+    # The settings to process builds with.  Each process has rate limit budgets of its own, so
+    # with the process executor the rate limits are split evenly between the worker processes
+    # and the daemon's own requests
+    def get_process_settings(self):
+        if self.executor_type != 'process':
+            return self.settings
+        settings = dict(self.settings)
+        for name in ['JENKINS_RATE_LIMIT', 'JENKINS_HEAVY_RATE_LIMIT']:
+            rate = float(settings.get(name, os.environ.get(name)) or 0)
+            if rate:
+                settings[name] = '{}'.format(rate / (self.get_max_workers() + 1))
+        return settings
+
+    # A Jenkins client for the daemon's own requests, with the settings and rate limits the
+    # builds are processed with
+    def get_jenkins_server(self):
+        settings = self.get_process_settings()
+
+        def setting(name):
+            return settings.get(name, os.environ.get(name))
+        return es_logger.connect_jenkins(setting('JENKINS_URL'), setting('JENKINS_USER'),
+                                         setting('JENKINS_PASSWORD'),
+                                         float(setting('JENKINS_RATE_LIMIT') or 0),
+                                         float(setting('JENKINS_HEAVY_RATE_LIMIT') or 0))
+
+    # The builds of each job newer than its checkpoint and finished, oldest first, listing the
+    # builds of each job a page at a time, newest first, back to its checkpoint.  Blocks on
+    # Jenkins
+    def find_missed_builds(self, checkpoints):
+        server = self.get_jenkins_server()
+        missed = []
+        for job, number in sorted(checkpoints.items()):
+            builds = []
+            try:
+                while True:
+                    page = server.get_job_builds(job, start=len(builds),
+                                                 end=len(builds) + CATCH_UP_PAGE)
+                    builds += page
+                    if len(page) < CATCH_UP_PAGE or page[-1]['number'] <= number:
+                        break
+            except jenkins.JenkinsException as err:
+                logging.warning("Unable to catch up on {}: {}".format(job, err))
+                continue
+            missed += [(job, build['number']) for build in reversed(builds)
+                       if build['number'] > number and not build.get('building')]
+        return missed
+
+    # Queue the builds that finished since the checkpoint, e.g. while the daemon was down
+    async def catch_up(self):
+        try:
+            missed = await asyncio.get_running_loop().run_in_executor(
+                None, self.find_missed_builds, self.checkpoint.builds())
+        except Exception as exc:
+            logging.warning("Unable to catch up: {}".format(exc))
+            return
+        logging.info("Catching up on {} builds finished since the checkpoint".format(len(missed)))
+        for job, number in missed:
+            msg = self.make_catch_up_message(job, number)
+            build = self.parse_message(msg)
+            if not self.is_duplicate(build):
+                await self.enqueue(msg, build)
+
+    def start_catch_up(self):
+        if self.catch_up_task is not None and not self.catch_up_task.done():
+            logging.debug("Already catching up")
+            return
+        self.catch_up_task = asyncio.create_task(self.catch_up())
+
+    # Catch up after reconnecting to the publisher, as whatever it sent in the meantime is lost
+    async def watch_connection(self, monitor):
+        disconnected = False
+        try:
+            while True:
+                event = zmq.utils.monitor.parse_monitor_message(await monitor.recv_multipart())
+                if event['event'] == zmq.EVENT_DISCONNECTED and not disconnected:
+                    logging.warning("Disconnected from {}".format(self.zmq_publisher))
+                    disconnected = True
+                elif event['event'] == zmq.EVENT_CONNECTED and disconnected:
+                    logging.info("Reconnected to {}".format(self.zmq_publisher))
+                    disconnected = False
+                    self.start_catch_up()
+        finally:
+            monitor.close()
+
+    # Put a message on the queue, applying the overflow policy once it is full
+    async def enqueue(self, msg, build):
+        self.journal_work(msg, build)
+        if self.spill is not None and (len(self.spill) > 0 or self.held > 0 or
+                                       (self.queue.full() and self.overflow == 'spill')):
+            # Spill behind any messages already spilled, to keep them in order
+            self.warn_overflow()
+            if self.is_journaled(build):
+                if self.journal.hold(build.job, build.number):
+                    self.held += 1
+            else:
+                self.spill.append(msg)
+            self.refill_queue()
+        elif self.queue.full() and self.overflow == 'drop' and \
+                (build is None or build.phase != 'FINISHED'):
+            self.warn_overflow()
+            logging.debug("Queue full, dropping {}".format(msg))
+        else:
+            if self.queue.full():
+                self.warn_overflow()
+            elif self.overflowing:
+                logging.info("Queue no longer full")
+                self.overflowing = False
+            await self.queue.put((msg, build))
+
+    # Say once when the queue fills up, rather than for every message
+    def warn_overflow(self):
+        if not self.overflowing:
+            logging.warning("Queue full at {} messages, applying overflow policy {}".format(
+                self.queue.qsize(), self.overflow))
+            self.overflowing = True
+
+    # Move spilled messages back on to the queue while there is room, then the held messages
+    def refill_queue(self):
+        while not self.queue.full():
+            if self.spill is not None and len(self.spill) > 0:
+                msg = self.spill.pop()
+                self.queue.put_nowait((msg, self.parse_message(msg)))
+            elif self.held > 0:
+                held = self.journal.take_held(self.queue.maxsize - self.queue.qsize())
+                self.held = self.held - len(held) if len(held) > 0 else 0
+                for msg in held:
+                    self.queue.put_nowait((msg, self.parse_message(msg)))
+            else:
+                break
+
     # Processing function to validate ZMQ connection
-    def test_zmq_task(self, msg):
-        var = json.loads(''.join(msg[0].decode("utf-8").split()[1:]))
-        job = self.get_project_name(var['url'])
-        number = var['build'].get('number')
-        phase = var['build'].get('phase')
-        logging.info(f'Got event: job [{job}] number [{number}] phase [{phase}]')
+    def test_zmq_task(self, msg, build):
+        if build is None:
+            logging.info(f'Got unparseable event: {msg}')
+            return 0
+        logging.info(f'Got event: job [{build.job}] number [{build.number}] '
+                     f'phase [{build.phase}]')
         return 0
 
     # Processing function to run es-logger
-    def es_logger_task(self, msg):
-        var = json.loads(''.join(msg[0].decode("utf-8").split()[1:]))
-        phase = var['build'].get('phase')
-        if phase == 'FINISHED':
-            job = self.get_project_name(var['url'])
-            number = var['build'].get('number')
+    def es_logger_task(self, msg, build):
+        if self.is_finished(build):
+            job, number = build.job, build.number
             logging.info("Process {} number {} on {}".format(job, number, self.jenkins_url))
             # Create and configure the ES-Logger instance
             # Ensure we only pass the keys for targets, and not the (potentially sensitive)
             # configuration details
-            esl = es_logger.EsLogger(console_length=32500, targets=self.targets.keys())
+            esl = es_logger.EsLogger(console_length=32500, targets=self.targets.keys(),
+                                     config=self.get_process_settings())
             esl.es_job_name = job
             esl.es_build_number = '{}'.format(number)
             esl.gather_all()
             status = esl.post_all()
             logging.info("{} number {} status {}".format(job, number, status))
         else:
-            logging.debug('Not collecting from job in phase {}'.format(phase))
+            logging.debug('Not collecting from job in phase {}'.format(
+                build.phase if build is not None else None))
             status = None
         return status
 
@@ -207,39 +737,147 @@ class ESLoggerZMQDaemon(object):
         logging.info("{} Starting".format(name))
         current_task = asyncio.current_task()
         while not current_task.done():
+            if self.retiring > 0:
+                # Scaled down
+                self.retiring -= 1
+                self.tasks.remove(current_task)
+                logging.info("{} retiring".format(name))
+                break
             try:
                 logging.debug("{} waiting for work".format(name))
-                msg = await asyncio.wait_for(self.queue.get(), self.worker_sleep)
-                logging.debug("{} processing msg {}".format(name, msg))
-                result = getattr(self, process_func)(msg)
-                self.queue.task_done()
-                logging.debug("{} result {}".format(name, result))
+                msg, build = await asyncio.wait_for(self.queue.get(), self.worker_sleep)
             except asyncio.TimeoutError:
                 logging.debug("{} timeout waiting for work, looping".format(name))
+                continue
             except asyncio.CancelledError:
                 logging.info("{} cancelled, finishing".format(name))
                 break
+            logging.debug("{} processing msg {}".format(name, msg))
+            # Shielded from cancellation, so a build being processed when stopping is finished
+            processing = asyncio.ensure_future(self.process(process_func, msg, build))
+            try:
+                result = await asyncio.shield(processing)
+            except asyncio.CancelledError:
+                logging.info("{} cancelled, finishing msg".format(name))
+                return await self.finish_processing(name, msg, build, processing)
+            self.complete_work(build)
+            self.queue.task_done()
+            self.refill_queue()
+            logging.debug("{} result {}".format(name, result))
         logging.info("{} Finished".format(name))
         return 0
 
+    # Finish the build a worker was processing when it was stopped, returning its status as the
+    # status of the worker.  Cancelling the worker again, at the shutdown deadline, gives up on it
+    # and keeps the message to process on restart
+    async def finish_processing(self, name, msg, build, processing):
+        try:
+            result = await asyncio.shield(processing)
+        except asyncio.CancelledError:
+            logging.warning("{} out of time, not finishing msg {}".format(name, msg))
+            self.persist_unprocessed([(msg, build)])
+            return 0
+        self.complete_work(build)
+        self.queue.task_done()
+        logging.info("{} Finished msg with result {}".format(name, result))
+        return 0 if result is None else result
+
+    # Process a message in the executor, as processing blocks on Jenkins and the targets,
+    # keeping it off the event loop
+    async def process(self, process_func, msg, build):
+        self.busy_workers += 1
+        start = time.monotonic()
+        self.processing_since.append(start)
+        try:
+            with es_logger.metrics.BUILD_SECONDS.time():
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, getattr(self, process_func), msg, build)
+        except Exception:
+            es_logger.metrics.BUILDS_PROCESSED.inc(result='error')
+            raise
+        finally:
+            self.busy_workers -= 1
+            self.processing_since.remove(start)
+            self.record_latency(time.monotonic() - start)
+        if result is None:
+            es_logger.metrics.BUILDS_PROCESSED.inc(result='skipped')
+        elif result == 0:
+            es_logger.metrics.BUILDS_PROCESSED.inc(result='ok')
+        else:
+            es_logger.metrics.BUILDS_PROCESSED.inc(result='failed')
+        return result
+
+    # Keep a moving average of the time taken to process a message, favouring recent messages
+    def record_latency(self, elapsed):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * elapsed
+
     # Drain the queue to enable clean shutdown
+    # The messages are processed in parallel on the executor, for up to drain_timeout seconds
+    # if set, after which those not processed are kept to process when the daemon next starts
     async def drain_queue(self):
         status_list = []
         qsize = self.queue.qsize()
         processed = 0
         logging.info("Draining queue of size {}".format(qsize))
+        loop = asyncio.get_running_loop()
+        futures = []
         while self.queue.qsize() != 0:
-            msg = self.queue.get_nowait()
+            msg, build = self.queue.get_nowait()
             logging.debug("Processing msg {}".format(msg))
-            result = self.es_logger_task(msg)
+            futures.append((msg, build, loop.run_in_executor(self.executor, self.es_logger_task,
+                                                             msg, build)))
             self.queue.task_done()
-            logging.debug("Result {}".format(result))
-            if result is not None:
-                status_list.append(result)
+        if len(futures) > 0:
+            await asyncio.wait([future for msg, build, future in futures],
+                               timeout=self.drain_timeout or None)
+        unprocessed = []
+        for msg, build, future in futures:
+            if not future.done():
+                future.cancel()
+                unprocessed.append((msg, build))
+                continue
+            if future.exception() is not None:
+                logging.warning("Exception processing msg {}: {}".format(msg, future.exception()))
+                status_list.append(future.exception())
+            else:
+                result = future.result()
+                self.complete_work(build)
+                logging.debug("Result {}".format(result))
+                if result is not None:
+                    status_list.append(result)
             processed += 1
+        if len(unprocessed) > 0:
+            self.drain_expired = True
+            self.persist_unprocessed(unprocessed)
         logging.info("Queue drained, processed {}".format(processed))
         return status_list
 
+    # Wait for the workers to finish the builds they were processing when stopped, for up to
+    # drain_timeout seconds if set, after which they are cancelled again
+    async def wait_workers(self):
+        if len(self.tasks) == 0:
+            return
+        done, pending = await asyncio.wait(self.tasks, timeout=self.drain_timeout or None)
+        if len(pending) > 0:
+            self.drain_expired = True
+            for task in pending:
+                task.cancel()
+
+    # Keep messages there wasn't time to process before shutdown, to be processed on restart
+    # FINISHED messages in the journal are already kept there, the rest are spilled
+    # Takes the queued messages, each with its Build
+    def persist_unprocessed(self, items):
+        spill = self.spill if self.spill is not None else \
+            es_logger.journal.SpillFile(self.spill_file)
+        for msg, build in items:
+            if not self.is_journaled(build):
+                spill.append(msg)
+        logging.warning("Shutdown deadline of {}s reached, kept {} unprocessed messages".format(
+            self.drain_timeout, len(items)))
+
     # Connection function executed as listener task
     async def recv(self):
         logging.info('Listener Starting against {}'.format(self.zmq_publisher))
@@ -249,43 +887,103 @@ class ESLoggerZMQDaemon(object):
         s.connect(self.zmq_publisher)
         s.subscribe(b'')
 
+        if self.journal is not None:
+            await self.resume_work()
+
+        monitor = None
+        if self.checkpoint is not None:
+            monitor = asyncio.create_task(self.watch_connection(
+                s.get_monitor_socket(zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED)))
+            self.start_catch_up()
+
         current_task = asyncio.current_task()
         while not current_task.done():
             try:
                 logging.debug("Listener waiting for message")
                 msg = await asyncio.wait_for(s.recv_multipart(), None)
+                es_logger.metrics.MESSAGES_RECEIVED.inc()
+                if not self.is_actionable(msg):
+                    continue
+                build = self.parse_message(msg)
+                if self.is_duplicate(build):
+                    continue
                 logging.debug("Adding {} to queue {}".format(msg, self.queue.qsize()))
-                await self.queue.put(msg)
+                await self.enqueue(msg, build)
             except asyncio.CancelledError:
                 logging.info("Listener cancelled, finishing")
                 break
+        if monitor is not None:
+            monitor.cancel()
+            self.catch_up_task.cancel()
+            await asyncio.gather(monitor, self.catch_up_task, return_exceptions=True)
+            s.disable_monitor()
         s.close()
+        if len(self.discarded) > 0:
+            logging.info("Listener discarded messages by phase: {}".format(dict(self.discarded)))
+        if self.duplicates > 0:
+            logging.info("Listener skipped {} duplicate messages".format(self.duplicates))
         logging.info("Listener Finished")
         return 0
 
     # Start the threads for processing
     def start(self):
         logging.info('Starting')
-        # Setup signal handlers
         self.loop = asyncio.get_running_loop()
-        for signame in ('SIGINT', 'SIGTERM'):
-            self.loop.add_signal_handler(getattr(signal, signame), self.stop)
-        self.queue = asyncio.Queue()
+        # Signals and metrics are handled once for all of the masters
+        if self.master is None:
+            self.add_signal_handlers()
+        self.queue = FairQueue(maxsize=self.max_queue_size, classify=self.classify_message)
+        # Messages are also spilled when there wasn't time to process them at shutdown
+        if self.overflow == 'spill' or os.path.exists(self.spill_file):
+            self.spill = es_logger.journal.SpillFile(self.spill_file)
+            self.refill_queue()
+        # Only the builds processed by es-logger need resuming
+        if self.journal_file is not None and not self.test_zmq:
+            self.journal = es_logger.journal.WorkJournal(self.journal_file)
+        if self.checkpoint_file is not None and not self.test_zmq:
+            self.checkpoint = es_logger.journal.Checkpoint(self.checkpoint_file)
+        self.executor = self.get_executor()
+        if self.master is None:
+            self.start_metrics([self])
         # Create an asynchronous listener task
         self.listener = asyncio.create_task(self.recv())
         # Create worker tasks to process the queue concurrently.
         self.tasks = []
         if self.test_zmq:
-            process_func = 'test_zmq_task'
+            self.process_func = 'test_zmq_task'
         else:
-            process_func = 'es_logger_task'
+            self.process_func = 'es_logger_task'
         for i in range(self.num_workers):
-            task = asyncio.create_task(self.worker(f'worker-{i}', process_func))
-            self.tasks.append(task)
-        logging.info(f'Started {self.num_workers} workers using {process_func}')
+            self.add_worker()
+        logging.info(f'Started {self.num_workers} workers using {self.process_func}')
+
+    # Stop on SIGINT and SIGTERM, and reload plugins on SIGHUP, e.g. after upgrading them
+    # Worker processes of a process executor keep the plugin code they already imported
+    def add_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for signame in ('SIGINT', 'SIGTERM'):
+            loop.add_signal_handler(getattr(signal, signame), self.stop)
+        loop.add_signal_handler(signal.SIGHUP, es_logger.registry.invalidate, True)
+
+    # Report on the queues and workers of the daemons, serving the metrics if configured to
+    def start_metrics(self, daemons):
+        es_logger.metrics.QUEUE_DEPTH.set_function(
+            lambda: sum(daemon.queue.qsize() for daemon in daemons if daemon.queue is not None))
+        es_logger.metrics.WORKERS_BUSY.set_function(
+            lambda: sum(daemon.busy_workers for daemon in daemons))
+        es_logger.metrics.WORKER_UTILIZATION.set_function(
+            lambda: sum(daemon.busy_workers for daemon in daemons) /
+            max(sum(len(daemon.tasks) for daemon in daemons), 1))
+        if self.metrics_port is not None:
+            self.metrics_server = es_logger.metrics.start_server(self.metrics_address,
+                                                                 self.metrics_port)
 
     # Cancel the threads for stopping
+    # Workers finish the build they are processing, unless stopped a second time
     def stop(self):
+        self.stopping = True
+        for master in self.masters:
+            master.stop()
         if self.listener is not None:
             logging.info("Stopping listener")
             self.listener.cancel()
@@ -335,6 +1033,8 @@ class ESLoggerZMQDaemon(object):
         await asyncio.sleep(2)
         logging.info("Started tasks, entering status check loop")
         while not self.tasks_done():
+            if self.stopping:
+                break
             if not self.check_listener():
                 logging.warning("Listener not running")
                 self.stop()
@@ -343,17 +1043,35 @@ class ESLoggerZMQDaemon(object):
                 logging.warning("Tasks not running")
                 self.stop()
                 break
-            await asyncio.sleep(self.async_main_sleep)
+            if self.autoscaling():
+                self.autoscale()
+                await asyncio.sleep(self.scale_interval)
+            else:
+                await asyncio.sleep(self.async_main_sleep)
 
         logging.info("Exited status check loop")
 
-        # Ensure all the tasks get completed
-        drain_status = await self.drain_queue()
+        # Ensure all the tasks get completed, while workers finish the builds they were on
+        drain_status, _ = await asyncio.gather(self.drain_queue(), self.wait_workers())
 
         # Wait for all of the coroutines to finish and gather the result
         logging.info("Gathering task statuses")
         status_list = await asyncio.gather(*([self.listener] + self.tasks), return_exceptions=True)
         status_list = status_list + drain_status
+        # Wait for any builds still being processed by cancelled workers
+        if self.executor is not None:
+            if self.drain_expired:
+                # Out of time, and the builds still being processed are kept for the next start
+                self.stop_executor()
+            else:
+                self.executor.shutdown(wait=True)
+        if self.journal is not None:
+            self.journal.close()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
         status = 0
         for s in status_list:
             if isinstance(s, Exception):
@@ -366,11 +1084,48 @@ class ESLoggerZMQDaemon(object):
                 status += 1
         return status
 
+    # Stop the executor without waiting, terminating the processes of a process pool, as the
+    # builds they are processing were kept for the next start.  Threads can't be stopped, so
+    # main exits without waiting for them
+    def stop_executor(self):
+        processes = list((getattr(self.executor, '_processes', None) or {}).values())
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    # The ASync executed main function for several masters, each with its own lifecycle
+    async def async_main_masters(self):
+        logging.info("Starting masters {}".format([master.master for master in self.masters]))
+        self.add_signal_handlers()
+        self.start_metrics(self.masters)
+        status_list = await asyncio.gather(*[master.async_main() for master in self.masters],
+                                           return_exceptions=True)
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        status = 0
+        for master, s in zip(self.masters, status_list):
+            if isinstance(s, Exception):
+                logging.warning("Master {} exception: {}".format(master.master, s))
+                status += 1
+            else:
+                status += s
+        return status
+
     # Synchronous main to trigger async main only,
     # after loading configuration and setting environment
     def main(self):
         self.configure()
-        status = asyncio.run(self.async_main())
+        if len(self.masters) > 0:
+            status = asyncio.run(self.async_main_masters())
+        else:
+            status = asyncio.run(self.async_main())
+        if self.drain_expired or any(master.drain_expired for master in self.masters):
+            # Exit without waiting for the threads still processing builds, whose builds were
+            # kept for the next start, so they are not posted now as well
+            logging.info("Finished, leaving the unfinished builds for the next start")
+            logging.shutdown()
+            os._exit(status)
         logging.info("Finished")
         return status
 
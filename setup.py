@@ -87,6 +87,7 @@ setup(
             'es_logger = es_logger.plugins.console_log_events:EsLoggerConsoleLogRegex',
         ],
         'es_logger.plugins.event_target': [
+            'elasticsearch = es_logger.plugins.target:ElasticsearchTarget',
             'logstash = es_logger.plugins.target:LogstashTarget',
             'sqs = es_logger.plugins.target:SqsTarget',
         ],
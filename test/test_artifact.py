@@ -4,6 +4,7 @@
 __author__ = 'jonpsull'
 
 import es_logger
+import functools
 from jenkins import JenkinsException
 import nose
 import unittest.mock
@@ -11,12 +12,20 @@ import unittest.mock
 
 class TestArtifactEvent(object):
 
+    # A mock EsLogger reading settings as EsLogger does
+    @staticmethod
+    def get_esl(config=None):
+        esl = unittest.mock.MagicMock()
+        esl.config = config or {}
+        esl.get_setting.side_effect = functools.partial(es_logger.EsLogger.get_setting, esl)
+        return esl
+
     def test_artifact_event_json_decode_error(self):
         eg = es_logger.plugins.artifact.ArtifactEvent()
         fields = eg.get_fields()
         nose.tools.ok_(fields == es_logger.interface.EventGenerator.DEFAULT_FIELDS)
 
-        esl = unittest.mock.MagicMock()
+        esl = self.get_esl()
         esl.console_log = 'log'
         esl.build_info = {'artifacts': [{'relativePath': 'es-logger-data.json'}]}
         # Invalid json as not in []
@@ -41,7 +50,7 @@ class TestArtifactEvent(object):
         fields = eg.get_fields()
         nose.tools.ok_(fields == es_logger.interface.EventGenerator.DEFAULT_FIELDS)
 
-        esl = unittest.mock.MagicMock()
+        esl = self.get_esl()
         esl.console_log = 'log'
         esl.build_info = {'artifacts': [{'relativePath': 'es-logger-data.json'}]}
         esl.server.get_build_artifact.side_effect = JenkinsException("Bad download")
@@ -63,7 +72,7 @@ class TestArtifactEvent(object):
         fields = eg.get_fields()
         nose.tools.ok_(fields == es_logger.interface.EventGenerator.DEFAULT_FIELDS)
 
-        esl = unittest.mock.MagicMock()
+        esl = self.get_esl()
         esl.console_log = 'log'
         esl.build_info = {'artifacts': [{'relativePath': 'es-logger-data.json'}]}
         esl.server.get_build_artifact.return_value = ('[{"name": "event1"},'
@@ -85,7 +94,7 @@ class TestArtifactEvent(object):
         fields = eg.get_fields()
         nose.tools.ok_(fields == es_logger.interface.EventGenerator.DEFAULT_FIELDS)
 
-        esl = unittest.mock.MagicMock()
+        esl = self.get_esl()
         esl.console_log = 'log'
         esl.build_info = {'artifacts': [{'relativePath': 'random.json'}]}
         esl.server.get_build_artifact.return_value = ('[{"name": "event1"},'
@@ -100,3 +109,16 @@ class TestArtifactEvent(object):
         for idx, event in enumerate(events):
             nose.tools.ok_(event == results[idx],
                            "Bad event[{}] returned: {}".format(idx, events))
+
+    @unittest.mock.patch.dict('os.environ', {'ES_EVENT_ARTIFACT': 'random.json'})
+    def test_artifact_event_config_filename(self):
+        eg = es_logger.plugins.artifact.ArtifactEvent()
+        # The setting of the build is used over the environment
+        esl = self.get_esl({'ES_EVENT_ARTIFACT': 'config.json'})
+        esl.build_info = {'artifacts': [{'relativePath': 'config.json'}]}
+        esl.server.get_build_artifact.return_value = '[{"name": "event1"}]'
+
+        events = eg.generate_events(esl)
+        nose.tools.assert_equal(events, [{"name": "event1"}])
+        esl.server.get_build_artifact.assert_called_once_with(
+            esl.es_job_name, esl.es_build_number, 'config.json')
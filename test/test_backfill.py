@@ -0,0 +1,150 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import es_logger
+import es_logger.backfill
+import json
+import nose
+import os
+import tempfile
+import unittest.mock
+
+
+class TestProgress(object):
+
+    def test_progress(self):
+        with tempfile.TemporaryDirectory() as progress_dir:
+            path = os.path.join(progress_dir, 'progress.jsonl')
+            progress = es_logger.backfill.Progress(path)
+            nose.tools.assert_equal(len(progress), 0)
+            progress.record('job', 1, 0)
+            progress.record('job', 2, 1)
+            progress.record('other', 1, 0)
+            nose.tools.ok_(progress.is_done('job', 1))
+            nose.tools.ok_(not progress.is_done('job', 2))
+            # A later failure of a build undoes it
+            progress.record('other', 1, 2)
+            nose.tools.ok_(not progress.is_done('other', 1))
+            # Killed part way through writing a line
+            with open(path, 'a') as progress_file:
+                progress_file.write('{"job": "job", "num')
+            progress = es_logger.backfill.Progress(path)
+            nose.tools.assert_equal(len(progress), 1)
+            nose.tools.ok_(progress.is_done('job', 1))
+
+    def test_progress_no_file(self):
+        progress = es_logger.backfill.Progress()
+        progress.record('job', 1, 0)
+        nose.tools.ok_(progress.is_done('job', 1))
+
+
+class TestBackfill(object):
+
+    def setup(self):
+        self.backfill = es_logger.backfill.Backfill('folder/job', first=2, last=4,
+                                                    targets=['dummy'], workers=2,
+                                                    config={'JENKINS_RATE_LIMIT': '5'})
+        self.backfill.server = unittest.mock.MagicMock()
+        self.backfill.server.get_job_builds.return_value = [
+            {'number': 6, 'building': True}, {'number': 5, 'building': False},
+            {'number': 4, 'building': False}, {'number': 3}, {'number': 2}, {'number': 1}]
+
+    @unittest.mock.patch.dict('os.environ', {'JENKINS_URL': 'jenkins_url'})
+    def test_get_server(self):
+        self.backfill.server = None
+        server = self.backfill.get_server()
+        nose.tools.assert_equal(server.server, 'jenkins_url/')
+        nose.tools.ok_(self.backfill.get_server() is server)
+
+    @unittest.mock.patch.dict('os.environ', {}, clear=True)
+    def test_get_server_unset(self):
+        self.backfill.server = None
+        nose.tools.assert_raises(es_logger.JenkinsCollectError, self.backfill.get_server)
+
+    def test_get_jobs(self):
+        nose.tools.assert_equal(self.backfill.get_jobs(), ['folder/job'])
+        self.backfill.server.get_all_jobs.assert_not_called()
+        self.backfill.job = 'folder/*'
+        self.backfill.server.get_all_jobs.return_value = [
+            {'fullname': 'folder', 'jobs': [{}]}, {'fullname': 'folder/job2'},
+            {'fullname': 'folder/job1'}, {'fullname': 'other/job1'}]
+        nose.tools.assert_equal(self.backfill.get_jobs(), ['folder/job1', 'folder/job2'])
+
+    def test_get_builds(self):
+        nose.tools.assert_equal(self.backfill.get_builds('folder/job'), [2, 3, 4])
+        self.backfill.server.get_job_builds.assert_called_once_with('folder/job')
+        # Finished builds from first on
+        self.backfill.last = None
+        nose.tools.assert_equal(self.backfill.get_builds('folder/job'), [2, 3, 4, 5])
+
+    def test_get_work(self):
+        self.backfill.progress.record('folder/job', 3, 0)
+        with nose.tools.assert_logs(level='INFO') as cm:
+            work = self.backfill.get_work()
+        nose.tools.assert_equal(work, [('folder/job', 2), ('folder/job', 4)])
+        nose.tools.assert_equal(cm.output,
+                                ['INFO:es_logger.backfill:folder/job has 3 builds in range'])
+
+    @unittest.mock.patch('es_logger.EsLogger')
+    def test_process_build(self, mock_esl):
+        mock_esl.return_value.post_all.return_value = 0
+        with nose.tools.assert_logs(level='INFO') as cm:
+            status = self.backfill.process_build('folder/job', 2)
+        nose.tools.assert_equal(status, 0)
+        mock_esl.assert_called_once_with(32500, ['dummy'], config={
+            'JENKINS_RATE_LIMIT': '5', 'ES_JOB_NAME': 'folder/job', 'ES_BUILD_NUMBER': '2'})
+        nose.tools.assert_equal(mock_esl.return_value.method_calls,
+                                [unittest.mock.call.gather_all(), unittest.mock.call.post_all()])
+        nose.tools.ok_(self.backfill.progress.is_done('folder/job', 2))
+        nose.tools.assert_equal(cm.output,
+                                ['INFO:es_logger.backfill:folder/job number 2 status 0'])
+
+    @unittest.mock.patch('es_logger.EsLogger')
+    def test_process_build_exception(self, mock_esl):
+        mock_esl.return_value.gather_all.side_effect = es_logger.JenkinsCollectError('info')
+        with nose.tools.assert_logs(level='INFO') as cm:
+            status = self.backfill.process_build('folder/job', 2)
+        nose.tools.assert_equal(status, 1)
+        nose.tools.ok_(not self.backfill.progress.is_done('folder/job', 2))
+        nose.tools.assert_equal(cm.output,
+                                ['WARNING:es_logger.backfill:folder/job number 2 exception: info',
+                                 'INFO:es_logger.backfill:folder/job number 2 status 1'])
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as progress_dir:
+            path = os.path.join(progress_dir, 'progress.jsonl')
+            self.backfill.progress = es_logger.backfill.Progress(path)
+            self.backfill.process_build = unittest.mock.MagicMock(
+                side_effect=lambda job, number: self.backfill.progress.record(
+                    job, number, number % 2) or number % 2)
+            with nose.tools.assert_logs(level='INFO') as cm:
+                failed = self.backfill.run()
+            nose.tools.assert_equal(failed, 1)
+            nose.tools.assert_equal(sorted(self.backfill.process_build.call_args_list),
+                                    [unittest.mock.call('folder/job', number)
+                                     for number in [2, 3, 4]])
+            nose.tools.assert_equal(
+                cm.output,
+                ['INFO:es_logger.backfill:folder/job has 3 builds in range',
+                 'INFO:es_logger.backfill:Backfilling 3 builds on 2 workers, 0 already done',
+                 'INFO:es_logger.backfill:Backfilled 3 builds, 1 failed'])
+            with open(path) as progress_file:
+                records = sorted(json.loads(line)['number'] for line in progress_file)
+            nose.tools.assert_equal(records, [2, 3, 4])
+
+            # Run again, only the build that failed is processed
+            self.backfill.progress = es_logger.backfill.Progress(path)
+            self.backfill.process_build.reset_mock()
+            nose.tools.assert_equal(self.backfill.run(), 1)
+            self.backfill.process_build.assert_called_once_with('folder/job', 3)
+
+    def test_run_interrupted(self):
+        self.backfill.workers = 1
+        self.backfill.process_build = unittest.mock.MagicMock(
+            side_effect=[KeyboardInterrupt, 0, 0])
+        with nose.tools.assert_logs(level='INFO') as cm:
+            nose.tools.assert_raises(KeyboardInterrupt, self.backfill.run)
+        nose.tools.ok_('WARNING:es_logger.backfill:Interrupted, finishing the builds in progress'
+                       in cm.output)
@@ -102,3 +102,30 @@ class TestCli(object):
                 mock_exit.assert_called_with(0)
                 mock_logging.assert_called_with(
                     format='%(asctime)s %(name)s %(levelname)s %(message)s', level=10)
+
+    @unittest.mock.patch('es_logger.backfill.Backfill', autospec=True)
+    def test_backfill(self, mock_backfill):
+        sys.argv = ['es-logger', 'backfill', 'folder/*', '--from', '10', '--to', '20', '-w', '8',
+                    '--progress', 'progress.jsonl', '--rate-limit', '5', '-t', 'dummy']
+        mock_backfill.return_value.run.return_value = 2
+        with unittest.mock.patch('sys.exit', side_effect=ExitException) as mock_exit:
+            nose.tools.assert_raises(ExitException, es_logger.cli.main)
+            mock_exit.assert_called_with(2)
+        mock_backfill.assert_called_once_with(
+            'folder/*', first=10, last=20, targets=['dummy'], console_length=DEFAULT_CONSOLE_LENGTH,
+            workers=8, progress='progress.jsonl', config={'JENKINS_RATE_LIMIT': '5.0'})
+
+    @unittest.mock.patch('es_logger.backfill.Backfill', autospec=True)
+    def test_backfill_list(self, mock_backfill):
+        sys.argv = ['es-logger', 'backfill', 'job', '--heavy-rate-limit', '0.5', '--list']
+        mock_backfill.return_value.get_work.return_value = [('job', 1), ('job', 2)]
+        with unittest.mock.patch('sys.exit', side_effect=ExitException) as mock_exit, \
+                unittest.mock.patch('builtins.print') as mock_print:
+            nose.tools.assert_raises(ExitException, es_logger.cli.main)
+            mock_exit.assert_called_with(0)
+        mock_backfill.assert_called_once_with(
+            'job', first=1, last=None, targets=['logstash'], console_length=DEFAULT_CONSOLE_LENGTH,
+            workers=4, progress=None, config={'JENKINS_HEAVY_RATE_LIMIT': '0.5'})
+        mock_backfill.return_value.run.assert_not_called()
+        nose.tools.assert_equal(mock_print.call_args_list,
+                                [unittest.mock.call('job 1'), unittest.mock.call('job 2')])
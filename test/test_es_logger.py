@@ -6,11 +6,12 @@ __author__ = 'jonpsull'
 import es_logger
 import importlib.metadata
 import io
+import json
 from jenkins import JenkinsException, NotFoundException
 import nose
 from parameterized import parameterized
 import requests
-from stevedore import ExtensionManager
+from stevedore import driver, ExtensionManager
 import unittest.mock
 import xml.etree.ElementTree as ET
 
@@ -31,6 +32,7 @@ class TestEsLogger(object):
     def setup(self):
         dummy_ep = importlib.metadata.EntryPoint(
             'dummy', 'test.test_plugins:DummyEventTarget', 'es_logger.plugins.event_target')
+        es_logger.registry.invalidate()
         ExtensionManager.ENTRY_POINT_CACHE = {'es_logger.plugins.event_target': [dummy_ep]}
         self.esl = es_logger.EsLogger(1000, ['dummy'])
 
@@ -39,6 +41,7 @@ class TestEsLogger(object):
             'get_build_stages': 'jenkins_url/job/job_name/1/wfapi/describe/'}
 
     def tearDown(self):
+        es_logger.registry.invalidate()
         ExtensionManager.ENTRY_POINT_CACHE = {}
         mgr = ExtensionManager(namespace='es_logger.plugins.event_target', invoke_on_load=False)
         mgr.names()
@@ -244,7 +247,8 @@ es_logger.plugins.event_target:
         with unittest.mock.patch('stevedore.driver.DriverManager') as mock_driver_mgr, \
                 unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info, \
                 unittest.mock.patch('jenkins.Jenkins.get_build_env_vars') as mock_env_vars, \
-                unittest.mock.patch('jenkins.Jenkins.get_build_console_output') as mock_console, \
+                unittest.mock.patch(
+                    'jenkins.Jenkins.get_build_console_output_stream') as mock_console, \
                 unittest.mock.patch('jenkins.Jenkins.get_job_config') as mock_config:
             mock_env_vars.return_value = {'envMap': {'BUILD_NUMBER': '1',
                                                      'JOB_NAME': 'job_name',
@@ -260,13 +264,13 @@ es_logger.plugins.event_target:
                              'buildsByBranchName': {'b1': {'buildNumber': '1'},
                                                     'b2': {'buildNumber': '2'}},
                              'remoteUrls': ["repoURL"]}]}
-            mock_console.return_value = 'log'
+            mock_console.return_value = iter(['log'])
 
             config_xml = "<project></project>"
             mock_config.return_value = config_xml
 
             self.esl.get_build_data()
-            mock_driver_mgr.assert_called_once()
+            mock_driver_mgr.return_value.driver.gather.assert_called_once()
 
             # Job Config recorded
             nose.tools.ok_(self.esl.es_info['job_config_info'].get("is_pipeline_job") is False,
@@ -328,7 +332,8 @@ es_logger.plugins.event_target:
         with unittest.mock.patch('stevedore.driver.DriverManager') as mock_driver_mgr, \
                 unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info, \
                 unittest.mock.patch('jenkins.Jenkins.get_build_env_vars') as mock_env_vars, \
-                unittest.mock.patch('jenkins.Jenkins.get_build_console_output') as mock_console, \
+                unittest.mock.patch(
+                    'jenkins.Jenkins.get_build_console_output_stream') as mock_console, \
                 unittest.mock.patch('jenkins.Jenkins.get_job_config') as mock_config:
             mock_env_vars.return_value = {'envMap': {'BUILD_NUMBER': '2',
                                                      'JOB_NAME': 'es_job_name',
@@ -344,11 +349,11 @@ es_logger.plugins.event_target:
                              'buildsByBranchName': {'b1': {'buildNumber': '1'},
                                                     'b2': {'buildNumber': '2'}},
                              'remoteUrls': ["repoURL"]}]}
-            mock_console.return_value = 'log'
+            mock_console.return_value = iter(['log'])
             mock_config.side_effect = JenkinsException("Error from Jenkins Api")
 
             self.esl.get_build_data()
-            mock_driver_mgr.assert_called_once()
+            mock_driver_mgr.return_value.driver.gather.assert_called_once()
 
             # Job Config not recorded
             expected_error_msg = "Unable to retrieve config.xml."
@@ -384,6 +389,199 @@ es_logger.plugins.event_target:
                            "Wrong name for scm_data first element: {} not repoURL".format(
                            self.esl.es_info['build_data']['scm_data'][0]['name']))
 
+    def test_get_collect_workers(self):
+        nose.tools.ok_(self.esl.get_collect_workers() == 0,
+                       "collect_workers not 0: {}".format(self.esl.get_collect_workers()))
+        with unittest.mock.patch.dict('os.environ', {'ES_COLLECT_WORKERS': '4'}):
+            self.esl = es_logger.EsLogger(1000, ['dummy'])
+        nose.tools.ok_(self.esl.get_collect_workers() == 4,
+                       "collect_workers not 4: {}".format(self.esl.get_collect_workers()))
+
+    def test_jenkins_rate_limit(self):
+        nose.tools.assert_equal(self.esl.get_jenkins_rate_limit(), 0)
+        nose.tools.assert_equal(self.esl.get_jenkins_heavy_rate_limit(), 0)
+        with unittest.mock.patch.dict('os.environ', {'JENKINS_URL': 'jenkins_url',
+                                                     'JENKINS_RATE_LIMIT': '10',
+                                                     'JENKINS_HEAVY_RATE_LIMIT': '0.5'}), \
+                unittest.mock.patch('es_logger.ratelimit.limit_session') as mock_limit:
+            self.esl = es_logger.EsLogger(1000, ['dummy'])
+        nose.tools.assert_equal(self.esl.get_jenkins_rate_limit(), 10)
+        nose.tools.assert_equal(self.esl.get_jenkins_heavy_rate_limit(), 0.5)
+        mock_limit.assert_called_once_with(self.esl.server._session, 'jenkins_url', 10, 0.5)
+        # Not limited unless configured to be
+        with unittest.mock.patch.dict('os.environ', {'JENKINS_URL': 'jenkins_url'}), \
+                unittest.mock.patch('es_logger.ratelimit.limit_session') as mock_limit:
+            self.esl = es_logger.EsLogger(1000, ['dummy'])
+        mock_limit.assert_not_called()
+
+    def test_config(self):
+        # Settings passed in take precedence over the environment
+        with unittest.mock.patch.dict('os.environ', {'JENKINS_URL': 'env_url',
+                                                     'JENKINS_USER': 'env_user'}):
+            self.esl = es_logger.EsLogger(1000, ['dummy'], config={'JENKINS_URL': 'config_url'})
+            nose.tools.assert_equal(self.esl.get_jenkins_url(), 'config_url')
+            nose.tools.assert_equal(self.esl.get_jenkins_user(), 'env_user')
+            nose.tools.assert_equal(self.esl.get_setting('ES_BUILD_NUMBER', '0'), '0')
+        # And passed on to the targets, including those that don't take the config when created
+        nose.tools.assert_equal(self.esl.targets[0].driver.get_setting('JENKINS_URL'), 'config_url')
+
+    def test_load_target(self):
+        es_logger.registry.invalidate()
+        dummy_ep = importlib.metadata.EntryPoint(
+            'dummy', 'test.test_plugins:DummyConfigEventTarget', 'es_logger.plugins.event_target')
+        ExtensionManager.ENTRY_POINT_CACHE = {'es_logger.plugins.event_target': [dummy_ep]}
+        self.esl.config = {'JENKINS_URL': 'config_url'}
+        es_logger.registry.get_plugin_class('es_logger.plugins.event_target', 'dummy')
+        with unittest.mock.patch('stevedore.driver.DriverManager',
+                                 wraps=driver.DriverManager) as mock_driver_mgr:
+            target = self.esl.load_target('dummy')
+        mock_driver_mgr.assert_called_once_with(
+            namespace='es_logger.plugins.event_target', invoke_on_load=True, name='dummy',
+            invoke_kwds={'config': {'JENKINS_URL': 'config_url'}})
+        nose.tools.assert_equal(target.driver.get_setting('JENKINS_URL'), 'config_url')
+
+    def get_build_data_es_info(self, collect_workers):
+        with unittest.mock.patch.dict(
+                'os.environ', {'JENKINS_URL': 'jenkins_url', 'JENKINS_USER': 'jenkins_user',
+                               'JENKINS_PASSWORD': 'jenkins_password', 'ES_JOB_NAME': 'es_job_name',
+                               'ES_BUILD_NUMBER': '2', 'ES_COLLECT_WORKERS': collect_workers}):
+            esl = es_logger.EsLogger(1000, ['dummy'])
+        with unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_env_vars') as mock_env_vars, \
+                unittest.mock.patch(
+                    'jenkins.Jenkins.get_build_console_output_stream') as mock_console, \
+                unittest.mock.patch('jenkins.Jenkins.get_job_config') as mock_config:
+            mock_env_vars.return_value = {'envMap': {'BUILD_NUMBER': '2'}}
+            mock_build_info.return_value = {
+                'number': '2',
+                'actions': [{'_class': 'hudson.model.ParametersAction',
+                             'parameters': [{'name': 'param', 'value': 'value'}]}]}
+            mock_console.return_value = iter(['log', '[2020-04-22T11:21:48.848Z] log2'])
+            mock_config.return_value = "<project></project>"
+            esl.get_build_data()
+            for mock_get in [mock_build_info, mock_env_vars, mock_console, mock_config]:
+                mock_get.assert_called_once()
+        nose.tools.ok_(esl.prefetched == {}, "Unused prefetch: {}".format(esl.prefetched))
+        return esl.es_info
+
+    def test_get_build_data_concurrent(self):
+        serial_info = self.get_build_data_es_info('0')
+        concurrent_info = self.get_build_data_es_info('4')
+        nose.tools.assert_equal(concurrent_info, serial_info)
+        nose.tools.ok_(concurrent_info['console_log'] == 'log\nlog2',
+                       "console_log not 'log\\nlog2': {}".format(concurrent_info))
+
+    @parameterized.expand([('get_build_info', 'get_build_info'),
+                           ('get_job_config', 'get_job_config'),
+                           ('get_build_env_vars', 'get_build_env_vars'),
+                           ('get_build_console_output_stream', 'get_build_console_output')])
+    def test_get_build_data_concurrent_error(self, param, error):
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
+        self.esl.collect_workers = 2
+        with unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_env_vars'), \
+                unittest.mock.patch('jenkins.Jenkins.get_build_console_output_stream'), \
+                unittest.mock.patch('jenkins.Jenkins.get_job_config') as mock_config:
+            mock_build_info.return_value = {'actions': []}
+            mock_config.return_value = None
+            with unittest.mock.patch('jenkins.Jenkins.' + param) as mock_error:
+                mock_error.side_effect = Exception("Wrap me")
+                with nose.tools.assert_raises(es_logger.JenkinsCollectError) as cm:
+                    self.esl.get_build_data()
+        nose.tools.assert_equal(str(cm.exception), error)
+
+    def test_get_es_info_data(self):
+        nose.tools.assert_equal(self.esl.get_es_info_data(),
+                                ['console_log', 'job_config', 'env_vars'])
+        with unittest.mock.patch.dict('os.environ', {'ES_INFO_DATA': 'console_log'}):
+            self.esl = es_logger.EsLogger(1000, ['dummy'])
+        nose.tools.assert_equal(self.esl.get_es_info_data(), ['console_log'])
+        with unittest.mock.patch.dict('os.environ', {'ES_INFO_DATA': ''}):
+            self.esl = es_logger.EsLogger(1000, ['dummy'])
+        nose.tools.assert_equal(self.esl.get_es_info_data(), [])
+
+    @parameterized.expand([
+        ('ansible_fatal', ['console_log', 'env_vars']),
+        ('ansible_recap_v2', ['console_log', 'env_vars']),
+        ('artifact_events', ['artifacts', 'env_vars']),
+        ('commit', ['env_vars']),
+        ('console_log_events', ['console_log', 'env_vars']),
+        ('junit', ['env_vars', 'test_report']),
+        ('stages', ['env_vars', 'stages'])])
+    def test_get_data_requirements_event_generator(self, plugin, expected):
+        self.esl.es_info_data = []
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = [plugin]
+        nose.tools.assert_equal(sorted(self.esl.get_data_requirements()), expected)
+
+    def test_get_data_requirements(self):
+        eps = {
+            'es_logger.plugins.console_log_processor': [importlib.metadata.EntryPoint(
+                'dummy', 'test.test_plugins:DummyConsoleLogProcessor',
+                'es_logger.plugins.console_log_processor')],
+            'es_logger.plugins.gather_build_data': [importlib.metadata.EntryPoint(
+                'dummy', 'test.test_plugins:DummyGatherBuildData',
+                'es_logger.plugins.gather_build_data')]}
+        ExtensionManager.ENTRY_POINT_CACHE.update(eps)
+        self.esl.es_info_data = ['job_config']
+        self.esl.process_console_logs = ['dummy']
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
+        nose.tools.assert_equal(self.esl.get_data_requirements(), {'console_log', 'job_config'})
+        # Resolved once for the build
+        self.esl.gather_build_data = ['dummy']
+        nose.tools.assert_equal(self.esl.get_data_requirements(), {'console_log', 'job_config'})
+        self.esl.data_requirements = None
+        nose.tools.assert_equal(self.esl.get_data_requirements(),
+                                set(es_logger.interface.DATA_SOURCES))
+
+    @parameterized.expand([('0',), ('4',)])
+    def test_get_build_data_not_required(self, collect_workers):
+        with unittest.mock.patch.dict(
+                'os.environ', {'JENKINS_URL': 'jenkins_url', 'ES_JOB_NAME': 'es_job_name',
+                               'ES_BUILD_NUMBER': '2', 'ES_INFO_DATA': '',
+                               'ES_NO_COMMIT_EVENTS': '1', 'ES_COLLECT_WORKERS': collect_workers}):
+            esl = es_logger.EsLogger(1000, ['dummy'])
+        with unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_env_vars') as mock_env_vars, \
+                unittest.mock.patch(
+                    'jenkins.Jenkins.get_build_console_output_stream') as mock_console, \
+                unittest.mock.patch('jenkins.Jenkins.get_job_config') as mock_config:
+            mock_build_info.return_value = {'number': '2', 'actions': []}
+            esl.get_build_data()
+            mock_build_info.assert_called_once()
+            for mock_get in [mock_env_vars, mock_console, mock_config]:
+                mock_get.assert_not_called()
+        nose.tools.ok_(esl.es_info['job_config_info'] is None)
+        nose.tools.assert_equal(esl.es_info['job_config_info_status'], "Not required.")
+        nose.tools.ok_(esl.es_info['env_vars'] is None)
+        nose.tools.ok_('console_log' not in esl.es_info,
+                       "console_log fetched: {}".format(esl.es_info))
+
+    def test_get_build_data_prefetch_plugin_data(self):
+        with unittest.mock.patch.dict(
+                'os.environ', {'JENKINS_URL': 'jenkins_url', 'ES_JOB_NAME': 'es_job_name',
+                               'ES_BUILD_NUMBER': '2', 'ES_INFO_DATA': '',
+                               'GENERATE_EVENTS': 'junit stages', 'ES_NO_COMMIT_EVENTS': '1',
+                               'ES_COLLECT_WORKERS': '4'}):
+            esl = es_logger.EsLogger(1000, ['dummy'])
+        with unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_env_vars') as mock_env_vars, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_test_report') as mock_report, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_stages') as mock_stages:
+            mock_build_info.return_value = {'number': '2', 'actions': []}
+            mock_report.return_value = {'report': True}
+            mock_stages.return_value = {'stages': True}
+            esl.get_build_data()
+            nose.tools.assert_equal(esl.get_test_report(), {'report': True})
+            nose.tools.assert_equal(esl.get_stages(), {'stages': True})
+            for mock_get in [mock_build_info, mock_env_vars, mock_report, mock_stages]:
+                mock_get.assert_called_once()
+        nose.tools.ok_(esl.prefetched == {}, "Unused prefetch: {}".format(esl.prefetched))
+
     def test_get_pipeline_job_type_script(self):
         script = "org.jenkinsci.plugins.workflow.cps.CpsFlowDefinition"
 
@@ -633,17 +831,306 @@ es_logger.plugins.event_target:
     def test_process_console_log(self):
         self.esl.process_console_logs = ['dummy']
         with unittest.mock.patch('stevedore.driver.DriverManager') as mock_driver_mgr:
-            with unittest.mock.patch('jenkins.Jenkins.get_build_console_output') as mock_get:
-                mock_get.return_value = 'log\n[2020-04-22T11:21:48.848Z] log2 words\nlog3'
+            # The processor is instantiated for each build
+            mock_processor = mock_driver_mgr.return_value.driver.return_value
+            mock_processor.streaming = False
+            mock_processor.process.return_value = {'dummy': True}
+            with unittest.mock.patch(
+                    'jenkins.Jenkins.get_build_console_output_stream') as mock_get:
+                mock_get.return_value = iter(['log', '[2020-04-22T11:21:48.848Z] log2 words',
+                                              'log3'])
                 self.esl.process_console_log()
                 mock_driver_mgr.assert_called_once()
+                mock_processor.process.assert_called_once_with('log\nlog2 words\nlog3')
+                nose.tools.assert_equal(self.esl.es_info['console_log_plugins'],
+                                        {'dummy': {'dummy': True}})
                 self.esl.console_length = 1
-                mock_get.return_value = 'log\nlog2 words\nlog3'
+                mock_get.return_value = iter(['log', 'log2 words', 'log3'])
                 self.esl.process_console_log()
                 nose.tools.ok_(len(self.esl.es_info['console_log']) == 1,
                                "Console log length not 1: {}".format(
                                     self.esl.es_info['console_log']))
 
+    def test_process_console_log_streaming(self):
+        dummy_ep = importlib.metadata.EntryPoint(
+            'dummy', 'test.test_plugins:DummyStreamingConsoleLogProcessor',
+            'es_logger.plugins.console_log_processor')
+        ExtensionManager.ENTRY_POINT_CACHE = {'es_logger.plugins.console_log_processor': [dummy_ep]}
+        self.esl.process_console_logs = ['dummy']
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
+        nose.tools.ok_(not self.esl.console_log_required())
+        with unittest.mock.patch('jenkins.Jenkins.get_build_console_output_stream') as mock_get:
+            mock_get.return_value = iter(['log', '[2020-04-22T11:21:48.848Z] log2', 'log3'])
+            self.esl.process_console_log()
+        nose.tools.assert_equal(self.esl.es_info['console_log_plugins'],
+                                {'dummy': {'DummyStreamingConsoleLogProcessor': 3}})
+        # Only the tail is kept when nothing needs the full console log
+        nose.tools.ok_(self.esl.console_log is None,
+                       "console_log kept: {}".format(self.esl.console_log))
+
+    @parameterized.expand([(1000,), (0,), (1,), (5,), (6,), (7,), (14,), (15,), (16,), (100,)])
+    def test_process_console_log_tail(self, console_length):
+        # The tail and length must match those of the full console log
+        self.esl.process_console_logs = []
+        lines = ['first', '', '[2020-04-22T11:21:48.848Z] second', 'third line', '', '']
+        console_log = '\n'.join(['first', '', 'second', 'third line', '', ''])
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
+        self.esl.console_length = console_length
+        with unittest.mock.patch('jenkins.Jenkins.get_build_console_output_stream') as mock_get:
+            mock_get.return_value = iter(lines)
+            self.esl.process_console_log()
+        nose.tools.assert_equal(self.esl.es_info['console_log_length'], len(console_log))
+        if len(console_log) > console_length:
+            expected = console_log[-console_length:]
+        else:
+            expected = console_log
+        nose.tools.assert_equal(self.esl.es_info['console_log'], expected)
+
+    def test_console_log_required(self):
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = ['console_log_events']
+        nose.tools.ok_(self.esl.console_log_required())
+        # Generators that don't read the console log don't need all of it
+        self.esl.generate_events = ['commit']
+        nose.tools.ok_(not self.esl.console_log_required())
+        self.esl.generate_events = []
+        nose.tools.ok_(not self.esl.console_log_required())
+        self.esl.console_log_processors = {'dummy': unittest.mock.MagicMock(streaming=False)}
+        nose.tools.ok_(self.esl.console_log_required())
+
+    def test_console_log_required_gatherer(self):
+        dummy_ep = importlib.metadata.EntryPoint(
+            'dummy', 'test.test_plugins:DummyGatherBuildData',
+            'es_logger.plugins.gather_build_data')
+        ExtensionManager.ENTRY_POINT_CACHE = {'es_logger.plugins.gather_build_data': [dummy_ep]}
+        self.esl.process_console_logs = []
+        self.esl.generate_events = []
+        # Gatherers are passed this object, and may read the full console log
+        self.esl.gather_build_data = ['dummy']
+        nose.tools.ok_(self.esl.console_log_required())
+        with unittest.mock.patch('jenkins.Jenkins.get_build_console_output_stream') as mock_get:
+            mock_get.return_value = iter(['log', 'log2'])
+            self.esl.process_console_log()
+        nose.tools.assert_equal(self.esl.console_log, 'log\nlog2')
+
+    def mock_console_response(self, chunks, encoding='utf-8'):
+        response = unittest.mock.MagicMock(spec=requests.Response)
+        response.encoding = encoding
+        response.iter_content.return_value = iter(chunks)
+        return response
+
+    @parameterized.expand([
+        (['line1\nline2\n'],),
+        (['li', 'ne1\r', '\nline2\n', '\n', 'last'],),
+        (['line1\r', 'line2\r\n\r\n', 'line3\x0c', 'line4'],),
+        (['\n\n', 'a\r'],),
+        ([],)])
+    def test_get_build_console_output_stream(self, chunks):
+        self.esl.server.crumb = False
+        self.esl.server.server = 'http://jenkins_url/'
+        with unittest.mock.patch.object(self.esl.server._session, 'send') as mock_send:
+            mock_send.return_value = self.mock_console_response(chunks)
+            lines = list(self.esl.server.get_build_console_output_stream('job_name', 1))
+            request = mock_send.call_args[0][0]
+            nose.tools.assert_equal(request.url, 'http://jenkins_url/job/job_name/1/consoleText')
+            nose.tools.ok_(mock_send.call_args[1]['stream'])
+            mock_send.return_value.close.assert_called_once()
+        nose.tools.assert_equal(lines, ''.join(chunks).splitlines())
+
+    def test_get_build_console_output_stream_encoding(self):
+        self.esl.server.crumb = False
+        self.esl.server.server = 'http://jenkins_url/'
+        with unittest.mock.patch.object(self.esl.server._session, 'send') as mock_send:
+            mock_send.return_value = self.mock_console_response(['log'], encoding=None)
+            lines = list(self.esl.server.get_build_console_output_stream('job_name', 1))
+        nose.tools.assert_equal(mock_send.return_value.encoding, 'utf-8')
+        nose.tools.assert_equal(lines, ['log'])
+
+    @parameterized.expand([(404,), (500,)])
+    def test_get_build_console_output_stream_missing(self, status_code):
+        self.esl.server.crumb = False
+        self.esl.server.server = 'http://jenkins_url/'
+        with unittest.mock.patch.object(self.esl.server._session, 'send') as mock_send:
+            response = requests.Response()
+            response.status_code = status_code
+            mock_send.return_value = response
+            nose.tools.assert_raises(JenkinsException, list,
+                                     self.esl.server.get_build_console_output_stream('job', 1))
+
+    def test_get_build_console_output_size(self):
+        self.esl.server.crumb = False
+        with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_request') as mock_request:
+            mock_request.return_value.headers = {'X-Text-Size': '1234'}
+            size = self.esl.server.get_build_console_output_size('job_name', 1)
+            request = mock_request.call_args[0][0]
+        nose.tools.assert_equal(size, 1234)
+        nose.tools.assert_equal(request.method, 'HEAD')
+        nose.tools.assert_equal(request.url,
+                                'jenkins_url/job/job_name/1/logText/progressiveText?start=0')
+
+    @parameterized.expand([
+        (NotFoundException(),),
+        (requests.exceptions.HTTPError('url', 'code', 'msg', 'hdrs', unittest.mock.MagicMock()),),
+        ({},),
+        ({'X-Text-Size': 'lots'},)])
+    def test_get_build_console_output_size_error(self, param):
+        self.esl.server.crumb = False
+        with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_request') as mock_request:
+            if isinstance(param, Exception):
+                mock_request.side_effect = param
+            else:
+                mock_request.return_value.headers = param
+            nose.tools.assert_raises(JenkinsException,
+                                     self.esl.server.get_build_console_output_size, 'job', 1)
+
+    def test_get_build_console_output_from(self):
+        self.esl.server.crumb = False
+        with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_request') as mock_request:
+            # Start part way through a multi-byte character
+            mock_request.return_value.content = 'l\u00e9g\nlog2'.encode('utf-8')[2:]
+            text = self.esl.server.get_build_console_output_from('job_name', 1, 10)
+            request = mock_request.call_args[0][0]
+        nose.tools.assert_equal(text, '\ufffdg\nlog2')
+        nose.tools.assert_equal(request.method, 'GET')
+        nose.tools.assert_equal(request.url,
+                                'jenkins_url/job/job_name/1/logText/progressiveText?start=10')
+
+    @parameterized.expand([(NotFoundException(),),
+                           (requests.exceptions.HTTPError('url', 'code', 'msg', 'hdrs',
+                                                          unittest.mock.MagicMock()),)])
+    def test_get_build_console_output_from_missing(self, error):
+        self.esl.server.crumb = False
+        with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_request') as mock_request:
+            mock_request.side_effect = error
+            nose.tools.assert_raises(JenkinsException,
+                                     self.esl.server.get_build_console_output_from, 'job', 1, 0)
+
+    @parameterized.expand([(True, 'allBuilds'), (False, 'builds')])
+    def test_get_job_builds(self, all_builds, builds):
+        self.esl.server.crumb = False
+        with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_open') as mock_open:
+            mock_open.return_value = json.dumps({builds: [{'number': 2}, {'number': 1}]})
+            nose.tools.assert_equal(
+                self.esl.server.get_job_builds('folder/job_name', all_builds=all_builds),
+                [{'number': 2}, {'number': 1}])
+            request = mock_open.call_args[0][0]
+        nose.tools.assert_equal(
+            request.url, 'jenkins_url/job/folder/job/job_name/api/json?tree=' + builds +
+            '[number,building,result,timestamp,duration]')
+
+    def test_get_job_builds_range(self):
+        self.esl.server.crumb = False
+        with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_open') as mock_open:
+            mock_open.return_value = json.dumps({'allBuilds': [{'number': 2}]})
+            nose.tools.assert_equal(self.esl.server.get_job_builds('job_name', start=100, end=200),
+                                    [{'number': 2}])
+            request = mock_open.call_args[0][0]
+        nose.tools.assert_equal(
+            request.url, 'jenkins_url/job/job_name/api/json?tree=allBuilds' +
+            '[number,building,result,timestamp,duration]{100,200}')
+
+    @parameterized.expand([({'return_value': None},),
+                           ({'return_value': '{}'},),
+                           ({'return_value': 'not json'},),
+                           ({'side_effect': NotFoundException()},),
+                           ({'side_effect': requests.exceptions.HTTPError(
+                               'url', 'code', 'msg', 'hdrs', unittest.mock.MagicMock())},)])
+    def test_get_job_builds_error(self, response):
+        self.esl.server.crumb = False
+        with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_open', **response):
+            nose.tools.assert_raises(JenkinsException, self.esl.server.get_job_builds, 'job')
+
+    def test_get_console_tail_only(self):
+        nose.tools.ok_(not self.esl.get_console_tail_only())
+        with unittest.mock.patch.dict('os.environ', {'ES_CONSOLE_TAIL_ONLY': ''}):
+            self.esl = es_logger.EsLogger(1000, ['dummy'])
+        nose.tools.ok_(self.esl.get_console_tail_only())
+
+    def test_get_console_log_reader(self):
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
+        nose.tools.assert_equal(self.esl.get_console_log_reader(), self.esl.read_console_log)
+        self.esl.console_tail_only = True
+        nose.tools.assert_equal(self.esl.get_console_log_reader(), self.esl.read_console_log_tail)
+        # Streaming processors still need every line of the console log
+        ExtensionManager.ENTRY_POINT_CACHE = {
+            'es_logger.plugins.console_log_processor': [importlib.metadata.EntryPoint(
+                'dummy', 'test.test_plugins:DummyStreamingConsoleLogProcessor',
+                'es_logger.plugins.console_log_processor')],
+            'es_logger.plugins.gather_build_data': [importlib.metadata.EntryPoint(
+                'dummy', 'test.test_plugins:DummyGatherBuildData',
+                'es_logger.plugins.gather_build_data')]}
+        self.esl.process_console_logs = ['dummy']
+        nose.tools.assert_equal(self.esl.get_console_log_reader(), self.esl.read_console_log)
+        self.esl.process_console_logs = []
+        self.esl.generate_events = ['console_log_events']
+        nose.tools.assert_equal(self.esl.get_console_log_reader(), self.esl.read_console_log)
+        self.esl.generate_events = []
+        nose.tools.assert_equal(self.esl.get_console_log_reader(), self.esl.read_console_log_tail)
+        self.esl.gather_build_data = ['dummy']
+        nose.tools.assert_equal(self.esl.get_console_log_reader(), self.esl.read_console_log)
+
+    @parameterized.expand([(1000, 1), (0, 1), (1, 2), (10, 2), (30, 3), (45, 3)])
+    def test_process_console_log_tail_only(self, console_length, requests_made):
+        lines = ['first', '[2020-04-22T11:21:48.848Z] s\u00e9cond', 'third line'] + \
+            ['[2020-04-22T11:21:48.848Z] {}'.format(i) for i in range(20)] + ['last']
+        raw = '\n'.join(lines).encode('utf-8')
+        console_log = '\n'.join([self.esl.strip_timestamp(line) for line in lines])
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
+        self.esl.console_tail_only = True
+        self.esl.console_length = console_length
+        with unittest.mock.patch('jenkins.Jenkins.get_build_console_output_size') as mock_size, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_console_output_from') as mock_from:
+            mock_size.return_value = len(raw)
+            mock_from.side_effect = lambda name, number, start: raw[start:].decode(
+                'utf-8', errors='replace')
+            self.esl.process_console_log()
+        nose.tools.assert_equal(mock_from.call_count, requests_made)
+        # The length is the size in bytes of the log from Jenkins
+        nose.tools.assert_equal(self.esl.es_info['console_log_length'], len(raw))
+        if console_length > 0:
+            expected = console_log[-console_length:]
+        else:
+            expected = console_log
+        nose.tools.assert_equal(self.esl.es_info['console_log'], expected)
+        nose.tools.ok_(self.esl.console_log is None,
+                       "console_log kept: {}".format(self.esl.console_log))
+
+    def test_read_console_log_tail_error(self):
+        with unittest.mock.patch('jenkins.Jenkins.get_build_console_output_size') as mock_size, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_console_output_from') as mock_from:
+            mock_size.return_value = 100
+            mock_from.side_effect = Exception("Wrap me")
+            with nose.tools.assert_raises(es_logger.JenkinsCollectError) as cm:
+                self.esl.read_console_log_tail()
+        nose.tools.assert_equal(str(cm.exception), 'get_build_console_output')
+
+    def test_read_console_log_tail_no_size(self):
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
+        self.esl.console_length = 5
+        with unittest.mock.patch('jenkins.Jenkins.get_build_console_output_size') as mock_size, \
+                unittest.mock.patch('jenkins.Jenkins.get_build_console_output_from') as mock_from, \
+                unittest.mock.patch(
+                    'jenkins.Jenkins.get_build_console_output_stream') as mock_stream:
+            mock_size.side_effect = JenkinsException('Could not get console size')
+            mock_stream.return_value = iter(['first', 'last'])
+            with nose.tools.assert_logs('es_logger', level='WARNING') as cm:
+                result = self.esl.read_console_log_tail()
+        # Falls back to streaming the whole console log
+        nose.tools.assert_equal(result, ('first\nlast', 10))
+        mock_from.assert_not_called()
+        nose.tools.assert_equal(cm.output, [
+            'WARNING:es_logger:Unable to get the console log size, reading all of it: '
+            'Could not get console size'])
+
     # Tested in get_events
     def test_get_event_info(self):
         pass
@@ -686,19 +1173,77 @@ es_logger.plugins.event_target:
                                         self.esl.events[count]['build_info'][field], count,
                                         self.esl.events[count][field]))
 
+    def test_get_generate_workers(self):
+        nose.tools.ok_(self.esl.get_generate_workers() == 0,
+                       "generate_workers not 0: {}".format(self.esl.get_generate_workers()))
+        with unittest.mock.patch.dict('os.environ', {'ES_GENERATE_WORKERS': '4'}):
+            self.esl = es_logger.EsLogger(1000, ['dummy'])
+        nose.tools.ok_(self.esl.get_generate_workers() == 4,
+                       "generate_workers not 4: {}".format(self.esl.get_generate_workers()))
+
+    def get_events_mock_generators(self, generate_workers, fail=None):
+        self.esl.generate_workers = generate_workers
+        self.esl.generate_events = ['gen{}'.format(i) for i in range(5)]
+        self.esl.es_info['env_vars'] = None
+        self.esl.es_info['build_info'] = {'number': '1', 'timestamp': 1}
+        generators = {}
+        for i, plugin in enumerate(self.esl.generate_events):
+            generators[plugin] = unittest.mock.MagicMock()
+            generators[plugin].get_fields.return_value = []
+            if plugin == fail:
+                generators[plugin].generate_events.side_effect = Exception("Generator failed")
+            else:
+                generators[plugin].generate_events.return_value = [{'event': n} for n in range(i)]
+        with unittest.mock.patch('es_logger.registry.get_plugin') as mock_get_plugin:
+            mock_get_plugin.side_effect = lambda namespace, name: generators[name]
+            self.esl.get_events()
+        return self.esl.events
+
+    def test_get_events_parallel(self):
+        serial_events = self.get_events_mock_generators(0)
+        self.esl.events = []
+        parallel_events = self.get_events_mock_generators(3)
+        nose.tools.assert_equal(len(parallel_events), 10)
+        nose.tools.assert_equal(parallel_events, serial_events)
+        nose.tools.ok_('event_generator_errors' not in self.esl.es_info)
+
+    def test_get_events_parallel_error(self):
+        nose.tools.assert_raises(Exception, self.get_events_mock_generators, 0, 'gen2')
+        self.esl.events = []
+        events = self.get_events_mock_generators(3, 'gen2')
+        # The other generators' events are kept, in order
+        nose.tools.assert_equal([list(event.keys())[0] for event in events],
+                                ['gen1', 'gen3', 'gen3', 'gen3', 'gen4', 'gen4', 'gen4', 'gen4'])
+        nose.tools.assert_equal(self.esl.es_info['event_generator_errors'],
+                                {'gen2': 'Exception: Generator failed'})
+
     def test_gather_all(self):
         with unittest.mock.patch('es_logger.EsLogger.get_build_data') as mock_get_build_data, \
-                unittest.mock.patch('es_logger.EsLogger.get_events') as mock_get_events:
+                unittest.mock.patch('es_logger.EsLogger.get_events') as mock_get_events, \
+                unittest.mock.patch('es_logger.metrics.STAGE_SECONDS') as mock_stage:
             self.esl.gather_all()
             mock_get_build_data.assert_called_once()
             mock_get_events.assert_called_once()
+        nose.tools.assert_equal(mock_stage.time.call_args_list,
+                                [unittest.mock.call(stage='gather'),
+                                 unittest.mock.call(stage='generate')])
 
     def test_post_all(self):
         with unittest.mock.patch('es_logger.EsLogger.post') as mock_post, \
-                unittest.mock.patch('es_logger.EsLogger.finish') as mock_finish:
+                unittest.mock.patch('es_logger.EsLogger.finish') as mock_finish, \
+                unittest.mock.patch('es_logger.metrics.STAGE_SECONDS') as mock_stage:
             self.esl.post_all()
             mock_post.assert_called_once()
             mock_finish.assert_called_once()
+        mock_stage.time.assert_called_once_with(stage='post')
+
+    def test_timed_request(self):
+        func = unittest.mock.MagicMock(return_value='info')
+        with unittest.mock.patch('es_logger.metrics.JENKINS_REQUEST_SECONDS') as mock_seconds:
+            nose.tools.assert_equal(
+                self.esl.timed_request('get_build_info', func, 'job', 1, depth=0), 'info')
+        func.assert_called_once_with('job', 1, depth=0)
+        mock_seconds.time.assert_called_once_with(request='get_build_info')
 
     def test_get_test_report(self):
         with unittest.mock.patch('jenkins.Jenkins.get_build_test_report') as mock_get:
@@ -726,8 +1271,10 @@ es_logger.plugins.event_target:
         nose.tools.ok_(status == 0)
 
     def test_post_bad(self):
-        status = self.esl.post(None)
+        with unittest.mock.patch('es_logger.metrics.TARGET_ERRORS') as mock_errors:
+            status = self.esl.post(None)
         nose.tools.ok_(status == 1)
+        mock_errors.inc.assert_called_once_with(1, target='dummy')
 
     def test_finish(self):
         status = self.esl.finish()
@@ -736,13 +1283,20 @@ es_logger.plugins.event_target:
     def test_finish_bad(self):
         mock_target = unittest.mock.MagicMock()
         mock_target.driver.finish_send.return_value = 1
+        mock_target.names.return_value = ['logstash']
         self.esl.targets = [mock_target, mock_target]
-        status = self.esl.finish()
+        with unittest.mock.patch('es_logger.metrics.TARGET_ERRORS') as mock_errors:
+            status = self.esl.finish()
         nose.tools.ok_(status == 2)
+        mock_errors.inc.assert_called_with(1, target='logstash')
+        nose.tools.assert_equal(mock_errors.inc.call_count, 2)
 
     @parameterized.expand(['get_build_data', 'process_console_log', 'get_test_report',
                            'get_stages'])
     def test_exception_wraps(self, param):
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
         with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_open') as mock_open:
             mock_open.return_value = None
             self.esl.server.crumb = False
@@ -752,6 +1306,9 @@ es_logger.plugins.event_target:
     # Needs a slightly different flow because 2nd call in the get_build_data function
     # Although the same outcome, ensures coverage, so is testing the right spot
     def test_exception_wraps_get_build_data(self):
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
         with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_open') as mock_open, \
                 unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info:
             mock_build_info.return_value = {}
@@ -762,6 +1319,9 @@ es_logger.plugins.event_target:
     # Needs a slightly different flow because get_job_config needs to throw a non-Jenkins error
     # Although the same outcome, ensures coverage, so is testing the right spot
     def test_exception_wraps_get_job_config(self):
+        self.esl.process_console_logs = []
+        self.esl.gather_build_data = []
+        self.esl.generate_events = []
         with unittest.mock.patch('es_logger.jenkins.Jenkins.jenkins_open') as mock_open, \
                 unittest.mock.patch('jenkins.Jenkins.get_build_info') as mock_build_info:
             mock_build_info.return_value = {}
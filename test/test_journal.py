@@ -0,0 +1,134 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import es_logger.journal
+import nose
+import os
+import tempfile
+import unittest.mock
+
+
+class TestJournal(object):
+    def setup(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_encode_message(self):
+        msg = [b'first', b'\x00\xff']
+        nose.tools.assert_equal(
+            es_logger.journal.decode_message(es_logger.journal.encode_message(msg)), msg)
+
+    def test_spill_file(self):
+        path = os.path.join(self.tmp_dir.name, 'spill.jsonl')
+        spill = es_logger.journal.SpillFile(path)
+        nose.tools.assert_equal(len(spill), 0)
+        spill.append([b'first', b'\x00\xff'])
+        spill.append([b'second'])
+        spill.append([b'third'])
+        nose.tools.assert_equal(len(spill), 3)
+        nose.tools.assert_equal(spill.pop(), [b'first', b'\x00\xff'])
+        # Only the messages not yet read back are found again by a new daemon
+        spill = es_logger.journal.SpillFile(path)
+        nose.tools.assert_equal(len(spill), 2)
+        nose.tools.assert_equal(spill.pop(), [b'second'])
+        nose.tools.assert_equal(spill.pop(), [b'third'])
+        nose.tools.assert_equal(len(spill), 0)
+        nose.tools.ok_(not os.path.exists(path))
+        nose.tools.ok_(not os.path.exists(spill.offset_path))
+        spill.append([b'again'])
+        nose.tools.assert_equal(spill.pop(), [b'again'])
+
+    def test_spill_file_stale_offset(self):
+        path = os.path.join(self.tmp_dir.name, 'spill.jsonl')
+        # An offset left from a spill file that was removed
+        with open(path + '.offset', 'w') as offset:
+            offset.write('100')
+        spill = es_logger.journal.SpillFile(path)
+        nose.tools.assert_equal(len(spill), 0)
+        nose.tools.ok_(not os.path.exists(spill.offset_path))
+        # An offset past every message in the file, e.g. after a crash
+        spill.append([b'first'])
+        spill.append([b'second'])
+        spill.read_offset = os.path.getsize(path)
+        spill.save_offset()
+        nose.tools.assert_equal(len(es_logger.journal.SpillFile(path)), 0)
+        nose.tools.ok_(not os.path.exists(path))
+        nose.tools.ok_(not os.path.exists(spill.offset_path))
+
+    def test_work_journal(self):
+        path = os.path.join(self.tmp_dir.name, 'journal.db')
+        journal = es_logger.journal.WorkJournal(path)
+        nose.tools.assert_equal(journal.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        nose.tools.ok_(journal.add('job', 1, [b'one']))
+        nose.tools.ok_(journal.add('job', '2', [b'two']))
+        nose.tools.ok_(journal.add('other', 1, [b'three']))
+        # The same build is only recorded once
+        nose.tools.ok_(not journal.add('job', '1', [b'one again']))
+        nose.tools.assert_equal(len(journal), 3)
+        journal.complete('job', '2')
+        nose.tools.assert_equal(journal.pending(), [[b'one'], [b'three']])
+        journal.close()
+        # Unfinished builds are found again by a new daemon
+        journal = es_logger.journal.WorkJournal(path)
+        nose.tools.assert_equal(journal.pending(), [[b'one'], [b'three']])
+        journal.complete('job', 1)
+        journal.complete('other', 1)
+        nose.tools.assert_equal(len(journal), 0)
+        journal.close()
+
+    def test_work_journal_order(self):
+        journal = es_logger.journal.WorkJournal(os.path.join(self.tmp_dir.name, 'journal.db'))
+        with unittest.mock.patch('time.time', side_effect=[2.0, 1.0, 1.0]):
+            for i in range(3):
+                journal.add('job', i, [str(i).encode('ascii')])
+        nose.tools.assert_equal(journal.pending(), [[b'1'], [b'2'], [b'0']])
+        journal.close()
+
+    def test_work_journal_held(self):
+        journal = es_logger.journal.WorkJournal(os.path.join(self.tmp_dir.name, 'journal.db'))
+        for i in range(3):
+            journal.add('job', i, [str(i).encode('ascii')])
+        nose.tools.ok_(journal.hold('job', 1))
+        nose.tools.ok_(journal.hold('job', 2))
+        nose.tools.ok_(not journal.hold('job', 2))
+        nose.tools.ok_(not journal.hold('job', 3))
+        nose.tools.assert_equal(journal.take_held(1), [[b'1']])
+        nose.tools.assert_equal(journal.take_held(5), [[b'2']])
+        nose.tools.assert_equal(journal.take_held(5), [])
+        # Held builds are still pending, and are released on resuming
+        nose.tools.ok_(journal.hold('job', 0))
+        nose.tools.assert_equal(journal.pending(), [[b'0'], [b'1'], [b'2']])
+        journal.resume(2)
+        nose.tools.assert_equal(journal.take_held(5), [])
+        journal.close()
+
+    def test_work_journal_resume(self):
+        journal = es_logger.journal.WorkJournal(os.path.join(self.tmp_dir.name, 'journal.db'))
+        journal.add('job', 1, [b'one'])
+        nose.tools.assert_equal(journal.resume(2), (0, [[b'one']]))
+        journal.add('job', 2, [b'two'])
+        nose.tools.assert_equal(journal.resume(2), (0, [[b'one'], [b'two']]))
+        # Builds resumed max_resumes times without finishing are abandoned
+        nose.tools.assert_equal(journal.resume(2), (1, [[b'two']]))
+        nose.tools.assert_equal(journal.resume(2), (1, []))
+        journal.close()
+
+    def test_checkpoint(self):
+        path = os.path.join(self.tmp_dir.name, 'checkpoint.db')
+        checkpoint = es_logger.journal.Checkpoint(path)
+        nose.tools.assert_equal(checkpoint.builds(), {})
+        checkpoint.update('job', 2)
+        checkpoint.update('other', 7)
+        # The newest build is kept when an older one finishes after it
+        checkpoint.update('job', 1)
+        nose.tools.assert_equal(checkpoint.builds(), {'job': 2, 'other': 7})
+        checkpoint.update('job', 3)
+        nose.tools.assert_equal(len(checkpoint), 2)
+        checkpoint.close()
+        checkpoint = es_logger.journal.Checkpoint(path)
+        nose.tools.assert_equal(checkpoint.builds(), {'job': 3, 'other': 7})
+        checkpoint.close()
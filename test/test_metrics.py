@@ -0,0 +1,96 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import es_logger.metrics
+import nose
+import unittest.mock
+import urllib.request
+
+
+class TestMetrics(object):
+    def setup(self):
+        self.registry = es_logger.metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('test_total', 'A counter', ['target'])
+        counter.inc(target='logstash')
+        counter.inc(2, target='logstash')
+        counter.inc(target='sqs')
+        nose.tools.assert_equal(
+            self.registry.render(),
+            '# HELP test_total A counter\n'
+            '# TYPE test_total counter\n'
+            'test_total{target="logstash"} 3\n'
+            'test_total{target="sqs"} 1\n')
+
+    def test_wrong_labels(self):
+        counter = self.registry.counter('test_total', 'A counter', ['target'])
+        nose.tools.assert_raises(ValueError, counter.inc)
+        nose.tools.assert_raises(ValueError, counter.inc, phase='STARTED')
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('test_depth', 'A gauge')
+        nose.tools.assert_equal(gauge.samples(), [])
+        gauge.set(5)
+        nose.tools.assert_equal(gauge.samples(), [('', {}, 5)])
+        gauge.set_function(lambda: 7)
+        nose.tools.assert_equal(gauge.samples(), [('', {}, 7)])
+        gauge.set_function(None)
+        nose.tools.assert_equal(
+            self.registry.render(),
+            '# HELP test_depth A gauge\n'
+            '# TYPE test_depth gauge\n'
+            'test_depth 5\n')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('test_seconds', 'A histogram', ['stage'],
+                                            buckets=[1, 0.5])
+        histogram.observe(0.25, stage='post')
+        histogram.observe(0.75, stage='post')
+        histogram.observe(2, stage='post')
+        nose.tools.assert_equal(
+            self.registry.render(),
+            '# HELP test_seconds A histogram\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{stage="post",le="0.5"} 1\n'
+            'test_seconds_bucket{stage="post",le="1"} 2\n'
+            'test_seconds_bucket{stage="post",le="+Inf"} 3\n'
+            'test_seconds_sum{stage="post"} 3.0\n'
+            'test_seconds_count{stage="post"} 3\n')
+
+    @unittest.mock.patch('time.monotonic', side_effect=[10.0, 12.5, 20.0, 21.0])
+    def test_histogram_time(self, mock_monotonic):
+        histogram = self.registry.histogram('test_seconds', 'A histogram')
+        with histogram.time():
+            pass
+        # Recorded even when the body raises
+        with nose.tools.assert_raises(KeyError):
+            with histogram.time():
+                raise KeyError()
+        nose.tools.assert_equal(histogram.samples()[-2:],
+                                [('_sum', {}, 3.5), ('_count', {}, 2)])
+
+    def test_format_labels(self):
+        nose.tools.assert_equal(self.registry.format_labels({}), '')
+        nose.tools.assert_equal(self.registry.format_labels({'job': 'a"b\\c\nd', 'n': '1'}),
+                                '{job="a\\"b\\\\c\\nd",n="1"}')
+
+    def test_start_server(self):
+        es_logger.metrics.MESSAGES_RECEIVED.inc()
+        with nose.tools.assert_logs('es_logger.metrics', level='DEBUG') as cm:
+            server = es_logger.metrics.start_server('127.0.0.1', 0)
+            try:
+                url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+                with urllib.request.urlopen(url) as response:
+                    content_type = response.headers['Content-Type']
+                    body = response.read().decode('utf-8')
+            finally:
+                server.shutdown()
+                server.server_close()
+        nose.tools.assert_equal(content_type, 'text/plain; version=0.0.4; charset=utf-8')
+        nose.tools.ok_('# TYPE es_logger_messages_received_total counter\n' in body)
+        nose.tools.assert_regex(cm.output[0],
+                                r'INFO:es_logger.metrics:Serving metrics on 127.0.0.1:\d+')
+        nose.tools.assert_regex(cm.output[1], r'DEBUG:es_logger.metrics:.*"GET /metrics')
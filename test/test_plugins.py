@@ -5,6 +5,8 @@ __author__ = 'jonpsull'
 
 import es_logger.interface
 import nose
+import threading
+import unittest.mock
 
 
 class DummyConsoleLogProcessor(es_logger.interface.ConsoleLogProcessor):
@@ -15,6 +17,25 @@ class DummyConsoleLogProcessor(es_logger.interface.ConsoleLogProcessor):
         return {'DummyConsoleLogProcessor': True}
 
 
+class DummyStreamingConsoleLogProcessor(es_logger.interface.ConsoleLogProcessor):
+    streaming = True
+
+    def __init__(self):
+        super().__init__()
+        self.lines = 0
+
+    def process(self, console_log):
+        for line in console_log.splitlines():
+            self.process_line(line)
+        return self.finish_process()
+
+    def process_line(self, line):
+        self.lines += 1
+
+    def finish_process(self):
+        return {'DummyStreamingConsoleLogProcessor': self.lines}
+
+
 class DummyGatherBuildData(es_logger.interface.GatherBuildData):
     def __init__(self):
         super().__init__()
@@ -51,21 +72,38 @@ Dummy Target Environment Variables:
         return 0
 
 
+class DummyConfigEventTarget(DummyEventTarget):
+    def __init__(self, config=None):
+        es_logger.interface.EventTarget.__init__(self, config)
+
+
 class TestPlugins(object):
 
     def test_console_log_processor_plugins(self):
         clp = DummyConsoleLogProcessor()
         clp.process('log')
+        nose.tools.ok_(not clp.streaming)
+        clp.process_line('log')
+        clp.finish_process()
+        nose.tools.assert_equal(clp.get_requirements(), [es_logger.interface.CONSOLE_LOG])
+
+    def test_streaming_console_log_processor_plugins(self):
+        clp = DummyStreamingConsoleLogProcessor()
+        nose.tools.ok_(clp.streaming)
+        ret = clp.process('log\nlog2')
+        nose.tools.assert_equal(ret, {'DummyStreamingConsoleLogProcessor': 2})
 
     def test_gather_build_data_plugins(self):
         gbd = DummyGatherBuildData()
         gbd.gather('log')
+        nose.tools.assert_equal(gbd.get_requirements(), es_logger.interface.DATA_SOURCES)
 
     def test_event_generator_plugins(self):
         eg = DummyEventGenerator()
         fields = eg.get_fields()
         nose.tools.ok_(fields == es_logger.interface.EventGenerator.DEFAULT_FIELDS)
         eg.generate_events({'es_logger': True})
+        nose.tools.assert_equal(eg.get_requirements(), es_logger.interface.DATA_SOURCES)
 
     def test_event_target_plugins(self):
         help_str = DummyEventTarget.get_help_string()
@@ -73,3 +111,60 @@ class TestPlugins(object):
         et = DummyEventTarget()
         et.send_event({'es_logger': True})
         et.finish_send()
+
+    @unittest.mock.patch.dict('os.environ', {'DUMMY_SERVER': 'env', 'DUMMY_USER': 'env'})
+    def test_event_target_get_setting(self):
+        et = DummyConfigEventTarget(config={'DUMMY_SERVER': 'config'})
+        nose.tools.assert_equal(et.get_setting('DUMMY_SERVER'), 'config')
+        nose.tools.assert_equal(et.get_setting('DUMMY_USER'), 'env')
+        nose.tools.assert_equal(et.get_setting('DUMMY_PASSWORD', 'default'), 'default')
+
+    def test_event_target_send_async(self):
+        et = DummyEventTarget()
+        send = unittest.mock.MagicMock(return_value=1)
+        # Sent directly without a window
+        nose.tools.assert_equal(et.send_async(send, 'event'), 1)
+        send.assert_called_once_with('event')
+        nose.tools.assert_equal(et.finish_send(), 0)
+
+        et.send_window = 2
+        lock = threading.Lock()
+        in_flight = []
+        most_in_flight = []
+        both_started = threading.Barrier(2)
+
+        def send_status(status):
+            with lock:
+                in_flight.append(status)
+                most_in_flight.append(len(in_flight))
+            # The first two are in flight together
+            if status < 2:
+                both_started.wait(timeout=5)
+            with lock:
+                in_flight.remove(status)
+            return status
+
+        for status in range(5):
+            nose.tools.assert_equal(et.send_async(send_status, status), 0)
+        nose.tools.assert_equal(et.finish_send(), 10)
+        nose.tools.assert_equal(max(most_in_flight), 2)
+        nose.tools.ok_(et.send_executor is None)
+        nose.tools.assert_equal(et.wait_sent(), 0)
+
+    def test_event_target_send_async_exception(self):
+        et = DummyEventTarget()
+        et.send_window = 2
+        sent = []
+
+        def send(status):
+            if status is None:
+                raise ValueError('send')
+            sent.append(status)
+            return status
+
+        for status in [1, None, 2, 3]:
+            et.send_async(send, status)
+        # The exception once all have been sent
+        nose.tools.assert_raises(ValueError, et.wait_sent)
+        nose.tools.assert_equal(sorted(sent), [1, 2, 3])
+        nose.tools.assert_equal(et.send_futures, [])
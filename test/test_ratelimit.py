@@ -0,0 +1,75 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import es_logger.ratelimit
+import nose
+import requests
+import unittest.mock
+
+
+class TestRateLimit(object):
+    def setup(self):
+        es_logger.ratelimit._BUCKETS.clear()
+
+    def tearDown(self):
+        es_logger.ratelimit._BUCKETS.clear()
+
+    @unittest.mock.patch('time.sleep')
+    @unittest.mock.patch('time.monotonic')
+    def test_token_bucket(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100.0
+        bucket = es_logger.ratelimit.TokenBucket(2)
+        nose.tools.assert_equal(bucket.capacity, 2)
+        # The burst is free, then callers wait their turn
+        nose.tools.assert_equal([bucket.acquire() for i in range(4)], [0, 0, 0.5, 1.0])
+        nose.tools.assert_equal(mock_sleep.call_args_list,
+                                [unittest.mock.call(0.5), unittest.mock.call(1.0)])
+        # Refilled over time, up to the capacity
+        mock_monotonic.return_value = 111.0
+        nose.tools.assert_equal(bucket.acquire(), 0)
+        nose.tools.assert_equal(bucket.tokens, 1)
+
+    @unittest.mock.patch('time.sleep')
+    @unittest.mock.patch('time.monotonic', return_value=100.0)
+    def test_token_bucket_slow(self, mock_monotonic, mock_sleep):
+        bucket = es_logger.ratelimit.TokenBucket(0.5, burst=2)
+        nose.tools.assert_equal([bucket.acquire() for i in range(3)], [0, 0, 2.0])
+
+    def test_get_bucket(self):
+        nose.tools.ok_(es_logger.ratelimit.get_bucket('jenkins', None) is None)
+        nose.tools.ok_(es_logger.ratelimit.get_bucket('jenkins', 0) is None)
+        bucket = es_logger.ratelimit.get_bucket('jenkins', 5)
+        nose.tools.ok_(es_logger.ratelimit.get_bucket('jenkins', 5) is bucket)
+        nose.tools.ok_(es_logger.ratelimit.get_bucket('jenkins_heavy', 5) is not bucket)
+        nose.tools.assert_equal(bucket.rate, 5)
+
+    @unittest.mock.patch('requests.adapters.HTTPAdapter.send')
+    def test_adapter(self, mock_send):
+        bucket = unittest.mock.MagicMock()
+        heavy_bucket = unittest.mock.MagicMock()
+        adapter = es_logger.ratelimit.RateLimitAdapter(bucket, heavy_bucket)
+        for url in ['https://jenkins/job/a/1/api/json', 'https://jenkins/job/a/1/consoleText',
+                    'https://jenkins/job/a/1/testReport/api/json?depth=0']:
+            request = requests.Request('GET', url).prepare()
+            nose.tools.ok_(adapter.send(request, timeout=5) is mock_send.return_value)
+            mock_send.assert_called_with(request, timeout=5)
+        nose.tools.assert_equal(bucket.acquire.call_count, 3)
+        nose.tools.assert_equal(heavy_bucket.acquire.call_count, 2)
+
+    @unittest.mock.patch('requests.adapters.HTTPAdapter.send')
+    def test_adapter_unlimited(self, mock_send):
+        adapter = es_logger.ratelimit.RateLimitAdapter()
+        request = requests.Request('GET', 'https://jenkins/job/a/1/consoleText').prepare()
+        adapter.send(request)
+        mock_send.assert_called_once_with(request)
+
+    def test_limit_session(self):
+        session = requests.Session()
+        es_logger.ratelimit.limit_session(session, 'jenkins', 10, None)
+        adapter = session.get_adapter('https://jenkins.example.com/')
+        nose.tools.assert_is_instance(adapter, es_logger.ratelimit.RateLimitAdapter)
+        nose.tools.ok_(session.get_adapter('http://jenkins.example.com/') is adapter)
+        nose.tools.ok_(adapter.bucket is es_logger.ratelimit.get_bucket('jenkins', 10))
+        nose.tools.ok_(adapter.heavy_bucket is None)
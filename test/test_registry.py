@@ -0,0 +1,102 @@
+# Copyright (c) 2018 Cisco Systems, Inc.
+# All rights reserved.
+
+__author__ = 'jonpsull'
+
+import es_logger
+import importlib.metadata
+import nose
+import os
+from stevedore import driver, ExtensionManager
+import sys
+import tempfile
+import unittest.mock
+
+
+class TestRegistry(object):
+    def setup(self):
+        es_logger.registry.invalidate()
+
+    def tearDown(self):
+        es_logger.registry.invalidate()
+
+    def test_get_plugin_class(self):
+        with unittest.mock.patch('stevedore.driver.DriverManager',
+                                 wraps=driver.DriverManager) as mock_driver_mgr:
+            plugin_class = es_logger.registry.get_plugin_class(
+                'es_logger.plugins.event_generator', 'commit')
+            nose.tools.ok_(plugin_class is es_logger.plugins.commit.CommitEvent)
+            nose.tools.ok_(es_logger.registry.get_plugin_class(
+                'es_logger.plugins.event_generator', 'commit') is plugin_class)
+            mock_driver_mgr.assert_called_once()
+
+    def test_get_plugin(self):
+        with unittest.mock.patch('stevedore.driver.DriverManager',
+                                 wraps=driver.DriverManager) as mock_driver_mgr:
+            plugin = es_logger.registry.get_plugin('es_logger.plugins.event_generator', 'commit')
+            nose.tools.assert_is_instance(plugin, es_logger.plugins.commit.CommitEvent)
+            # Shared across builds
+            nose.tools.ok_(es_logger.registry.get_plugin(
+                'es_logger.plugins.event_generator', 'commit') is plugin)
+            mock_driver_mgr.assert_called_once()
+
+    def test_get_plugin_names(self):
+        with unittest.mock.patch('stevedore.ExtensionManager.names',
+                                 return_value=['ansible', 'es_logger']) as mock_names:
+            names = es_logger.registry.get_plugin_names(
+                'es_logger.plugins.event_generator.console_log_events')
+            names.append('modified')
+            names = es_logger.registry.get_plugin_names(
+                'es_logger.plugins.event_generator.console_log_events')
+            mock_names.assert_called_once()
+        nose.tools.assert_equal(names, ['ansible', 'es_logger'])
+
+    def test_invalidate(self):
+        plugin = es_logger.registry.get_plugin('es_logger.plugins.event_generator', 'commit')
+        nose.tools.ok_(len(ExtensionManager.ENTRY_POINT_CACHE) > 0)
+        es_logger.registry.invalidate()
+        nose.tools.assert_equal(ExtensionManager.ENTRY_POINT_CACHE, {})
+        nose.tools.ok_(es_logger.registry.get_plugin(
+            'es_logger.plugins.event_generator', 'commit') is not plugin)
+
+    def test_invalidate_reload_modules(self):
+        namespace = 'es_logger.plugins.event_generator'
+        with tempfile.TemporaryDirectory() as plugin_dir:
+            plugin_file = os.path.join(plugin_dir, 'upgraded_plugin.py')
+            with open(plugin_file, 'w') as f:
+                f.write('class Plugin(object):\n    VERSION = 1\n')
+            sys.path.insert(0, plugin_dir)
+            try:
+                ExtensionManager.ENTRY_POINT_CACHE = {namespace: [
+                    importlib.metadata.EntryPoint('upgraded', 'upgraded_plugin:Plugin', namespace)]}
+                nose.tools.assert_equal(
+                    es_logger.registry.get_plugin(namespace, 'upgraded').VERSION, 1)
+                # Upgrade the plugin, with a different time to the cached bytecode
+                with open(plugin_file, 'w') as f:
+                    f.write('class Plugin(object):\n    VERSION = 2\n')
+                os.utime(plugin_file, (0, 0))
+                with nose.tools.assert_logs('es_logger.registry', level='INFO') as cm:
+                    es_logger.registry.invalidate(reload_modules=True)
+                nose.tools.assert_equal(cm.output, [
+                    'INFO:es_logger.registry:Reloaded plugin module upgraded_plugin'])
+                ExtensionManager.ENTRY_POINT_CACHE = {namespace: [
+                    importlib.metadata.EntryPoint('upgraded', 'upgraded_plugin:Plugin', namespace),
+                    importlib.metadata.EntryPoint('dummy', 'test.test_plugins:DummyEventGenerator',
+                                                  namespace)]}
+                nose.tools.assert_equal(
+                    es_logger.registry.get_plugin_class(namespace, 'upgraded').VERSION, 2)
+                # Failures to reload are logged, and modules no longer loaded are skipped
+                with open(plugin_file, 'w') as f:
+                    f.write('class Plugin(object:\n')
+                es_logger.registry.get_plugin_class(namespace, 'dummy')
+                with unittest.mock.patch.dict('sys.modules'):
+                    del sys.modules['test.test_plugins']
+                    with nose.tools.assert_logs('es_logger.registry', level='INFO') as cm:
+                        es_logger.registry.invalidate(reload_modules=True)
+                nose.tools.assert_equal(len(cm.output), 1)
+                nose.tools.ok_(cm.output[0].startswith(
+                    'ERROR:es_logger.registry:Failed to reload plugin module upgraded_plugin: '),
+                    cm.output)
+            finally:
+                sys.path.remove(plugin_dir)
+                sys.modules.pop('upgraded_plugin', None)
@@ -3,19 +3,29 @@
 
 __author__ = 'jonpsull'
 
-from es_logger.plugins.target import LogstashPostError, LogstashTarget, SqsTarget
+from es_logger.plugins.target import ElasticsearchTarget, GzipBody, LogstashPostError, \
+    LogstashTarget, SqsTarget, clear_sessions, mount_pool
+import base64
+import gzip
+import http.server
 import json
 import nose
 import os
+import re
 import requests
+import threading
 import unittest.mock
 
 
 class TestLogstashTarget(object):
 
     def setup(self):
+        clear_sessions()
         self.lt = LogstashTarget()
 
+    def teardown(self):
+        clear_sessions()
+
     @unittest.mock.patch.dict('os.environ', {'LOGSTASH_SERVER': "https://example.com",
                                              'LS_USER': 'user',
                                              'LS_PASSWORD': 'pass'})
@@ -25,6 +35,16 @@ class TestLogstashTarget(object):
         nose.tools.ok_(lt.get_ls_user() == os.getenv('LS_USER'))
         nose.tools.ok_(lt.get_ls_password() == os.getenv('LS_PASSWORD'))
 
+    @unittest.mock.patch.dict('os.environ', {'LOGSTASH_SERVER': "https://example.com",
+                                             'LS_USER': 'user',
+                                             'LS_PASSWORD': 'pass'})
+    def test_LogstashTarget_config(self):
+        lt = LogstashTarget(config={'LOGSTASH_SERVER': 'https://config.example.com',
+                                    'LS_USER': 'config_user'})
+        nose.tools.assert_equal(lt.get_logstash_server(), 'https://config.example.com')
+        nose.tools.assert_equal(lt.get_ls_user(), 'config_user')
+        nose.tools.assert_equal(lt.get_ls_password(), 'pass')
+
     @unittest.mock.patch('requests.Session')
     def test_get_session(self, mock_session):
         self.lt.get_session()
@@ -32,6 +52,28 @@ class TestLogstashTarget(object):
         nose.tools.ok_(self.lt.ls_session is not None,
                        "Session is None: {}".format(self.lt.ls_session))
 
+    @unittest.mock.patch('requests.Session')
+    def test_get_session_shared(self, mock_session):
+        mock_session.side_effect = lambda: unittest.mock.MagicMock()
+        session = self.lt.get_session()
+        # Shared with the targets of later builds with the same settings
+        nose.tools.ok_(LogstashTarget().get_session() is session)
+        nose.tools.ok_(LogstashTarget(config={'LS_USER': 'other'}).get_session() is not session)
+        # Until a post on it times out
+        session.post.side_effect = requests.exceptions.ReadTimeout
+        lt = LogstashTarget()
+        lt.timeout_sleep = 0
+        lt.send_event({"event": "event"})
+        replacement = lt.ls_session
+        nose.tools.ok_(replacement is not session)
+        nose.tools.ok_(LogstashTarget().get_session() is replacement)
+        # A target still holding the old session doesn't drop its replacement, and moves to it
+        replacement.post.return_value.ok = True
+        self.lt.timeout_sleep = 0
+        nose.tools.assert_equal(self.lt.send_event({"event": "event"}), 0)
+        nose.tools.ok_(self.lt.ls_session is replacement)
+        nose.tools.ok_(LogstashTarget().get_session() is replacement)
+
     @unittest.mock.patch('requests.Session')
     def test_send_event_good(self, mock_session):
         mock_session().post().ok = True
@@ -52,17 +94,19 @@ class TestLogstashTarget(object):
         self.lt.timeout_sleep = 0
         nose.tools.assert_raises(LogstashPostError, self.lt.send_event, {"event": "event"})
         # We should see this created and called 5 times attempting to get post finished
+        post = unittest.mock.call().post(None, data=b'{"event": "event"}',
+                                         headers={'Content-Type': 'application/json'})
         calls = [unittest.mock.call(),
                  unittest.mock.call(),
-                 unittest.mock.call().post(None, json={'event': 'event'}),
+                 post,
                  unittest.mock.call(),
-                 unittest.mock.call().post(None, json={'event': 'event'}),
+                 post,
                  unittest.mock.call(),
-                 unittest.mock.call().post(None, json={'event': 'event'}),
+                 post,
                  unittest.mock.call(),
-                 unittest.mock.call().post(None, json={'event': 'event'}),
+                 post,
                  unittest.mock.call(),
-                 unittest.mock.call().post(None, json={'event': 'event'})]
+                 post]
         print(mock_session.mock_calls)
         nose.tools.ok_(mock_session.mock_calls == calls)
 
@@ -72,6 +116,151 @@ class TestLogstashTarget(object):
         self.lt.timeout_sleep = 0
         nose.tools.assert_raises(LogstashPostError, self.lt.send_event, {"event": "event"})
 
+    def get_batch_target(self, mock_session, **config):
+        config.setdefault('LS_BATCH_SIZE', '3')
+        lt = LogstashTarget(config=config)
+        lt.get_session()
+        mock_session().post().ok = True
+        mock_session.reset_mock()
+        return lt
+
+    def batch_call(self, *events):
+        body = ''.join(json.dumps(event) + '\n' for event in events).encode('utf-8')
+        return unittest.mock.call().post(None, data=body,
+                                         headers={'Content-Type': 'application/x-ndjson'})
+
+    def test_batch_config(self):
+        nose.tools.assert_equal(self.lt.batch_size, 0)
+        nose.tools.assert_equal(self.lt.batch_bytes, 5 * 1024 * 1024)
+        nose.tools.assert_equal(self.lt.batch_seconds, 0)
+        lt = LogstashTarget(config={'LS_BATCH_SIZE': '100', 'LS_BATCH_BYTES': '1000',
+                                    'LS_BATCH_SECONDS': '0.5'})
+        nose.tools.assert_equal(lt.batch_size, 100)
+        nose.tools.assert_equal(lt.batch_bytes, 1000)
+        nose.tools.assert_equal(lt.batch_seconds, 0.5)
+
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_batch_count(self, mock_session):
+        lt = self.get_batch_target(mock_session)
+        events = [{'event': number} for number in range(4)]
+        for event in events:
+            nose.tools.assert_equal(lt.send_event(event), 0)
+        # Sent once the third event is added, the fourth is left for finish_send
+        nose.tools.assert_equal(mock_session.mock_calls, [self.batch_call(*events[:3])])
+        nose.tools.assert_equal(lt.finish_send(), 0)
+        nose.tools.assert_equal(mock_session.mock_calls[-1], self.batch_call(events[3]))
+        nose.tools.assert_equal(lt.batch, [])
+        nose.tools.assert_equal(lt.batch_length, 0)
+        # Nothing more to send
+        mock_session.reset_mock()
+        nose.tools.assert_equal(lt.finish_send(), 0)
+        nose.tools.assert_equal(mock_session.mock_calls, [])
+
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_batch_bytes(self, mock_session):
+        event = {'event': 'x' * 10}
+        length = len(json.dumps(event)) + 1
+        lt = self.get_batch_target(mock_session, LS_BATCH_SIZE='10',
+                                   LS_BATCH_BYTES='{}'.format(length * 2 + 1))
+        nose.tools.assert_equal(lt.send_event(event), 0)
+        nose.tools.assert_equal(lt.send_event(event), 0)
+        nose.tools.assert_equal(lt.batch_length, length * 2)
+        # The third would go over the limit, so the first two are sent without it
+        nose.tools.assert_equal(lt.send_event(event), 0)
+        nose.tools.assert_equal(mock_session.mock_calls[-1], self.batch_call(event, event))
+        nose.tools.assert_equal(lt.batch_length, length)
+        # A single event over the limit is sent on its own
+        lt.batch_bytes = length - 1
+        nose.tools.assert_equal(lt.send_event(event), 0)
+        nose.tools.assert_equal(mock_session.mock_calls[-2:],
+                                [self.batch_call(event), self.batch_call(event)])
+        nose.tools.assert_equal(lt.batch, [])
+
+    @unittest.mock.patch('time.monotonic')
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_batch_seconds(self, mock_session, mock_monotonic):
+        lt = self.get_batch_target(mock_session, LS_BATCH_SIZE='10', LS_BATCH_SECONDS='5')
+        mock_monotonic.side_effect = [100, 100, 104, 105]
+        nose.tools.assert_equal(lt.send_event({'event': 1}), 0)
+        nose.tools.assert_equal(lt.send_event({'event': 2}), 0)
+        nose.tools.assert_equal(len(lt.batch), 2)
+        nose.tools.assert_equal(lt.send_event({'event': 3}), 0)
+        nose.tools.assert_equal(mock_session.mock_calls[-1],
+                                self.batch_call({'event': 1}, {'event': 2}, {'event': 3}))
+        nose.tools.assert_equal(lt.batch, [])
+
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_batch_bad(self, mock_session):
+        lt = self.get_batch_target(mock_session)
+        mock_session().post().ok = False
+        nose.tools.assert_equal(lt.send_event({'event': 1}), 0)
+        nose.tools.assert_equal(lt.send_event({'event': 2}), 0)
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            nose.tools.assert_equal(lt.finish_send(), 2)
+        nose.tools.assert_equal(
+            cm.output, ['DEBUG:es_logger.plugins.target:Posted 2 events in 26 bytes, result False',
+                        'DEBUG:es_logger.plugins.target:Logstash posted 26 bytes as 26 bytes on '
+                        'the wire'])
+
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_batch_retry(self, mock_session):
+        lt = self.get_batch_target(mock_session, LS_BATCH_SIZE='1')
+        lt.timeout_sleep = 0
+        mock_session().post.side_effect = [requests.exceptions.ReadTimeout,
+                                           unittest.mock.MagicMock(ok=True)]
+        nose.tools.assert_equal(lt.send_event({'event': 1}), 0)
+        nose.tools.assert_equal([c for c in mock_session.mock_calls if c != unittest.mock.call()],
+                                [self.batch_call({'event': 1})] * 2)
+
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_gzip(self, mock_session):
+        lt = self.get_batch_target(mock_session, LS_BATCH_SIZE='0', LS_GZIP_LEVEL='6',
+                                   LS_GZIP_MIN_BYTES='100')
+        nose.tools.assert_equal(lt.send_event({'event': 'small'}), 0)
+        nose.tools.assert_equal(
+            mock_session.mock_calls[-1],
+            unittest.mock.call().post(None, data=b'{"event": "small"}',
+                                      headers={'Content-Type': 'application/json'}))
+        event = {'event': 'x' * 1000}
+        nose.tools.assert_equal(lt.send_event(event), 0)
+        kwargs = mock_session.mock_calls[-1][2]
+        nose.tools.assert_equal(kwargs['headers'], {'Content-Type': 'application/json',
+                                                    'Content-Encoding': 'gzip'})
+        nose.tools.assert_equal(json.loads(gzip.decompress(kwargs['data'])), event)
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            nose.tools.assert_equal(lt.finish_send(), 0)
+        nose.tools.assert_equal(
+            cm.output, ['DEBUG:es_logger.plugins.target:Logstash posted {} bytes as {} bytes on '
+                        'the wire'.format(18 + len(json.dumps(event)), 18 + len(kwargs['data']))])
+        nose.tools.assert_equal(lt.gzip.body_bytes, 0)
+        nose.tools.assert_equal(lt.gzip.wire_bytes, 0)
+
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_window(self, mock_session):
+        lt = self.get_batch_target(mock_session, LS_BATCH_SIZE='0', LS_SEND_WINDOW='2')
+        both_started = threading.Barrier(2)
+
+        def post(server, data, headers):
+            event = json.loads(data)
+            if event['event'] < 2:
+                both_started.wait(timeout=5)
+            return unittest.mock.MagicMock(ok=event['event'] % 2 == 0)
+
+        mock_session().post.side_effect = post
+        for number in range(5):
+            nose.tools.assert_equal(lt.send_event({'event': number}), 0)
+        # The errors of the posts in flight are counted once they have finished
+        nose.tools.assert_equal(lt.finish_send(), 2)
+        nose.tools.assert_equal(mock_session().post.call_count, 5)
+
+    @unittest.mock.patch('requests.Session')
+    def test_send_event_batch_window(self, mock_session):
+        lt = self.get_batch_target(mock_session, LS_BATCH_SIZE='2', LS_SEND_WINDOW='2')
+        mock_session().post().ok = False
+        for number in range(5):
+            nose.tools.assert_equal(lt.send_event({'event': number}), 0)
+        nose.tools.assert_equal(lt.finish_send(), 5)
+
     def test_validate(self):
         ret = self.lt.validate()
         nose.tools.ok_(ret, "Validate must return True")
@@ -82,23 +271,283 @@ class TestLogstashTarget(object):
         nose.tools.assert_equal(ret, expected, "{} doesn't match expected {}".format(ret, expected))
 
 
+class TestGzipBody(object):
+
+    def test_encode(self):
+        body = b'x' * 2000
+        nose.tools.assert_equal(GzipBody().encode(body), (body, {}))
+        gzip_body = GzipBody('9', '2001')
+        nose.tools.assert_equal(gzip_body.encode(body), (body, {}))
+        gzip_body.min_bytes = 2000
+        encoded, headers = gzip_body.encode(body)
+        nose.tools.assert_equal(headers, {'Content-Encoding': 'gzip'})
+        nose.tools.assert_equal(gzip.decompress(encoded), body)
+        nose.tools.ok_(len(encoded) < 100)
+        nose.tools.assert_equal(gzip_body.body_bytes, 4000)
+        # Only counted on the wire when sent, for each attempt
+        nose.tools.assert_equal(gzip_body.wire_bytes, 0)
+        gzip_body.sent(encoded)
+        gzip_body.sent(encoded)
+        nose.tools.assert_equal(gzip_body.wire_bytes, len(encoded) * 2)
+
+
+class TestMountPool(object):
+
+    def test_mount_pool(self):
+        session = requests.Session()
+        adapter = session.get_adapter('http://localhost')
+        nose.tools.ok_(mount_pool(session, 10) is session)
+        nose.tools.ok_(session.get_adapter('http://localhost') is adapter)
+        mount_pool(session, 20)
+        nose.tools.assert_equal(session.get_adapter('http://localhost')._pool_maxsize, 20)
+        nose.tools.ok_(session.get_adapter('https://localhost') is
+                       session.get_adapter('http://localhost'))
+
+
+# A stub of the Elasticsearch _bulk API, recording the requests and replying with each of
+# responses in turn, either a status for the whole request or the status of each item
+class BulkHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers['Content-Encoding'] == 'gzip':
+            body = gzip.decompress(body)
+        self.server.requests.append((self.path, self.headers, body))
+        actions = [json.loads(line) for line in body.splitlines()[::2]]
+        response = self.server.responses.pop(0) if self.server.responses else None
+        if isinstance(response, int):
+            self.send_response(response)
+            self.end_headers()
+            self.wfile.write(b'busy')
+            return
+        statuses = response or [201] * len(actions)
+        items = []
+        for action, status in zip(actions, statuses):
+            result = {'_index': action['index']['_index'],
+                      '_id': action['index'].get('_id', 'generated'), 'status': status}
+            if status >= 300:
+                result['error'] = {'type': 'mapper_parsing_exception'}
+            items.append({'index': result})
+        reply = json.dumps({'errors': any(status >= 300 for status in statuses),
+                            'items': items}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '{}'.format(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestElasticsearchTarget(object):
+
+    def setup(self):
+        clear_sessions()
+        self.server = http.server.ThreadingHTTPServer(('localhost', 0), BulkHandler)
+        self.server.requests = []
+        self.server.responses = []
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.start()
+        self.est = self.get_target()
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        clear_sessions()
+
+    def get_target(self, **config):
+        config.setdefault('ELASTICSEARCH_SERVER',
+                          'http://localhost:{}/'.format(self.server.server_address[1]))
+        est = ElasticsearchTarget(config=config)
+        est.timeout_sleep = 0
+        return est
+
+    # The events in each request made, by index
+    def get_requests(self):
+        requests = []
+        for path, headers, body in self.server.requests:
+            nose.tools.assert_equal(path, '/_bulk')
+            nose.tools.assert_equal(headers['Content-Type'], 'application/x-ndjson')
+            lines = body.splitlines()
+            requests.append([(json.loads(action)['index']['_index'], json.loads(source))
+                             for action, source in zip(lines[::2], lines[1::2])])
+        return requests
+
+    def test_ElasticsearchTarget(self):
+        est = ElasticsearchTarget(config={'ELASTICSEARCH_SERVER': 'http://localhost:9200'})
+        nose.tools.assert_equal(est.es_server, 'http://localhost:9200')
+        nose.tools.assert_equal(est.index, 'es-logger')
+        nose.tools.assert_equal(est.batch_size, 500)
+        nose.tools.assert_equal(est.batch_bytes, 5 * 1024 * 1024)
+        nose.tools.assert_equal(est.retries, 3)
+        nose.tools.ok_(est.validate(), "Validate must return True")
+        nose.tools.assert_equal(est.get_required_vars(), ['ELASTICSEARCH_SERVER'])
+        nose.tools.ok_('ELASTICSEARCH_SERVER' in est.get_help_string())
+
+    def test_get_index(self):
+        nose.tools.assert_equal(self.est.get_index({'eslogger': {'job_name': 'job'}}), 'es-logger')
+        nose.tools.assert_equal(self.est.get_index({'eslogger': {'event': 'JUnit'}}),
+                                'es-logger-junit')
+        nose.tools.assert_equal(self.est.get_index({}), 'es-logger')
+
+    def test_get_event_id(self):
+        build = {'eslogger': {'job_name': 'job', 'jenkins_url': 'url', 'es_build_number': 1}}
+        event = {'eslogger': dict(build['eslogger'], event='console_log_events')}
+        first = self.est.get_event_id(event)
+        nose.tools.assert_equal(len(first), 64)
+        # A repeat of an event within a build gets an id of its own
+        nose.tools.assert_not_equal(self.est.get_event_id(event), first)
+        nose.tools.assert_not_equal(self.est.get_event_id(build), first)
+        # The same event of the build sent again by another target gets the same id
+        nose.tools.assert_equal(self.get_target().get_event_id(event), first)
+        nose.tools.assert_is_none(self.est.get_event_id({'eslogger': {'job_name': 'job'}}))
+        nose.tools.assert_is_none(self.est.get_event_id({}))
+
+    def test_send_event_ids(self):
+        event = {'eslogger': {'job_name': 'job', 'jenkins_url': 'url', 'es_build_number': 1,
+                              'event': 'console_log_events'}}
+        self.est.send_event(event)
+        self.est.send_event(event)
+        self.est.send_event({'a': 1})
+        nose.tools.assert_equal(self.est.finish_send(), 0)
+        actions = [json.loads(line)['index']
+                   for line in self.server.requests[0][2].splitlines()[::2]]
+        nose.tools.assert_equal(len(actions), 3)
+        nose.tools.assert_not_equal(actions[0]['_id'], actions[1]['_id'])
+        nose.tools.ok_('_id' not in actions[2])
+
+    def test_send_event(self):
+        est = self.get_target(ELASTICSEARCH_BATCH_SIZE='2', ELASTICSEARCH_USER='user',
+                              ELASTICSEARCH_PASSWORD='pass')
+        events = [{'eslogger': {'job_name': 'job'}},
+                  {'eslogger': {'event': 'junit'}, 'junit': {'test': 1}},
+                  {'eslogger': {'event': 'commit'}, 'commit': {'sha': 'abc'}}]
+        nose.tools.assert_equal(est.send_event(events[0]), 0)
+        nose.tools.assert_equal(self.server.requests, [])
+        nose.tools.assert_equal(est.send_event(events[1]), 0)
+        nose.tools.assert_equal(est.send_event(events[2]), 0)
+        nose.tools.assert_equal(est.finish_send(), 0)
+        nose.tools.assert_equal(self.get_requests(),
+                                [[('es-logger', events[0]), ('es-logger-junit', events[1])],
+                                 [('es-logger-commit', events[2])]])
+        nose.tools.assert_equal(self.server.requests[0][1]['Authorization'],
+                                'Basic {}'.format(base64.b64encode(b'user:pass').decode()))
+        # Nothing left to send
+        nose.tools.assert_equal(est.finish_send(), 0)
+        nose.tools.assert_equal(len(self.server.requests), 2)
+
+    def test_send_event_bytes(self):
+        event = {'event': 'x' * 100}
+        est = self.get_target()
+        nose.tools.assert_equal(est.send_event(event), 0)
+        est.batch_bytes = est.batch_length * 2 + 1
+        nose.tools.assert_equal(est.send_event(event), 0)
+        # The third would go over the limit, so the first two are sent without it
+        nose.tools.assert_equal(est.send_event(event), 0)
+        nose.tools.assert_equal(self.get_requests(), [[('es-logger', event)] * 2])
+        # A single event over the limit is sent on its own
+        est.batch_bytes = 100
+        nose.tools.assert_equal(est.send_event(event), 0)
+        nose.tools.assert_equal(self.get_requests()[1:], [[('es-logger', event)]] * 2)
+        nose.tools.assert_equal(est.batch, [])
+
+    def test_send_event_item_errors(self):
+        events = [{'event': number} for number in range(4)]
+        self.server.responses = [[201, 429, 400, 503]]
+        for event in events:
+            nose.tools.assert_equal(self.est.send_event(event), 0)
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            nose.tools.assert_equal(self.est.finish_send(), 1)
+        # Only the events rejected as busy are sent again
+        nose.tools.assert_equal(self.get_requests(),
+                                [[('es-logger', event) for event in events],
+                                 [('es-logger', events[1]), ('es-logger', events[3])]])
+        nose.tools.ok_("WARNING:es_logger.plugins.target:Error indexing event status 400 error "
+                       "{'type': 'mapper_parsing_exception'}" in cm.output)
+        nose.tools.ok_("DEBUG:es_logger.plugins.target:Retrying 2 of 4 events" in cm.output)
+
+    def test_send_event_request_errors(self):
+        est = self.get_target(ELASTICSEARCH_RETRIES='2')
+        self.server.responses = [503, 429]
+        nose.tools.assert_equal(est.send_event({'event': 1}), 0)
+        nose.tools.assert_equal(est.finish_send(), 0)
+        nose.tools.assert_equal(self.get_requests(), [[('es-logger', {'event': 1})]] * 3)
+        # Busy every time
+        self.server.responses = [503, 503, 503]
+        nose.tools.assert_equal(est.send_event({'event': 1}), 0)
+        nose.tools.assert_equal(est.send_event({'event': 2}), 0)
+        with nose.tools.assert_logs(level='WARNING') as cm:
+            nose.tools.assert_equal(est.finish_send(), 2)
+        nose.tools.assert_equal(
+            cm.output, ['WARNING:es_logger.plugins.target:Giving up on 2 events after 3 attempts'])
+        nose.tools.assert_equal(len(self.server.requests), 6)
+
+    def test_send_event_gzip(self):
+        est = self.get_target(ELASTICSEARCH_GZIP_LEVEL='1', ELASTICSEARCH_RETRIES='1')
+        self.server.responses = [503]
+        events = [{'event': 'x' * 1000}, {'event': 2}]
+        for event in events:
+            nose.tools.assert_equal(est.send_event(event), 0)
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            nose.tools.assert_equal(est.finish_send(), 0)
+        nose.tools.assert_equal(self.get_requests(),
+                                [[('es-logger', event) for event in events]] * 2)
+        nose.tools.assert_equal(self.server.requests[0][1]['Content-Encoding'], 'gzip')
+        # Both attempts are counted
+        body_bytes = len(self.server.requests[0][2]) * 2
+        nose.tools.ok_(re.match('DEBUG:es_logger.plugins.target:Elasticsearch posted {} bytes as '
+                                '[0-9]+ bytes on the wire'.format(body_bytes), cm.output[-1]))
+        wire_bytes = int(cm.output[-1].split()[-5])
+        nose.tools.ok_(wire_bytes < body_bytes, cm.output[-1])
+
+    def test_send_event_window(self):
+        est = self.get_target(ELASTICSEARCH_BATCH_SIZE='2', ELASTICSEARCH_SEND_WINDOW='2')
+        self.server.responses = [[201, 400], [400, 429]]
+        events = [{'event': number} for number in range(5)]
+        for event in events:
+            nose.tools.assert_equal(est.send_event(event), 0)
+        nose.tools.assert_equal(est.finish_send(), 2)
+        # Which of the first two requests gets which response depends on which is first,
+        # either way one event is sent again
+        nose.tools.assert_equal(sum(len(request) for request in self.get_requests()), 6)
+
+    def test_send_event_connection_error(self):
+        est = self.get_target(ELASTICSEARCH_RETRIES='1')
+        est.es_server = 'http://localhost:{}'.format(self.server.server_address[1])
+        self.teardown()
+        nose.tools.assert_equal(est.send_event({'event': 1}), 0)
+        with nose.tools.assert_logs(level='WARNING') as cm:
+            nose.tools.assert_equal(est.finish_send(), 1)
+        nose.tools.assert_equal(len(cm.output), 3)
+        nose.tools.ok_(cm.output[0].startswith(
+            'WARNING:es_logger.plugins.target:Bulk request error'))
+        nose.tools.ok_(est.es_session is None)
+        self.setup()
+
+
 class TestSqsTarget(object):
 
     def setup(self):
         self.sqst = SqsTarget()
 
-    def mock_do_send_good(self):
-        self.sqst.data = []
+    def mock_do_send_good(self, entries):
         return 0
 
-    def mock_do_send_bad(self):
-        self.sqst.data = []
+    def mock_do_send_bad(self, entries):
         return 3
 
     @unittest.mock.patch.dict('os.environ', {'SQS_QUEUE': "https://example.com"})
     def test_SqsTarget(self):
         sqs = SqsTarget()
         nose.tools.ok_(sqs.get_sqs_queue() == os.getenv('SQS_QUEUE'))
+        # Batches are sent one at a time, to keep the order of the FIFO queue
+        nose.tools.assert_equal(sqs.send_window, 0)
+        sqs = SqsTarget(config={'SQS_QUEUE': 'https://config.example.com',
+                                'SQS_SEND_WINDOW': '4'})
+        nose.tools.assert_equal(sqs.get_sqs_queue(), 'https://config.example.com')
+        nose.tools.assert_equal(sqs.send_window, 4)
 
     @unittest.mock.patch('boto3.client')
     def test_get_sqs(self, mock_sqs_client):
@@ -193,12 +642,15 @@ class TestSqsTarget(object):
     def test_send_event_multiple(self):
         self.test_send_event()
         self.sqst.do_send.side_effect = self.mock_do_send_good
+        self.sqst.client = unittest.mock.MagicMock()
+        entries = self.sqst.data
 
         event = {"event": 11}
         result = self.sqst.send_event(event)
         nose.tools.assert_equal(result, 0, "Return not equal to 0 for {}: {}".format(
                                 event, result))
-        nose.tools.assert_equal(self.sqst.do_send.mock_calls, [unittest.mock.call()],
+        nose.tools.assert_equal(self.sqst.wait_sent(), 0)
+        nose.tools.assert_equal(self.sqst.do_send.mock_calls, [unittest.mock.call(entries)],
                                 "do_send not called when it should be: {}".format(
                                 self.sqst.do_send.mock_calls))
         expected_data = [{'Id': '0',
@@ -218,7 +670,53 @@ class TestSqsTarget(object):
         nose.tools.assert_equal(result, 1, "Return not equal to 0 for {}: {}".format(
                                 event, result))
         nose.tools.assert_equal(cm.output,
-                                ['WARNING:es_logger.plugins.target:Message too big: 262396'])
+                                ['WARNING:es_logger.plugins.target:Message too big: 262184'])
+
+    def test_send_event_size(self):
+        self.sqst.do_send = unittest.mock.MagicMock(side_effect=self.mock_do_send_good)
+        self.sqst.client = unittest.mock.MagicMock()
+        self.sqst.send_window = 0
+        # The body and the name, type and value of the source attribute
+        event = {"event": "x" * (100 * 1024 - 13 - 21)}
+        size = len(json.dumps(event)) + 21
+        nose.tools.assert_equal(size, 100 * 1024)
+        nose.tools.assert_equal(self.sqst.send_event(event), 0)
+        nose.tools.assert_equal(self.sqst.send_event(event), 0)
+        nose.tools.assert_equal(self.sqst.data_size, size * 2)
+        self.sqst.do_send.assert_not_called()
+        # The third would take the batch over the limit, so the first two are sent without it
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            nose.tools.assert_equal(self.sqst.send_event(event), 0)
+        nose.tools.assert_equal(
+            cm.output, ['DEBUG:es_logger.plugins.target:Sending max message size {} count '
+                        '2'.format(size * 3)])
+        nose.tools.assert_equal(len(self.sqst.do_send.call_args[0][0]), 2)
+        nose.tools.assert_equal(self.sqst.data_size, size)
+        nose.tools.assert_equal(self.sqst.data[0]['Id'], '0')
+        # Nothing left to send after finishing
+        nose.tools.assert_equal(self.sqst.finish_send(), 0)
+        nose.tools.assert_equal(self.sqst.do_send.call_count, 2)
+        nose.tools.assert_equal(self.sqst.finish_send(), 0)
+        nose.tools.assert_equal(self.sqst.do_send.call_count, 2)
+
+    def test_send_event_window(self):
+        self.sqst.send_window = 2
+        sqs_client_mock = unittest.mock.MagicMock()
+        both_started = threading.Barrier(2)
+
+        def send_message_batch(QueueUrl, Entries):
+            # The first two batches are in flight at once
+            if Entries[0]['MessageBody'] in ['{"event": 0}', '{"event": 10}']:
+                both_started.wait(timeout=5)
+            return self.send_message_batch_bad(QueueUrl, Entries[:1])
+
+        sqs_client_mock.send_message_batch = send_message_batch
+        self.sqst.client = sqs_client_mock
+        self.sqst.sqs_queue = 'http://sqs.dummy_queue.fifo'
+        for number in range(25):
+            nose.tools.assert_equal(self.sqst.send_event({'event': number}), 0)
+        # The errors of the batches in flight are counted once they have finished
+        nose.tools.assert_equal(self.sqst.finish_send(), 3)
 
     def test_validate(self):
         ret = self.sqst.validate()
@@ -262,6 +760,7 @@ class TestSqsTarget(object):
     def test_finish_send(self):
         self.test_send_event()
         self.sqst.do_send = self.sqst.orig_do_send
+        entries = self.sqst.data
         sqs_client_mock = unittest.mock.MagicMock()
         sqs_client_mock.send_message_batch = self.send_message_batch_good
         self.sqst.get_sqs = lambda: sqs_client_mock
@@ -271,6 +770,8 @@ class TestSqsTarget(object):
         nose.tools.assert_equal(sqs_client_mock.mock_calls, [])
         nose.tools.ok_(ret == 0, "Return not 0: {}".format(ret))
         nose.tools.ok_(len(self.sqst.data) == 0, "data queue not 0: {}".format(len(self.sqst.data)))
+        nose.tools.assert_equal(self.sqst.data_size, 0)
+        nose.tools.assert_equal(len(entries), 10)
         print(cm.output)
         nose.tools.assert_equal(
             cm.output,
@@ -322,6 +823,7 @@ class TestSqsTarget(object):
     def test_finish_send_bad(self):
         self.test_send_event()
         self.sqst.do_send = self.sqst.orig_do_send
+        entries = self.sqst.data
         sqs_client_mock = unittest.mock.MagicMock()
         sqs_client_mock.send_message_batch = self.send_message_batch_bad
         self.sqst.get_sqs = lambda: sqs_client_mock
@@ -331,6 +833,8 @@ class TestSqsTarget(object):
         nose.tools.assert_equal(sqs_client_mock.mock_calls, [])
         nose.tools.ok_(ret == 10, "Return not 10: {}".format(ret))
         nose.tools.ok_(len(self.sqst.data) == 0, "data queue not 0: {}".format(len(self.sqst.data)))
+        nose.tools.assert_equal(self.sqst.data_size, 0)
+        nose.tools.assert_equal(len(entries), 10)
         print(cm.output)
         nose.tools.assert_equal(
             cm.output,
@@ -4,12 +4,19 @@
 __author__ = 'jonpsull'
 
 import asyncio
+import concurrent.futures
 import es_logger
 import importlib.metadata
 import nose
+from jenkins import JenkinsException
 import os
+from parameterized import parameterized
+import struct
+import tempfile
 from stevedore import ExtensionManager
+import time
 import unittest.mock
+import zmq
 
 
 class TestZMQClient(object):
@@ -38,6 +45,9 @@ class TestZMQClient(object):
         '        "number":123,"phase":"FINISHED","status":"SUCCESS","url":' +\
         '"job/folder/job/sample-job/123/",\\n        "node_name":"","node_description":' +\
         '"the master Jenkins node",\\n        "host_name":"jenkins_url"}}\''
+    sample_finished_build = es_logger.zmq_client.Build('folder/sample-job', 123, 'FINISHED',
+                                                       'SUCCESS', False)
+    sample_completed_build = sample_finished_build._replace(phase='COMPLETED')
 
     def setup(self):
         self.config_dict = {}
@@ -157,6 +167,208 @@ class TestZMQClient(object):
                            "{} did not match {} ({})".format(5, self.zmqd.num_workers,
                                                              type(self.zmqd.num_workers)))
 
+    def test_zmq_client_configure_autoscale(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.zmqd.configure()
+            nose.tools.assert_equal((self.zmqd.min_workers, self.zmqd.max_workers), (3, 3))
+            nose.tools.ok_(not self.zmqd.autoscaling())
+            config['zmq']['min_workers'] = '1'
+            config['zmq']['max_workers'] = '10'
+            config['zmq']['scale_interval'] = '5'
+            config['zmq']['scale_up_backlog'] = '30'
+            config['zmq']['scale_down_checks'] = '2'
+            self.zmqd.configure()
+            nose.tools.assert_equal((self.zmqd.min_workers, self.zmqd.max_workers), (1, 10))
+            nose.tools.assert_equal((self.zmqd.scale_interval, self.zmqd.scale_up_backlog,
+                                     self.zmqd.scale_down_checks), (5, 30, 2))
+            nose.tools.ok_(self.zmqd.autoscaling())
+            nose.tools.assert_equal(self.zmqd.get_max_workers(), 10)
+            config['zmq']['max_workers'] = '2'
+            nose.tools.assert_raises(es_logger.zmq_client.ZMQClientMisconfiguration,
+                                     self.zmqd.configure)
+            config['zmq']['max_workers'] = '10'
+            config['zmq']['min_workers'] = '0'
+            nose.tools.assert_raises(es_logger.zmq_client.ZMQClientMisconfiguration,
+                                     self.zmqd.configure)
+
+    def test_zmq_client_configure_executor(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.executor_type, 'thread')
+            config['zmq']['executor'] = 'process'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.executor_type, 'process')
+            config['zmq']['executor'] = 'bad'
+            nose.tools.assert_raises(es_logger.zmq_client.ZMQClientMisconfiguration,
+                                     self.zmqd.configure)
+
+    def test_zmq_client_configure_overflow(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.max_queue_size, 0)
+            nose.tools.assert_equal(self.zmqd.overflow, 'block')
+            nose.tools.assert_equal(self.zmqd.drain_timeout, 0)
+            config['zmq']['drain_timeout'] = '120'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.drain_timeout, 120)
+            config['zmq']['max_queue_size'] = '100'
+            config['zmq']['overflow'] = 'spill'
+            config['zmq']['spill_file'] = '/tmp/spill'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.max_queue_size, 100)
+            nose.tools.assert_equal(self.zmqd.overflow, 'spill')
+            nose.tools.assert_equal(self.zmqd.spill_file, '/tmp/spill')
+            # Only non-FINISHED messages are dropped, and they are only queued with --test-zmq
+            config['zmq']['overflow'] = 'drop'
+            self.zmqd.configure()
+            self.zmqd.test_zmq = False
+            nose.tools.assert_raises(es_logger.zmq_client.ZMQClientMisconfiguration,
+                                     self.zmqd.configure)
+            self.zmqd.test_zmq = True
+            config['zmq']['overflow'] = 'spill'
+            nose.tools.ok_(self.zmqd.journal_file is None)
+            config['zmq']['journal'] = '/tmp/journal.db'
+            config['zmq']['journal_max_resumes'] = '5'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.journal_file, '/tmp/journal.db')
+            nose.tools.assert_equal(self.zmqd.journal_max_resumes, 5)
+            nose.tools.assert_equal(self.zmqd.dedup_ttl, 3600)
+            config['zmq']['dedup_ttl'] = '0'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.dedup_ttl, 0)
+
+    @unittest.mock.patch.dict('os.environ', {})
+    def test_zmq_client_configure_rate_limit(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            config['jenkins']['rate_limit'] = '10'
+            config['jenkins']['heavy_rate_limit'] = '2'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.settings['JENKINS_RATE_LIMIT'], '10')
+            nose.tools.assert_equal(self.zmqd.settings['JENKINS_HEAVY_RATE_LIMIT'], '2')
+
+    def set_masters_config(self, config):
+        config['zmq']['spill_file'] = 'spill.jsonl'
+        config['zmq']['journal'] = 'journal.db'
+        config['zmq']['checkpoint'] = 'checkpoint.db'
+        config['zmq']['metrics_port'] = '9100'
+        config['master:a'] = {}
+        config['master:a']['jenkins_url'] = 'https://a.example.com'
+        config['master:a']['zmq_publisher'] = 'tcp://a.example.com:8888'
+        config['master:b'] = {}
+        config['master:b']['jenkins_url'] = 'https://b.example.com'
+        config['master:b']['jenkins_user'] = 'b_user'
+        config['master:b']['zmq_publisher'] = 'tcp://b.example.com:8888'
+        config['master:b']['num_workers'] = '1'
+        config['master:b']['journal'] = 'b.db'
+        config['master:b']['rate_limit'] = '5'
+
+    def test_zmq_client_configure_masters(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.set_masters_config(config)
+            self.zmqd.configure()
+        nose.tools.ok_(self.zmqd.master is None)
+        nose.tools.assert_equal(self.zmqd.metrics_port, 9100)
+        # The Jenkins in [zmq] and [jenkins] is still listened to
+        nose.tools.assert_equal([master.master for master in self.zmqd.masters],
+                                ['default', 'a', 'b'])
+        master_default, master_a, master_b = self.zmqd.masters
+        nose.tools.assert_equal(master_default.zmq_publisher, 'tcp://jenkins.example.com:8888')
+        nose.tools.assert_equal(master_default.settings.get('JENKINS_URL'),
+                                'https://jenkins.example.com')
+        # Each master reads [zmq] and [jenkins] with the settings of its own section over them
+        nose.tools.assert_equal(master_a.zmq_publisher, 'tcp://a.example.com:8888')
+        nose.tools.assert_equal(master_a.num_workers, 3)
+        nose.tools.assert_equal(master_b.num_workers, 1)
+        jenkins_vars = ['JENKINS_URL', 'JENKINS_USER', 'JENKINS_PASSWORD', 'JENKINS_RATE_LIMIT']
+        nose.tools.assert_equal(
+            [master_a.settings.get(var) for var in jenkins_vars],
+            ['https://a.example.com', 'jenkins_user', 'jenkins_password', None])
+        nose.tools.assert_equal(
+            [master_b.settings.get(var) for var in jenkins_vars],
+            ['https://b.example.com', 'b_user', 'jenkins_password', '5'])
+        # Files are kept apart unless set for the master, and metrics are served by the parent
+        nose.tools.assert_equal(master_a.spill_file, 'spill.jsonl.a')
+        nose.tools.assert_equal(master_a.journal_file, 'journal.db.a')
+        nose.tools.assert_equal(master_b.journal_file, 'b.db')
+        nose.tools.assert_equal(master_b.checkpoint_file, 'checkpoint.db.b')
+        nose.tools.assert_equal(self.zmqd.checkpoint_file, 'checkpoint.db')
+        nose.tools.assert_equal(master_default.spill_file, 'spill.jsonl')
+        nose.tools.assert_equal(master_default.journal_file, 'journal.db')
+        nose.tools.ok_(master_default.metrics_port is None)
+        nose.tools.ok_(master_a.metrics_port is None)
+        nose.tools.assert_equal(master_a.masters, [])
+
+    def test_zmq_client_configure_masters_only(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.set_masters_config(config)
+            # Only the masters need a Jenkins to listen to
+            del config['zmq']['zmq_publisher']
+            del config['jenkins']['jenkins_url']
+            self.zmqd.configure()
+        nose.tools.ok_(self.zmqd.zmq_publisher is None)
+        nose.tools.assert_equal([master.master for master in self.zmqd.masters], ['a', 'b'])
+
+    def test_zmq_client_configure_masters_default(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            config['master:default'] = {}
+            nose.tools.assert_raises(es_logger.zmq_client.ZMQClientMisconfiguration,
+                                     self.zmqd.configure)
+
+    def test_get_section(self):
+        get_section = es_logger.zmq_client.ESLoggerZMQDaemon.get_section
+        config = {'zmq': {'num_workers': '3', 'executor': 'thread'}}
+        nose.tools.ok_(get_section(config, 'jenkins', {}) is None)
+        nose.tools.assert_equal(get_section(config, 'jenkins', {'rate_limit': '5'}),
+                                {'rate_limit': '5'})
+        nose.tools.assert_equal(get_section(config, 'zmq', {'num_workers': '1'}),
+                                {'num_workers': '1', 'executor': 'thread'})
+
+    def test_zmq_client_configure_metrics(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.zmqd.configure()
+            nose.tools.ok_(self.zmqd.metrics_port is None)
+            nose.tools.assert_equal(self.zmqd.metrics_address, '127.0.0.1')
+            config['zmq']['metrics_port'] = '9100'
+            config['zmq']['metrics_address'] = '0.0.0.0'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.metrics_port, 9100)
+            nose.tools.assert_equal(self.zmqd.metrics_address, '0.0.0.0')
+
+    def test_zmq_client_configure_scheduling(self):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.scheduling, 'fair')
+            nose.tools.assert_equal(self.zmqd.priority_statuses, ['FAILURE'])
+            config['zmq']['scheduling'] = 'fifo'
+            config['zmq']['priority_statuses'] = 'FAILURE UNSTABLE'
+            self.zmqd.configure()
+            nose.tools.assert_equal(self.zmqd.scheduling, 'fifo')
+            nose.tools.assert_equal(self.zmqd.priority_statuses, ['FAILURE', 'UNSTABLE'])
+            config['zmq']['scheduling'] = 'bad'
+            nose.tools.assert_raises(es_logger.zmq_client.ZMQClientMisconfiguration,
+                                     self.zmqd.configure)
+            config['zmq']['overflow'] = 'bad'
+            nose.tools.assert_raises(es_logger.zmq_client.ZMQClientMisconfiguration,
+                                     self.zmqd.configure)
+
     # Test call flow with good options
     def test_zmq_client_configure_default(self):
         with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
@@ -188,17 +400,19 @@ class TestZMQClient(object):
             self.zmqd.configure(config)
             for key in self.zmqd.env_vars:
                 if hasattr(self.zmqd, key.lower()):
-                    nose.tools.ok_(os.environ[key] == getattr(self.zmqd, key.lower()))
+                    nose.tools.ok_(self.zmqd.settings.get(key) == getattr(self.zmqd, key.lower()))
             for key in config['generate_events:plugin-a'].keys():
-                nose.tools.ok_(os.environ[key.upper()] == config['generate_events:plugin-a'][key],
-                               "Expected: {}, Actual: {}".format(
-                                   config['generate_events:plugin-a'][key],
-                                   os.environ[key.upper()]))
+                nose.tools.ok_(
+                    self.zmqd.settings[key.upper()] == config['generate_events:plugin-a'][key],
+                    "Expected: {}, Actual: {}".format(
+                        config['generate_events:plugin-a'][key],
+                        self.zmqd.settings[key.upper()]))
             for key in config['generate_events:pluginb'].keys():
-                nose.tools.ok_(os.environ[key.upper()] == config['generate_events:pluginb'][key],
-                               "Expected: {}, Actual: {}".format(
-                                   config['generate_events:pluginb'][key],
-                                   os.environ[key.upper()]))
+                nose.tools.ok_(
+                    self.zmqd.settings[key.upper()] == config['generate_events:pluginb'][key],
+                    "Expected: {}, Actual: {}".format(
+                        config['generate_events:pluginb'][key],
+                        self.zmqd.settings[key.upper()]))
 
     def test_zmq_client_configure_gather_build_data_plugin_config(self):
         with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
@@ -209,12 +423,13 @@ class TestZMQClient(object):
             self.zmqd.configure(config)
             for key in self.zmqd.env_vars:
                 if hasattr(self.zmqd, key.lower()):
-                    nose.tools.ok_(os.environ[key] == getattr(self.zmqd, key.lower()))
+                    nose.tools.ok_(self.zmqd.settings.get(key) == getattr(self.zmqd, key.lower()))
             for key in config['gather_build_data:plugin'].keys():
-                nose.tools.ok_(os.environ[key.upper()] == config['gather_build_data:plugin'][key],
-                               "Expected: {}, Actual: {}".format(
-                                   config['gather_build_data:plugin'][key],
-                                   os.environ[key.upper()]))
+                nose.tools.ok_(
+                    self.zmqd.settings[key.upper()] == config['gather_build_data:plugin'][key],
+                    "Expected: {}, Actual: {}".format(
+                        config['gather_build_data:plugin'][key],
+                        self.zmqd.settings[key.upper()]))
 
     def test_zmq_client_configure_process_console_logs_plugin_config(self):
         with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
@@ -225,24 +440,29 @@ class TestZMQClient(object):
             self.zmqd.configure(config)
             for key in self.zmqd.env_vars:
                 if hasattr(self.zmqd, key.lower()):
-                    nose.tools.ok_(os.environ[key] == getattr(self.zmqd, key.lower()))
+                    nose.tools.ok_(self.zmqd.settings.get(key) == getattr(self.zmqd, key.lower()))
             for key in config['process_console_logs:pluginA'].keys():
                 nose.tools.ok_(
-                    os.environ[key.upper()] == config['process_console_logs:pluginA'][key],
+                    self.zmqd.settings[key.upper()] == config['process_console_logs:pluginA'][key],
                     "Expected: {}, Actual: {}".format(
                         config['process_console_logs:pluginA'][key],
-                        os.environ[key.upper()]))
+                        self.zmqd.settings[key.upper()]))
 
     # Test call flow with good options
     def test_zmq_client_configure(self):
-        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser, \
+                unittest.mock.patch.dict('os.environ', {}, clear=True):
             config = self.config_setup(mock_config_parser)
             self.set_default_config(config)
             self.set_plugin_config(config)
             self.zmqd.configure()
             for key in self.zmqd.env_vars:
                 if hasattr(self.zmqd, key.lower()):
-                    nose.tools.ok_(os.environ[key] == getattr(self.zmqd, key.lower()))
+                    nose.tools.ok_(self.zmqd.settings.get(key) == getattr(self.zmqd, key.lower()))
+            nose.tools.assert_equal(self.zmqd.settings['LOGSTASH_SERVER'],
+                                    'https://logstash.example.com:8080')
+            # Settings are passed to each EsLogger, not set in the environment
+            nose.tools.assert_equal(dict(os.environ), {})
 
     @nose.tools.raises(es_logger.zmq_client.ZMQClientMisconfiguration)
     def test_zmq_missing_config(self):
@@ -256,10 +476,12 @@ class TestZMQClient(object):
 
     def test_test_zmq_task(self):
         with nose.tools.assert_logs(level='DEBUG') as cm:
-            self.zmqd.test_zmq_task([self.sample_finished_message])
+            self.zmqd.test_zmq_task([self.sample_finished_message], self.sample_finished_build)
+            self.zmqd.test_zmq_task([b'garbage'], None)
         nose.tools.assert_equal(
             cm.output,
-            ['INFO:root:Got event: job [folder/sample-job] number [123] phase [FINISHED]'])
+            ['INFO:root:Got event: job [folder/sample-job] number [123] phase [FINISHED]',
+             "INFO:root:Got unparseable event: [b'garbage']"])
 
     @unittest.mock.patch('es_logger.EsLogger', autospec=True)
     def test_es_logger_task(self, mock_esl):
@@ -267,7 +489,7 @@ class TestZMQClient(object):
         mock_esl_instance = mock_esl(32500, ['logstash'])
         mock_esl_instance.post_all.return_value = 0
         with nose.tools.assert_logs(level='DEBUG') as cm:
-            self.zmqd.es_logger_task([self.sample_finished_message])
+            self.zmqd.es_logger_task([self.sample_finished_message], self.sample_finished_build)
         nose.tools.assert_equal(cm.output,
                                 ['INFO:root:Process folder/sample-job number 123 on ' +
                                  'https://joc.example.com/jenkins/jenkins_url',
@@ -286,9 +508,12 @@ class TestZMQClient(object):
         mock_esl_instance = mock_esl(32500, ['logstash'])
         mock_esl_instance.post_all.return_value = 0
         with nose.tools.assert_logs(level='DEBUG') as cm:
-            self.zmqd.es_logger_task([self.sample_completed_message])
+            self.zmqd.es_logger_task([self.sample_completed_message],
+                                     self.sample_completed_build)
+            self.zmqd.es_logger_task([b'garbage'], None)
         nose.tools.assert_equal(cm.output,
-                                ['DEBUG:root:Not collecting from job in phase COMPLETED'])
+                                ['DEBUG:root:Not collecting from job in phase COMPLETED',
+                                 'DEBUG:root:Not collecting from job in phase None'])
         esl_calls = []
         nose.tools.assert_equals(mock_esl.method_calls, esl_calls)
 
@@ -297,7 +522,8 @@ class TestZMQClient(object):
             status_list = asyncio.run(self.async_worker())
         nose.tools.ok_(self.zmqd.queue.qsize() == 0)
         nose.tools.ok_(status_list == [0])
-        self.zmqd.es_logger_task.assert_called_with(self.sample_finished_message)
+        self.zmqd.es_logger_task.assert_called_with(self.sample_finished_message,
+                                                    self.sample_finished_build)
         print(cm.output)
         nose.tools.assert_equal(
             cm.output,
@@ -315,13 +541,226 @@ class TestZMQClient(object):
         self.zmqd.es_logger_task = unittest.mock.MagicMock()
         self.zmqd.es_logger_task.return_value = 0
         task = asyncio.create_task(self.zmqd.worker('worker-1', 'es_logger_task'))
-        self.zmqd.queue.put_nowait(self.sample_finished_message)
+        self.zmqd.queue.put_nowait((self.sample_finished_message, self.sample_finished_build))
         # Yield control to the worker task
         await asyncio.sleep(1)
         # Cancel the worker
         task.cancel()
         return await asyncio.gather(task, return_exceptions=True)
 
+    def test_worker_stopped(self):
+        self.zmqd.complete_work = unittest.mock.MagicMock()
+        self.zmqd.persist_unprocessed = unittest.mock.MagicMock()
+        with nose.tools.assert_logs(level='INFO') as cm:
+            status_list = asyncio.run(self.async_worker_stopped(cancels=1))
+        # The build being processed when stopped is finished, and its status returned
+        nose.tools.assert_equal(status_list, [2])
+        self.zmqd.complete_work.assert_called_once_with('build')
+        self.zmqd.persist_unprocessed.assert_not_called()
+        nose.tools.assert_equal(
+            cm.output,
+            ['INFO:root:worker-1 Starting',
+             'INFO:root:worker-1 cancelled, finishing msg',
+             'INFO:root:worker-1 Finished msg with result 2'])
+
+    def test_worker_stopped_again(self):
+        self.zmqd.complete_work = unittest.mock.MagicMock()
+        self.zmqd.persist_unprocessed = unittest.mock.MagicMock()
+        with nose.tools.assert_logs(level='INFO') as cm:
+            status_list = asyncio.run(self.async_worker_stopped(cancels=2))
+        nose.tools.assert_equal(status_list, [0])
+        # Kept to process on restart
+        self.zmqd.complete_work.assert_not_called()
+        self.zmqd.persist_unprocessed.assert_called_once_with([([b'msg'], 'build')])
+        nose.tools.assert_equal(
+            cm.output,
+            ['INFO:root:worker-1 Starting',
+             'INFO:root:worker-1 cancelled, finishing msg',
+             'WARNING:root:worker-1 out of time, not finishing msg [b\'msg\']'])
+
+    async def async_worker_stopped(self, cancels):
+        self.zmqd.queue = asyncio.Queue()
+        building = concurrent.futures.Future()
+        self.zmqd.es_logger_task = unittest.mock.MagicMock(
+            side_effect=lambda msg, build: building.result())
+        task = asyncio.create_task(self.zmqd.worker('worker-1', 'es_logger_task'))
+        self.zmqd.queue.put_nowait(([b'msg'], 'build'))
+        await asyncio.sleep(0.5)
+        for i in range(cancels):
+            task.cancel()
+            await asyncio.sleep(0.5)
+        building.set_result(2)
+        return await asyncio.gather(task, return_exceptions=True)
+
+    def test_wait_workers(self):
+        status_list = asyncio.run(self.async_wait_workers())
+        # Workers still running at the deadline are cancelled again
+        nose.tools.assert_equal(status_list[0], 0)
+        nose.tools.assert_is_instance(status_list[1], asyncio.CancelledError)
+        nose.tools.ok_(self.zmqd.drain_expired)
+
+    async def async_wait_workers(self):
+        self.zmqd.drain_timeout = 1
+        await self.zmqd.wait_workers()
+        nose.tools.ok_(not self.zmqd.drain_expired)
+        self.zmqd.tasks = [asyncio.create_task(self.dummyTask(1)),
+                           asyncio.create_task(self.dummyTask(2, sleep=30))]
+        await self.zmqd.wait_workers()
+        return await asyncio.gather(*self.zmqd.tasks, return_exceptions=True)
+
+    @parameterized.expand([(0, 'ok'), (2, 'failed'), (None, 'skipped')])
+    def test_process(self, result, label):
+        self.zmqd.es_logger_task = unittest.mock.MagicMock(return_value=result)
+        with unittest.mock.patch('es_logger.metrics.BUILDS_PROCESSED') as mock_processed:
+            nose.tools.assert_equal(
+                asyncio.run(self.zmqd.process('es_logger_task', [b'msg'], None)), result)
+        mock_processed.inc.assert_called_once_with(result=label)
+        nose.tools.assert_equal(self.zmqd.busy_workers, 0)
+
+    def test_process_latency(self):
+        # Known to be in progress while it is processed
+        self.zmqd.es_logger_task = unittest.mock.MagicMock(
+            side_effect=lambda msg, build: len(self.zmqd.processing_since))
+        self.zmqd.record_latency = unittest.mock.MagicMock()
+        nose.tools.assert_equal(
+            asyncio.run(self.zmqd.process('es_logger_task', [b'msg'], None)), 1)
+        self.zmqd.record_latency.assert_called_once()
+        nose.tools.assert_equal(self.zmqd.processing_since, [])
+
+    def test_get_latency(self):
+        nose.tools.assert_equal(self.zmqd.get_latency(), 0)
+        with unittest.mock.patch('time.monotonic', return_value=100):
+            self.zmqd.processing_since = [95, 90]
+            nose.tools.assert_equal(self.zmqd.get_latency(), 10)
+            # Once measured, the moving average is used
+            self.zmqd.latency = 3
+            nose.tools.assert_equal(self.zmqd.get_latency(), 3)
+
+    def test_record_latency(self):
+        self.zmqd.record_latency(10)
+        nose.tools.assert_equal(self.zmqd.latency, 10)
+        self.zmqd.record_latency(5)
+        nose.tools.assert_equal(self.zmqd.latency, 9)
+
+    def test_process_error(self):
+        self.zmqd.es_logger_task = unittest.mock.MagicMock(side_effect=KeyError('url'))
+        with unittest.mock.patch('es_logger.metrics.BUILDS_PROCESSED') as mock_processed:
+            nose.tools.assert_raises(KeyError, asyncio.run,
+                                     self.zmqd.process('es_logger_task', [b'msg'], None))
+        mock_processed.inc.assert_called_once_with(result='error')
+        nose.tools.assert_equal(self.zmqd.busy_workers, 0)
+
+    def test_worker_retire(self):
+        with nose.tools.assert_logs(level='INFO') as cm:
+            asyncio.run(self.async_worker_retire())
+        nose.tools.assert_equal(self.zmqd.tasks, [])
+        nose.tools.assert_equal(self.zmqd.retiring, 0)
+        nose.tools.assert_equal(
+            cm.output,
+            ['INFO:root:worker-0 Starting',
+             'INFO:root:worker-0 retiring',
+             'INFO:root:worker-0 Finished'])
+
+    async def async_worker_retire(self):
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.process_func = 'es_logger_task'
+        self.zmqd.retiring = 1
+        self.zmqd.add_worker()
+        nose.tools.assert_equal(await self.zmqd.tasks[0], 0)
+
+    def test_autoscale(self):
+        asyncio.run(self.async_autoscale())
+
+    async def async_autoscale(self):
+        self.zmqd.min_workers = 1
+        self.zmqd.max_workers = 4
+        self.zmqd.scale_down_checks = 2
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.tasks = [unittest.mock.MagicMock()]
+        self.zmqd.add_worker = unittest.mock.MagicMock(
+            side_effect=lambda: self.zmqd.tasks.append(unittest.mock.MagicMock()))
+        with nose.tools.assert_logs(level='INFO') as cm:
+            # No latency measured yet, and nothing being processed
+            for i in range(10):
+                self.zmqd.queue.put_nowait(i)
+            self.zmqd.autoscale()
+            nose.tools.assert_equal(len(self.zmqd.tasks), 1)
+            # 10 messages of at least 11.5s, going by the message being processed, is 115s to
+            # drain with 1 worker, 2 workers drain it in under 60s
+            self.zmqd.processing_since = [time.monotonic() - 11.5]
+            self.zmqd.autoscale()
+            nose.tools.assert_equal(len(self.zmqd.tasks), 2)
+            self.zmqd.processing_since = []
+            # Grows by at least one worker, up to max_workers
+            self.zmqd.latency = 13
+            self.zmqd.autoscale()
+            nose.tools.assert_equal(len(self.zmqd.tasks), 3)
+            self.zmqd.latency = 600
+            self.zmqd.autoscale()
+            self.zmqd.autoscale()
+            nose.tools.assert_equal(len(self.zmqd.tasks), 4)
+            # Only shrinks once idle for scale_down_checks checks in a row
+            while self.zmqd.queue.qsize() > 0:
+                self.zmqd.queue.get_nowait()
+            self.zmqd.autoscale()
+            self.zmqd.busy_workers = 4
+            self.zmqd.autoscale()
+            self.zmqd.busy_workers = 0
+            self.zmqd.autoscale()
+            nose.tools.assert_equal(self.zmqd.retiring, 0)
+            self.zmqd.autoscale()
+            nose.tools.assert_equal(self.zmqd.retiring, 1)
+            for i in range(6):
+                self.zmqd.autoscale()
+            # Never below min_workers
+            nose.tools.assert_equal(self.zmqd.retiring, 3)
+        nose.tools.assert_equal(
+            cm.output,
+            ['INFO:root:Queue of 10 needs 115s to drain, scaling up to 2 workers',
+             'INFO:root:Queue of 10 needs 65s to drain, scaling up to 3 workers',
+             'INFO:root:Queue of 10 needs 2000s to drain, scaling up to 4 workers',
+             'INFO:root:Workers idle, scaling down to 3 workers',
+             'INFO:root:Workers idle, scaling down to 2 workers',
+             'INFO:root:Workers idle, scaling down to 1 workers'])
+
+    def test_add_worker_master(self):
+        asyncio.run(self.async_add_worker_master())
+
+    async def async_add_worker_master(self):
+        self.zmqd.master = 'a'
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.tasks = []
+        self.zmqd.process_func = self.zmqd.test_zmq_task
+        self.zmqd.worker = unittest.mock.MagicMock(side_effect=lambda *args: self.dummyTask(0))
+        self.zmqd.add_worker()
+        self.zmqd.add_worker()
+        await asyncio.gather(*self.zmqd.tasks)
+        nose.tools.assert_equal([call.args[0] for call in self.zmqd.worker.call_args_list],
+                                ['a-worker-0', 'a-worker-1'])
+
+    def test_worker_executor(self):
+        self.zmqd.num_workers = 2
+        self.zmqd.executor = self.zmqd.get_executor()
+        nose.tools.assert_is_instance(self.zmqd.executor, concurrent.futures.ThreadPoolExecutor)
+        asyncio.run(self.async_worker())
+        self.zmqd.executor.shutdown()
+        self.zmqd.es_logger_task.assert_called_with(self.sample_finished_message,
+                                                    self.sample_finished_build)
+
+    def test_process_executor(self):
+        self.zmqd.num_workers = 1
+        self.zmqd.executor_type = 'process'
+        # The asyncio state of the daemon is not passed to the process pool
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.listener = unittest.mock.MagicMock()
+        self.zmqd.executor = self.zmqd.get_executor()
+        nose.tools.assert_is_instance(self.zmqd.executor, concurrent.futures.ProcessPoolExecutor)
+        nose.tools.ok_('queue' not in self.zmqd.__getstate__())
+        future = self.zmqd.executor.submit(self.zmqd.test_zmq_task, [self.sample_finished_message],
+                                           self.sample_finished_build)
+        nose.tools.assert_equal(future.result(timeout=30), 0)
+        self.zmqd.executor.shutdown()
+
     def test_worker_timeout(self):
         with nose.tools.assert_logs(level='DEBUG') as cm:
             status_list = asyncio.run(self.async_worker_timeout())
@@ -350,8 +789,8 @@ class TestZMQClient(object):
         with nose.tools.assert_logs(level='DEBUG') as cm:
             status_list = asyncio.run(self.async_drain_queue())
         nose.tools.ok_(status_list == [0])
-        calls = [unittest.mock.call(self.sample_completed_message),
-                 unittest.mock.call(self.sample_finished_message)]
+        calls = [unittest.mock.call(self.sample_completed_message, None),
+                 unittest.mock.call(self.sample_finished_message, self.sample_finished_build)]
         self.zmqd.es_logger_task.assert_has_calls(calls)
         print(cm.output)
         nose.tools.assert_equal(
@@ -359,8 +798,8 @@ class TestZMQClient(object):
             ['DEBUG:asyncio:Using selector: EpollSelector',
              'INFO:root:Draining queue of size 2',
              'DEBUG:root:Processing msg ' + self.sample_completed_message_log,
-             'DEBUG:root:Result None',
              'DEBUG:root:Processing msg ' + self.sample_finished_message_log,
+             'DEBUG:root:Result None',
              'DEBUG:root:Result 0',
              'INFO:root:Queue drained, processed 2'])
 
@@ -368,10 +807,443 @@ class TestZMQClient(object):
         self.zmqd.es_logger_task = unittest.mock.MagicMock()
         self.zmqd.es_logger_task.side_effect = [None, 0]
         self.zmqd.queue = asyncio.Queue()
-        self.zmqd.queue.put_nowait(self.sample_completed_message)
-        self.zmqd.queue.put_nowait(self.sample_finished_message)
+        self.zmqd.queue.put_nowait((self.sample_completed_message, None))
+        self.zmqd.queue.put_nowait((self.sample_finished_message, self.sample_finished_build))
         return await self.zmqd.drain_queue()
 
+    def test_drain_queue_exception(self):
+        self.zmqd.es_logger_task = unittest.mock.MagicMock(side_effect=[KeyError('url'), 0])
+        status_list = asyncio.run(self.async_drain_queue_messages([[b'bad'], [b'good']]))
+        nose.tools.assert_equal(len(status_list), 2)
+        nose.tools.assert_is_instance(status_list[0], KeyError)
+        nose.tools.assert_equal(status_list[1], 0)
+
+    async def async_drain_queue_messages(self, msgs):
+        self.zmqd.queue = asyncio.Queue()
+        for msg in msgs:
+            self.zmqd.queue.put_nowait((msg, None))
+        return await self.zmqd.drain_queue()
+
+    def test_drain_queue_deadline(self):
+        slow = concurrent.futures.Future()
+        self.zmqd.es_logger_task = unittest.mock.MagicMock(
+            side_effect=lambda msg, build: 0 if msg == [b'fast'] else slow.result())
+        self.zmqd.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.zmqd.drain_timeout = 1
+        self.zmqd.complete_work = unittest.mock.MagicMock()
+        with tempfile.TemporaryDirectory() as spill_dir:
+            self.zmqd.spill_file = os.path.join(spill_dir, 'spill')
+            with nose.tools.assert_logs(level='INFO') as cm:
+                status_list = asyncio.run(self.async_drain_queue_messages(
+                    [[b'fast'], [b'slow'], [b'slow'], [b'queued']]))
+            slow.set_result(0)
+            self.zmqd.executor.shutdown()
+            spill = es_logger.journal.SpillFile(self.zmqd.spill_file)
+            kept = [spill.pop() for i in range(len(spill))]
+        nose.tools.assert_equal(status_list, [0])
+        nose.tools.assert_equal(kept, [[b'slow'], [b'slow'], [b'queued']])
+        nose.tools.ok_(self.zmqd.drain_expired)
+        self.zmqd.complete_work.assert_called_once_with(None)
+        # The message never started is not run after the deadline
+        nose.tools.assert_equal(self.zmqd.es_logger_task.call_count, 3)
+        nose.tools.assert_equal(
+            cm.output,
+            ['INFO:root:Draining queue of size 4',
+             'WARNING:root:Shutdown deadline of 1s reached, kept 3 unprocessed messages',
+             'INFO:root:Queue drained, processed 1'])
+
+    def test_persist_unprocessed_journal(self):
+        self.zmqd.journal = unittest.mock.MagicMock()
+        self.zmqd.spill = unittest.mock.MagicMock()
+        with nose.tools.assert_logs(level='WARNING'):
+            self.zmqd.persist_unprocessed([([self.sample_finished_message],
+                                            self.sample_finished_build), ([b'other'], None)])
+        # FINISHED messages are already kept in the journal
+        self.zmqd.spill.append.assert_called_once_with([b'other'])
+
+    def test_parse_message(self):
+        parse = self.zmqd.parse_message
+        nose.tools.assert_equal(parse([self.sample_finished_message]), self.sample_finished_build)
+        nose.tools.assert_equal(parse([self.sample_completed_message]),
+                                self.sample_completed_build)
+        nose.tools.assert_equal(parse([b'onFinalized {"url": "a/", "build": {}}']),
+                                es_logger.zmq_client.Build('a', None, None, None, False))
+        nose.tools.ok_(parse([b'onFinalized {"url": ""}']) is None)
+        nose.tools.ok_(parse([b'onFinalized {"url": "a/", "build": 1}']) is None)
+        nose.tools.ok_(parse([b'not json']) is None)
+        nose.tools.ok_(parse(1) is None)
+
+    def test_fair_queue(self):
+        queued = asyncio.run(self.async_fair_queue())
+        nose.tools.assert_equal(queued, ['b1!', 'a1', 'b2', 'c1', 'a2', 'c2', 'a3', 'a0?', 'c0?'])
+
+    async def async_fair_queue(self):
+        tiers = {'!': es_logger.zmq_client.PRIORITY, '?': es_logger.zmq_client.CATCH_UP}
+        queue = es_logger.zmq_client.FairQueue(
+            maxsize=9, classify=lambda item: (item[0], tiers.get(item[-1],
+                                                                 es_logger.zmq_client.LIVE)))
+        for item in ['a0?', 'a1', 'a2', 'a3', 'b1!', 'b2', 'c0?', 'c1', 'c2']:
+            queue.put_nowait(item)
+        nose.tools.ok_(queue.full())
+        nose.tools.assert_equal(sorted(queue._queue),
+                                ['a0?', 'a1', 'a2', 'a3', 'b1!', 'b2', 'c0?', 'c1', 'c2'])
+        return [queue.get_nowait() for i in range(queue.qsize())]
+
+    def test_fair_queue_default(self):
+        queued = asyncio.run(self.async_fair_queue_default())
+        nose.tools.assert_equal(queued, [3, 1, 2])
+
+    async def async_fair_queue_default(self):
+        queue = es_logger.zmq_client.FairQueue()
+        for item in [3, 1, 2]:
+            await queue.put(item)
+        nose.tools.ok_(not queue.empty())
+        return [await queue.get() for i in range(3)]
+
+    def test_classify_message(self):
+        failed = self.sample_finished_build._replace(status='FAILURE')
+        nose.tools.assert_equal(self.zmqd.classify_message((None, self.sample_finished_build)),
+                                ('folder/sample-job', es_logger.zmq_client.LIVE))
+        nose.tools.assert_equal(self.zmqd.classify_message((None, failed)),
+                                ('folder/sample-job', es_logger.zmq_client.PRIORITY))
+        nose.tools.assert_equal(self.zmqd.classify_message(([b'not json'], None)),
+                                (None, es_logger.zmq_client.LIVE))
+        caught_up = self.zmqd.make_catch_up_message('folder/sample-job', 124)
+        nose.tools.assert_equal(
+            self.zmqd.classify_message((caught_up, self.zmqd.parse_message(caught_up))),
+            ('folder/sample-job', es_logger.zmq_client.CATCH_UP))
+        self.zmqd.scheduling = 'fifo'
+        nose.tools.assert_equal(self.zmqd.classify_message((None, failed)),
+                                (None, es_logger.zmq_client.PRIORITY))
+
+    def test_is_finished(self):
+        nose.tools.ok_(self.zmqd.is_finished(self.sample_finished_build))
+        nose.tools.ok_(not self.zmqd.is_finished(
+            self.sample_completed_build))
+        nose.tools.ok_(not self.zmqd.is_finished(self.sample_finished_build._replace(number=None)))
+        nose.tools.ok_(not self.zmqd.is_finished(None))
+
+    def test_journal_work(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            self.zmqd.journal = es_logger.journal.WorkJournal(os.path.join(journal_dir, 'db'))
+            queued = asyncio.run(self.async_journal_work())
+            nose.tools.assert_equal(self.zmqd.journal.pending(), [])
+            self.zmqd.journal.close()
+        nose.tools.assert_equal([msg for msg, build in queued],
+                                [[self.sample_completed_message], [self.sample_finished_message]])
+
+    async def async_journal_work(self):
+        self.zmqd.queue = asyncio.Queue()
+        await self.zmqd.enqueue([self.sample_completed_message],
+                                self.sample_completed_build)
+        await self.zmqd.enqueue([self.sample_finished_message], self.sample_finished_build)
+        # Only FINISHED messages are processed, so only they are recorded
+        nose.tools.assert_equal(self.zmqd.journal.pending(), [[self.sample_finished_message]])
+        queued = [self.zmqd.queue.get_nowait(), self.zmqd.queue.get_nowait()]
+        for msg, build in queued:
+            self.zmqd.complete_work(build)
+        return queued
+
+    def test_complete_work_checkpoint(self):
+        self.zmqd.checkpoint = unittest.mock.MagicMock()
+        self.zmqd.complete_work(self.sample_completed_build)
+        self.zmqd.checkpoint.update.assert_not_called()
+        self.zmqd.complete_work(self.sample_finished_build)
+        self.zmqd.checkpoint.update.assert_called_once_with('folder/sample-job', 123)
+
+    def test_make_catch_up_message(self):
+        msg = self.zmqd.make_catch_up_message('folder/sample job', 124)
+        nose.tools.assert_equal(self.zmqd.parse_message(msg), es_logger.zmq_client.Build(
+            'folder/sample job', 124, 'FINISHED', None, True))
+        self.zmqd.test_zmq = False
+        nose.tools.ok_(self.zmqd.is_actionable(msg))
+
+    @unittest.mock.patch('es_logger.connect_jenkins')
+    def test_get_jenkins_server(self, mock_connect):
+        self.zmqd.settings = {'JENKINS_URL': 'https://jenkins.example.com',
+                              'JENKINS_RATE_LIMIT': '10'}
+        with unittest.mock.patch.dict('os.environ', {'JENKINS_USER': 'user'}):
+            nose.tools.ok_(self.zmqd.get_jenkins_server() is mock_connect.return_value)
+        mock_connect.assert_called_once_with('https://jenkins.example.com', 'user', None, 10, 0)
+
+    def test_get_process_settings(self):
+        self.zmqd.settings = {'JENKINS_URL': 'https://jenkins.example.com',
+                              'JENKINS_RATE_LIMIT': '10'}
+        nose.tools.ok_(self.zmqd.get_process_settings() is self.zmqd.settings)
+        # Split between the three worker processes and the daemon
+        self.zmqd.executor_type = 'process'
+        self.zmqd.num_workers = 3
+        with unittest.mock.patch.dict('os.environ', {'JENKINS_HEAVY_RATE_LIMIT': '2'}):
+            nose.tools.assert_equal(self.zmqd.get_process_settings(),
+                                    {'JENKINS_URL': 'https://jenkins.example.com',
+                                     'JENKINS_RATE_LIMIT': '2.5',
+                                     'JENKINS_HEAVY_RATE_LIMIT': '0.5'})
+        nose.tools.assert_equal(self.zmqd.settings['JENKINS_RATE_LIMIT'], '10')
+
+    def test_find_missed_builds(self):
+        builds = {'job': [{'number': 5, 'building': True}, {'number': 4, 'building': False},
+                          {'number': 3}, {'number': 2}],
+                  'other': [{'number': 7}],
+                  'busy': [{'number': number} for number in range(250, 0, -1)]}
+
+        def get_job_builds(job, start, end):
+            if job not in builds:
+                raise JenkinsException('job[{}] does not exist'.format(job))
+            return builds[job][start:end]
+        self.zmqd.get_jenkins_server = unittest.mock.MagicMock()
+        server = self.zmqd.get_jenkins_server.return_value
+        server.get_job_builds.side_effect = get_job_builds
+        with nose.tools.assert_logs(level='WARNING') as cm:
+            missed = self.zmqd.find_missed_builds({'job': 2, 'other': 7, 'gone': 1, 'busy': 40})
+        # Builds older than the most recent page are listed back to the checkpoint
+        nose.tools.assert_equal(missed, [('busy', number) for number in range(41, 251)] +
+                                [('job', 3), ('job', 4)])
+        nose.tools.assert_equal(
+            server.get_job_builds.call_args_list,
+            [unittest.mock.call('busy', start=0, end=100),
+             unittest.mock.call('busy', start=100, end=200),
+             unittest.mock.call('busy', start=200, end=300),
+             unittest.mock.call('gone', start=0, end=100),
+             unittest.mock.call('job', start=0, end=100),
+             unittest.mock.call('other', start=0, end=100)])
+        nose.tools.assert_equal(cm.output,
+                                ['WARNING:root:Unable to catch up on gone: '
+                                 'job[gone] does not exist'])
+
+    def test_catch_up(self):
+        self.zmqd.test_zmq = False
+        self.zmqd.checkpoint = unittest.mock.MagicMock()
+        self.zmqd.checkpoint.builds.return_value = {'folder/sample-job': 122}
+        self.zmqd.find_missed_builds = unittest.mock.MagicMock(
+            return_value=[('folder/sample-job', 123), ('folder/sample-job', 124)])
+        with nose.tools.assert_logs(level='INFO') as cm:
+            queued = asyncio.run(self.async_catch_up())
+        self.zmqd.find_missed_builds.assert_called_once_with({'folder/sample-job': 122})
+        # Already queued from Jenkins
+        nose.tools.assert_equal([msg for msg, build in queued],
+                                [[self.sample_finished_message],
+                                 self.zmqd.make_catch_up_message('folder/sample-job', 124)])
+        nose.tools.assert_equal(cm.output,
+                                ['INFO:root:Catching up on 2 builds finished since the checkpoint'])
+
+    async def async_catch_up(self):
+        self.zmqd.queue = es_logger.zmq_client.FairQueue(classify=self.zmqd.classify_message)
+        self.zmqd.is_duplicate(self.sample_finished_build)
+        await self.zmqd.enqueue([self.sample_finished_message], self.sample_finished_build)
+        self.zmqd.start_catch_up()
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            self.zmqd.start_catch_up()
+        nose.tools.assert_equal(cm.output, ['DEBUG:root:Already catching up'])
+        await self.zmqd.catch_up_task
+        return [self.zmqd.queue.get_nowait() for i in range(self.zmqd.queue.qsize())]
+
+    def test_catch_up_error(self):
+        self.zmqd.checkpoint = unittest.mock.MagicMock()
+        self.zmqd.find_missed_builds = unittest.mock.MagicMock(
+            side_effect=AttributeError("'NoneType' object has no attribute 'get_job_builds'"))
+        self.zmqd.queue = asyncio.Queue()
+        with nose.tools.assert_logs(level='INFO') as cm:
+            asyncio.run(self.zmqd.catch_up())
+        nose.tools.assert_equal(cm.output,
+                                ["WARNING:root:Unable to catch up: "
+                                 "'NoneType' object has no attribute 'get_job_builds'"])
+        nose.tools.assert_equal(self.zmqd.queue.qsize(), 0)
+
+    @staticmethod
+    def monitor_event(event):
+        future = asyncio.Future()
+        future.set_result([struct.pack('=hi', event, 0), b'tcp://jenkins.example.com:8888'])
+        return future
+
+    def test_watch_connection(self):
+        self.zmqd.zmq_publisher = 'tcp://jenkins.example.com:8888'
+        self.zmqd.start_catch_up = unittest.mock.MagicMock()
+        monitor = unittest.mock.MagicMock()
+        with nose.tools.assert_logs(level='INFO') as cm:
+            asyncio.run(self.async_watch_connection(monitor))
+        # Only a reconnection means messages may have been missed
+        self.zmqd.start_catch_up.assert_called_once_with()
+        monitor.close.assert_called_once_with()
+        nose.tools.assert_equal(
+            cm.output,
+            ['WARNING:root:Disconnected from tcp://jenkins.example.com:8888',
+             'INFO:root:Reconnected to tcp://jenkins.example.com:8888'])
+
+    async def async_watch_connection(self, monitor):
+        monitor.recv_multipart.side_effect = [
+            self.monitor_event(zmq.EVENT_CONNECTED), self.monitor_event(zmq.EVENT_DISCONNECTED),
+            self.monitor_event(zmq.EVENT_DISCONNECTED), self.monitor_event(zmq.EVENT_CONNECTED),
+            asyncio.Future()]
+        watcher = asyncio.create_task(self.zmqd.watch_connection(monitor))
+        await asyncio.sleep(0.1)
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+
+    @unittest.mock.patch('es_logger.zmq_client.Context', autospec=True)
+    def test_recv_checkpoint(self, mock_context):
+        self.zmqd.zmq_publisher = 'tcp://jenkins.example.com:8888'
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.checkpoint = unittest.mock.MagicMock()
+        self.zmqd.find_missed_builds = unittest.mock.MagicMock(return_value=[])
+        socket = mock_context.instance().socket()
+        socket.get_monitor_socket.return_value.recv_multipart.side_effect = [asyncio.Future()]
+        listener = asyncio.run(self.async_recv_checkpoint(mock_context.instance()))
+        nose.tools.assert_equal(listener.result(), 0)
+        socket.get_monitor_socket.assert_called_once_with(
+            zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED)
+        self.zmqd.find_missed_builds.assert_called_once_with(
+            self.zmqd.checkpoint.builds.return_value)
+        socket.get_monitor_socket.return_value.close.assert_called_once_with()
+        socket.disable_monitor.assert_called_once_with()
+
+    def test_resume_work(self):
+        self.zmqd.journal_max_resumes = 1
+        with tempfile.TemporaryDirectory() as journal_dir:
+            self.zmqd.journal = es_logger.journal.WorkJournal(os.path.join(journal_dir, 'db'))
+            self.zmqd.journal.add('folder/sample-job', 123, [self.sample_finished_message])
+            with nose.tools.assert_logs(level='DEBUG') as cm:
+                queued = asyncio.run(self.async_resume_work())
+            self.zmqd.journal.close()
+        nose.tools.assert_equal(queued, [[self.sample_finished_message], []])
+        nose.tools.assert_equal(
+            cm.output,
+            ['DEBUG:asyncio:Using selector: EpollSelector',
+             'INFO:root:Resuming 1 unfinished builds from the journal',
+             'WARNING:root:Abandoning 1 builds in the journal, resumed 1 times already',
+             'INFO:root:Resuming 0 unfinished builds from the journal'])
+
+    async def async_resume_work(self):
+        self.zmqd.queue = asyncio.Queue()
+        await self.zmqd.resume_work()
+        queued = [self.zmqd.queue.get_nowait()[0]]
+        # Left unfinished again, and given up on
+        await self.zmqd.resume_work()
+        queued.append(self.zmqd.journal.pending())
+        return queued
+
+    @unittest.mock.patch('es_logger.zmq_client.Context', autospec=True)
+    def test_recv_resume_work(self, mock_context):
+        self.zmqd.zmq_publisher = 'tcp://jenkins.example.com:8888'
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.journal = unittest.mock.MagicMock()
+        self.zmqd.journal.resume.return_value = (0, [[self.sample_finished_message]])
+        asyncio.run(self.async_recv(mock_context.instance()))
+        self.zmqd.journal.resume.assert_called_once_with(3)
+        nose.tools.assert_equal(self.zmqd.queue.get_nowait(),
+                                ([self.sample_finished_message], self.sample_finished_build))
+
+    async def async_recv_checkpoint(self, mc_instance):
+        listener = await self.async_recv(mc_instance)
+        await asyncio.gather(listener)
+        return listener
+
+    def test_enqueue_block(self):
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            blocked = asyncio.run(self.async_enqueue_block())
+        nose.tools.ok_(blocked)
+        nose.tools.assert_equal(
+            cm.output,
+            ['DEBUG:asyncio:Using selector: EpollSelector',
+             'WARNING:root:Queue full at 1 messages, applying overflow policy block'])
+
+    async def async_enqueue_block(self):
+        self.zmqd.queue = asyncio.Queue(maxsize=1)
+        await self.zmqd.enqueue([self.sample_completed_message], self.sample_completed_build)
+        try:
+            await asyncio.wait_for(self.zmqd.enqueue([self.sample_completed_message],
+                                                     self.sample_completed_build), 1)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    def test_enqueue_drop(self):
+        self.zmqd.overflow = 'drop'
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            queued = asyncio.run(self.async_enqueue_drop())
+        nose.tools.assert_equal(queued, [[self.sample_completed_message],
+                                         [self.sample_finished_message]])
+        nose.tools.assert_equal(
+            cm.output,
+            ['DEBUG:asyncio:Using selector: EpollSelector',
+             'WARNING:root:Queue full at 1 messages, applying overflow policy drop',
+             'DEBUG:root:Queue full, dropping [' + self.sample_completed_message_log + ']',
+             'DEBUG:root:Queue full, dropping [' + self.sample_completed_message_log + ']',
+             'INFO:root:Queue no longer full'])
+
+    async def async_enqueue_drop(self):
+        self.zmqd.queue = asyncio.Queue(maxsize=1)
+        await self.zmqd.enqueue([self.sample_completed_message], self.sample_completed_build)
+        await self.zmqd.enqueue([self.sample_completed_message], self.sample_completed_build)
+        await self.zmqd.enqueue([self.sample_completed_message], self.sample_completed_build)
+        # FINISHED messages are never dropped, they wait for room on the queue
+        finished = asyncio.create_task(self.zmqd.enqueue([self.sample_finished_message],
+                                                         self.sample_finished_build))
+        await asyncio.sleep(0.1)
+        nose.tools.ok_(not finished.done())
+        queued = [self.zmqd.queue.get_nowait()[0]]
+        await finished
+        queued.append(self.zmqd.queue.get_nowait()[0])
+        await self.zmqd.enqueue([self.sample_completed_message], self.sample_completed_build)
+        return queued
+
+    def test_enqueue_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            self.zmqd.overflow = 'spill'
+            self.zmqd.spill = es_logger.journal.SpillFile(os.path.join(spill_dir, 'spill'))
+            queued = asyncio.run(self.async_enqueue_spill())
+        nose.tools.assert_equal(queued, [[str(i).encode('ascii')] for i in range(5)])
+
+    async def async_enqueue_spill(self):
+        self.zmqd.queue = asyncio.Queue(maxsize=2)
+        for i in range(4):
+            await self.zmqd.enqueue([str(i).encode('ascii')], None)
+        nose.tools.assert_equal(len(self.zmqd.spill), 2)
+        queued = [self.zmqd.queue.get_nowait()[0]]
+        # Still spilled behind the older spilled messages, even with room on the queue
+        await self.zmqd.enqueue([b'4'], None)
+        nose.tools.assert_equal(len(self.zmqd.spill), 2)
+        while self.zmqd.queue.qsize() > 0:
+            queued.append(self.zmqd.queue.get_nowait()[0])
+            self.zmqd.refill_queue()
+        return queued
+
+    def test_enqueue_spill_journal(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            self.zmqd.journal = es_logger.journal.WorkJournal(os.path.join(spill_dir, 'journal'))
+            self.zmqd.overflow = 'spill'
+            self.zmqd.spill = es_logger.journal.SpillFile(os.path.join(spill_dir, 'spill'))
+            queued = asyncio.run(self.async_enqueue_spill_journal())
+            self.zmqd.journal.close()
+        # Held messages are queued once the spill file is empty
+        nose.tools.assert_equal(queued, [[b'0'], [b'1'], [self.sample_finished_message]])
+
+    async def async_enqueue_spill_journal(self):
+        self.zmqd.queue = asyncio.Queue(maxsize=1)
+        await self.zmqd.enqueue([b'0'], None)
+        await self.zmqd.enqueue([self.sample_finished_message], self.sample_finished_build)
+        await self.zmqd.enqueue([self.sample_finished_message], self.sample_finished_build)
+        # Journaled messages are held in the journal rather than spilled, so they aren't
+        # processed twice, nor kept in memory
+        nose.tools.assert_equal(len(self.zmqd.spill), 0)
+        nose.tools.assert_equal(self.zmqd.held, 1)
+        await self.zmqd.enqueue([b'1'], None)
+        nose.tools.assert_equal(len(self.zmqd.spill), 1)
+        queued = []
+        while self.zmqd.queue.qsize() > 0:
+            queued.append(self.zmqd.queue.get_nowait()[0])
+            self.zmqd.refill_queue()
+        nose.tools.assert_equal(self.zmqd.held, 0)
+        return queued
+
+    def test_refill_queue_held_missing(self):
+        self.zmqd.journal = unittest.mock.MagicMock()
+        self.zmqd.journal.take_held.return_value = []
+        self.zmqd.queue = asyncio.Queue(maxsize=2)
+        self.zmqd.held = 1
+        self.zmqd.refill_queue()
+        nose.tools.assert_equal(self.zmqd.held, 0)
+        self.zmqd.journal.take_held.assert_called_once_with(2)
+
     @unittest.mock.patch('es_logger.zmq_client.Context', autospec=True)
     def test_recv(self, mock_context):
         self.zmqd.zmq_publisher = 'tcp://jenkins.example.com:8888'
@@ -409,6 +1281,78 @@ class TestZMQClient(object):
         listener.cancel()
         return listener
 
+    def test_is_actionable(self):
+        nose.tools.ok_(self.zmqd.is_actionable(1))
+        self.zmqd.test_zmq = False
+        nose.tools.ok_(self.zmqd.is_actionable([self.sample_finished_message]))
+        nose.tools.ok_(not self.zmqd.is_actionable([self.sample_completed_message]))
+        nose.tools.ok_(not self.zmqd.is_actionable([self.sample_completed_message]))
+        nose.tools.ok_(not self.zmqd.is_actionable([b'onStarted {"build": {"phase" : "STARTED"}}']))
+        nose.tools.ok_(not self.zmqd.is_actionable([b'not json']))
+        nose.tools.assert_equal(self.zmqd.discarded,
+                                {'COMPLETED': 2, 'STARTED': 1, 'unknown': 1})
+
+    @unittest.mock.patch('time.monotonic')
+    def test_is_duplicate(self, mock_monotonic):
+        other_build = self.sample_finished_build._replace(number=124)
+        # Everything is kept when testing the connection
+        nose.tools.ok_(not self.zmqd.is_duplicate(self.sample_finished_build))
+        self.zmqd.test_zmq = False
+        self.zmqd.dedup_ttl = 60
+        mock_monotonic.return_value = 100
+        nose.tools.ok_(not self.zmqd.is_duplicate(self.sample_finished_build))
+        nose.tools.ok_(not self.zmqd.is_duplicate(self.sample_completed_build))
+        mock_monotonic.return_value = 130
+        nose.tools.ok_(self.zmqd.is_duplicate(self.sample_finished_build))
+        nose.tools.ok_(not self.zmqd.is_duplicate(other_build))
+        # Forgotten once the TTL expires
+        mock_monotonic.return_value = 160
+        nose.tools.ok_(not self.zmqd.is_duplicate(self.sample_finished_build))
+        nose.tools.ok_(self.zmqd.is_duplicate(other_build))
+        nose.tools.assert_equal(self.zmqd.duplicates, 2)
+        nose.tools.assert_equal(list(self.zmqd.seen_builds.values()), [190, 220])
+        self.zmqd.dedup_ttl = 0
+        nose.tools.ok_(not self.zmqd.is_duplicate(other_build))
+
+    @unittest.mock.patch('es_logger.zmq_client.Context', autospec=True)
+    def test_recv_discard(self, mock_context):
+        self.zmqd.zmq_publisher = 'tcp://jenkins.example.com:8888'
+        self.zmqd.test_zmq = False
+        self.zmqd.queue = asyncio.Queue()
+        mc_instance = mock_context.instance()
+        with nose.tools.assert_logs(level='DEBUG') as cm:
+            asyncio.run(self.async_recv_discard(mc_instance))
+        nose.tools.assert_equal(self.zmqd.queue.qsize(), 1)
+        nose.tools.assert_equal(self.zmqd.queue.get_nowait(),
+                                ([self.sample_finished_message], self.sample_finished_build))
+        nose.tools.assert_equal(
+            cm.output,
+            ['DEBUG:asyncio:Using selector: EpollSelector',
+             'INFO:root:Listener Starting against tcp://jenkins.example.com:8888',
+             'DEBUG:root:Listener waiting for message',
+             'DEBUG:root:Discarding message in phase COMPLETED',
+             'DEBUG:root:Listener waiting for message',
+             'DEBUG:root:Adding [' + self.sample_finished_message_log + '] to queue 0',
+             'DEBUG:root:Listener waiting for message',
+             'DEBUG:root:Skipping duplicate of folder/sample-job number 123',
+             'DEBUG:root:Listener waiting for message',
+             'INFO:root:Listener cancelled, finishing',
+             "INFO:root:Listener discarded messages by phase: {'COMPLETED': 1}",
+             'INFO:root:Listener skipped 1 duplicate messages',
+             'INFO:root:Listener Finished'])
+
+    async def async_recv_discard(self, mc_instance):
+        messages = []
+        for msg in [self.sample_completed_message, self.sample_finished_message,
+                    self.sample_finished_message]:
+            messages.append(asyncio.Future())
+            messages[-1].set_result([msg])
+        mc_instance.socket().recv_multipart.side_effect = messages + [asyncio.Future()]
+        listener = asyncio.create_task(self.zmqd.recv())
+        await asyncio.sleep(1)
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+
     def test_test_zmq_start(self):
         dummy_task = unittest.mock.MagicMock()
         dummy_task.return_value = self.dummyTask(0)
@@ -442,6 +1386,130 @@ class TestZMQClient(object):
         nose.tools.ok_(len(self.zmqd.tasks) == 2)
         nose.tools.ok_(self.zmqd.listener)
 
+    def test_es_logger_start_spill(self):
+        dummy_task = unittest.mock.MagicMock()
+        dummy_task.side_effect = lambda *args: self.dummyTask(0)
+        self.zmqd.recv = dummy_task
+        self.zmqd.worker = dummy_task
+        self.zmqd.num_workers = 1
+        self.zmqd.test_zmq = False
+        self.zmqd.max_queue_size = 2
+        self.zmqd.overflow = 'spill'
+        with tempfile.TemporaryDirectory() as spill_dir:
+            self.zmqd.spill_file = os.path.join(spill_dir, 'spill')
+            spill = es_logger.journal.SpillFile(self.zmqd.spill_file)
+            for i in range(3):
+                spill.append([str(i).encode('ascii')])
+            asyncio.run(self.async_start())
+            # Spilled messages from the last run are put back on the queue
+            nose.tools.assert_equal(self.zmqd.queue.qsize(), 2)
+            nose.tools.assert_equal(len(self.zmqd.spill), 1)
+
+    def test_es_logger_start_unprocessed(self):
+        dummy_task = unittest.mock.MagicMock()
+        dummy_task.side_effect = lambda *args: self.dummyTask(0)
+        self.zmqd.recv = dummy_task
+        self.zmqd.worker = dummy_task
+        self.zmqd.num_workers = 1
+        self.zmqd.test_zmq = False
+        self.zmqd.max_queue_size = 1
+        with tempfile.TemporaryDirectory() as spill_dir:
+            self.zmqd.spill_file = os.path.join(spill_dir, 'spill')
+            asyncio.run(self.async_start())
+            nose.tools.ok_(self.zmqd.spill is None)
+            # Left unprocessed at the last shutdown
+            spill = es_logger.journal.SpillFile(self.zmqd.spill_file)
+            for i in range(2):
+                spill.append([str(i).encode('ascii')])
+            queued = asyncio.run(self.async_start_unprocessed())
+        nose.tools.assert_equal(queued, [[b'0'], [b'1'], [b'2']])
+
+    async def async_start_unprocessed(self):
+        self.zmqd.start()
+        nose.tools.assert_equal(len(self.zmqd.spill), 1)
+        # New messages wait behind them
+        await self.zmqd.enqueue([b'2'], None)
+        nose.tools.assert_equal(len(self.zmqd.spill), 2)
+        queued = []
+        while self.zmqd.queue.qsize() > 0:
+            queued.append(self.zmqd.queue.get_nowait()[0])
+            self.zmqd.refill_queue()
+        # Then the overflow policy applies again
+        await self.zmqd.enqueue([b'3'], None)
+        blocked = asyncio.create_task(self.zmqd.enqueue([b'4'], None))
+        await asyncio.sleep(0.1)
+        nose.tools.ok_(not blocked.done())
+        blocked.cancel()
+        return queued
+
+    @unittest.mock.patch('es_logger.metrics.start_server')
+    def test_es_logger_start_metrics(self, mock_start_server):
+        dummy_task = unittest.mock.MagicMock()
+        dummy_task.side_effect = lambda *args: self.dummyTask(0)
+        self.zmqd.recv = dummy_task
+        self.zmqd.worker = dummy_task
+        self.zmqd.num_workers = 2
+        asyncio.run(self.async_start())
+        mock_start_server.assert_not_called()
+        self.zmqd.metrics_port = 9100
+        asyncio.run(self.async_start())
+        mock_start_server.assert_called_once_with('127.0.0.1', 9100)
+        nose.tools.ok_(self.zmqd.metrics_server is mock_start_server.return_value)
+        self.zmqd.queue.put_nowait(([b'msg'], None))
+        self.zmqd.busy_workers = 1
+        nose.tools.assert_equal(es_logger.metrics.QUEUE_DEPTH.samples(), [('', {}, 1)])
+        nose.tools.assert_equal(es_logger.metrics.WORKERS_BUSY.samples(), [('', {}, 1)])
+        nose.tools.assert_equal(es_logger.metrics.WORKER_UTILIZATION.samples(),
+                                [('', {}, 0.5)])
+
+    @unittest.mock.patch('es_logger.metrics.start_server')
+    def test_es_logger_start_master(self, mock_start_server):
+        dummy_task = unittest.mock.MagicMock()
+        dummy_task.side_effect = lambda *args: self.dummyTask(0)
+        self.zmqd.recv = dummy_task
+        self.zmqd.worker = dummy_task
+        self.zmqd.num_workers = 1
+        self.zmqd.master = 'a'
+        self.zmqd.add_signal_handlers = unittest.mock.MagicMock()
+        self.zmqd.start_metrics = unittest.mock.MagicMock()
+        asyncio.run(self.async_start())
+        # Left to the daemon running the masters
+        self.zmqd.add_signal_handlers.assert_not_called()
+        self.zmqd.start_metrics.assert_not_called()
+        nose.tools.assert_equal(len(self.zmqd.tasks), 1)
+
+    def test_es_logger_start_journal(self):
+        dummy_task = unittest.mock.MagicMock()
+        dummy_task.side_effect = lambda *args: self.dummyTask(0)
+        self.zmqd.recv = dummy_task
+        self.zmqd.worker = dummy_task
+        self.zmqd.num_workers = 1
+        with tempfile.TemporaryDirectory() as journal_dir:
+            self.zmqd.journal_file = os.path.join(journal_dir, 'journal.db')
+            # Nothing to resume when only testing the connection
+            asyncio.run(self.async_start())
+            nose.tools.ok_(self.zmqd.journal is None)
+            nose.tools.assert_is_instance(self.zmqd.queue, es_logger.zmq_client.FairQueue)
+            self.zmqd.test_zmq = False
+            asyncio.run(self.async_start())
+            nose.tools.assert_is_instance(self.zmqd.journal, es_logger.journal.WorkJournal)
+            self.zmqd.journal.close()
+
+    def test_es_logger_start_checkpoint(self):
+        dummy_task = unittest.mock.MagicMock()
+        dummy_task.side_effect = lambda *args: self.dummyTask(0)
+        self.zmqd.recv = dummy_task
+        self.zmqd.worker = dummy_task
+        self.zmqd.num_workers = 1
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            self.zmqd.checkpoint_file = os.path.join(checkpoint_dir, 'checkpoint.db')
+            asyncio.run(self.async_start())
+            nose.tools.ok_(self.zmqd.checkpoint is None)
+            self.zmqd.test_zmq = False
+            asyncio.run(self.async_start())
+            nose.tools.assert_is_instance(self.zmqd.checkpoint, es_logger.journal.Checkpoint)
+            self.zmqd.checkpoint.close()
+
     async def async_start(self):
         self.zmqd.start()
 
@@ -458,6 +1526,12 @@ class TestZMQClient(object):
                  r'DEBUG:root:All Tasks: {.*}',
                  r'INFO:root:Stopped, waiting for tasks to finish']))
 
+    def test_stop_masters(self):
+        master = unittest.mock.MagicMock()
+        self.zmqd.masters = [master]
+        asyncio.run(self.async_stop())
+        master.stop.assert_called_once_with()
+
     async def async_stop(self):
         self.zmqd.listener = asyncio.create_task(self.dummyTask(1, sleep=5))
         self.zmqd.tasks = [asyncio.create_task(self.dummyTask(2, sleep=5))]
@@ -509,6 +1583,7 @@ class TestZMQClient(object):
 
     def test_async_main(self):
         self.zmqd.queue = asyncio.Queue()
+        self.zmqd.executor = unittest.mock.MagicMock()
         self.zmqd.check_listener = unittest.mock.MagicMock()
         self.zmqd.check_tasks = unittest.mock.MagicMock()
         self.zmqd.start = unittest.mock.MagicMock()
@@ -523,6 +1598,70 @@ class TestZMQClient(object):
              'INFO:root:Queue drained, processed 0',
              'INFO:root:Gathering task statuses'])
         nose.tools.ok_(status == 0)
+        self.zmqd.executor.shutdown.assert_called_once_with(wait=True)
+
+    def test_async_main_journal(self):
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.journal = unittest.mock.MagicMock()
+        self.zmqd.check_listener = unittest.mock.MagicMock()
+        self.zmqd.check_tasks = unittest.mock.MagicMock()
+        self.zmqd.start = unittest.mock.MagicMock()
+        asyncio.run(self.async_async_main())
+        self.zmqd.journal.close.assert_called_once_with()
+
+    def test_async_main_checkpoint(self):
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.checkpoint = unittest.mock.MagicMock()
+        self.zmqd.check_listener = unittest.mock.MagicMock()
+        self.zmqd.check_tasks = unittest.mock.MagicMock()
+        self.zmqd.start = unittest.mock.MagicMock()
+        asyncio.run(self.async_async_main())
+        self.zmqd.checkpoint.close.assert_called_once_with()
+
+    def test_async_main_autoscale(self):
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.min_workers = 1
+        self.zmqd.max_workers = 2
+        self.zmqd.scale_interval = 1
+        self.zmqd.autoscale = unittest.mock.MagicMock()
+        self.zmqd.check_listener = unittest.mock.MagicMock()
+        self.zmqd.check_tasks = unittest.mock.MagicMock()
+        self.zmqd.start = unittest.mock.MagicMock()
+        asyncio.run(self.async_async_main())
+        nose.tools.ok_(self.zmqd.autoscale.call_count >= 2)
+
+    def test_async_main_drain_expired(self):
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.executor = unittest.mock.MagicMock()
+        self.zmqd.drain_expired = True
+        self.zmqd.check_listener = unittest.mock.MagicMock()
+        self.zmqd.check_tasks = unittest.mock.MagicMock()
+        self.zmqd.start = unittest.mock.MagicMock()
+        asyncio.run(self.async_async_main())
+        self.zmqd.executor.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+
+    def test_stop_executor(self):
+        self.zmqd.executor = unittest.mock.create_autospec(concurrent.futures.ThreadPoolExecutor)
+        self.zmqd.stop_executor()
+        self.zmqd.executor.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+
+    def test_stop_executor_process(self):
+        self.zmqd.executor = unittest.mock.MagicMock()
+        process = unittest.mock.MagicMock()
+        self.zmqd.executor._processes = {1: process}
+        self.zmqd.stop_executor()
+        self.zmqd.executor.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+        process.terminate.assert_called_once_with()
+
+    def test_async_main_metrics(self):
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.metrics_server = unittest.mock.MagicMock()
+        self.zmqd.check_listener = unittest.mock.MagicMock()
+        self.zmqd.check_tasks = unittest.mock.MagicMock()
+        self.zmqd.start = unittest.mock.MagicMock()
+        asyncio.run(self.async_async_main())
+        self.zmqd.metrics_server.shutdown.assert_called_once_with()
+        self.zmqd.metrics_server.server_close.assert_called_once_with()
 
     async def async_async_main(self):
         self.zmqd.listener = asyncio.create_task(self.dummyTask(1, sleep=5))
@@ -572,6 +1711,15 @@ class TestZMQClient(object):
             self.dummyTask(2, exception=Exception("Exception message")))]
         return await self.zmqd.async_main()
 
+    def test_async_main_stopping(self):
+        self.zmqd.queue = asyncio.Queue()
+        self.zmqd.start = unittest.mock.MagicMock()
+        self.zmqd.check_listener = unittest.mock.MagicMock()
+        self.zmqd.stopping = True
+        nose.tools.assert_equal(asyncio.run(self.async_async_main()), 0)
+        # Stopped by a signal, so not checked or stopped again
+        self.zmqd.check_listener.assert_not_called()
+
     def test_async_main_bad_listener(self):
         self.zmqd.queue = asyncio.Queue()
         self.zmqd.start = unittest.mock.MagicMock()
@@ -608,6 +1756,59 @@ class TestZMQClient(object):
             self.dummyTask("worker", sleep=3, exception=Exception("Exception message")))]
         return await self.zmqd.async_main()
 
+    def make_master(self, name, status=0, exception=None):
+        master = es_logger.zmq_client.ESLoggerZMQDaemon(self.zmqd.args)
+        master.master = name
+
+        async def async_main():
+            master.queue = asyncio.Queue()
+            master.queue.put_nowait(([b'msg'], None))
+            master.tasks = [unittest.mock.MagicMock()] * 2
+            master.busy_workers = 1
+            await asyncio.sleep(0)
+            if exception is not None:
+                raise exception
+            return status
+        master.async_main = async_main
+        return master
+
+    @unittest.mock.patch('es_logger.metrics.start_server')
+    def test_async_main_masters(self, mock_start_server):
+        self.zmqd.metrics_port = 9100
+        self.zmqd.masters = [self.make_master('a'), self.make_master('b', status=1),
+                             self.make_master('c', exception=Exception('Exception message'))]
+        with nose.tools.assert_logs(level='INFO') as cm:
+            status = asyncio.run(self.zmqd.async_main_masters())
+        nose.tools.assert_equal(status, 2)
+        nose.tools.assert_equal(cm.output,
+                                ["INFO:root:Starting masters ['a', 'b', 'c']",
+                                 'WARNING:root:Master c exception: Exception message'])
+        mock_start_server.assert_called_once_with('127.0.0.1', 9100)
+        mock_start_server.return_value.shutdown.assert_called_once_with()
+        mock_start_server.return_value.server_close.assert_called_once_with()
+        # The metrics cover every master
+        nose.tools.assert_equal(es_logger.metrics.QUEUE_DEPTH.samples(), [('', {}, 3)])
+        nose.tools.assert_equal(es_logger.metrics.WORKERS_BUSY.samples(), [('', {}, 3)])
+        nose.tools.assert_equal(es_logger.metrics.WORKER_UTILIZATION.samples(),
+                                [('', {}, 0.5)])
+
+    def test_async_main_masters_no_metrics(self):
+        self.zmqd.masters = [self.make_master('a')]
+        nose.tools.assert_equal(asyncio.run(self.zmqd.async_main_masters()), 0)
+        nose.tools.ok_(self.zmqd.metrics_server is None)
+
+    @unittest.mock.patch('es_logger.zmq_client.asyncio', autospec=True)
+    def test_main_masters(self, mock_asyncio):
+        with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
+            config = self.config_setup(mock_config_parser)
+            self.set_default_config(config)
+            self.set_masters_config(config)
+            mock_asyncio.run.return_value = 0
+            self.zmqd.async_main_masters = unittest.mock.Mock()
+            status = self.zmqd.main()
+        mock_asyncio.assert_has_calls([unittest.mock.call.run(self.zmqd.async_main_masters())])
+        nose.tools.assert_equal(status, 0)
+
     @unittest.mock.patch('es_logger.zmq_client.asyncio', autospec=True)
     def test_main(self, mock_asyncio):
         with unittest.mock.patch('configparser.ConfigParser') as mock_config_parser:
@@ -620,3 +1821,17 @@ class TestZMQClient(object):
         print(mock_asyncio.mock_calls)
         mock_asyncio.assert_has_calls([unittest.mock.call.run(self.zmqd.async_main())])
         nose.tools.assert_equal(status, 0)
+
+    @unittest.mock.patch('logging.shutdown', autospec=True)
+    @unittest.mock.patch('es_logger.zmq_client.os._exit', autospec=True)
+    @unittest.mock.patch('es_logger.zmq_client.asyncio', autospec=True)
+    def test_main_drain_expired(self, mock_asyncio, mock_exit, mock_shutdown):
+        mock_asyncio.run.return_value = 2
+        self.zmqd.configure = unittest.mock.Mock()
+        self.zmqd.async_main_masters = unittest.mock.Mock()
+        self.zmqd.masters = [self.make_master('a'), self.make_master('b')]
+        self.zmqd.masters[1].drain_expired = True
+        self.zmqd.main()
+        # The builds still running were kept for the next start, so don't wait for them
+        mock_shutdown.assert_called_once_with()
+        mock_exit.assert_called_once_with(2)